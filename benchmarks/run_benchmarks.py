@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Measure bitcode-build-tool orchestration overhead on synthetic inputs.
+
+Every build runs against the stub toolchain from stubtool.py, so this works
+on any host with python3 (no Xcode needed).  For each member count a fat
+Mach-O with one synthetic bitcode bundle per arch is generated, then built
+at each -j value; wall time, orchestrator CPU and peak RSS are reported.
+"""
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import stubtool
+import synthetic
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def int_list(value):
+    return [int(x) for x in value.split(",") if x]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-j", "--jobs", type=int_list, default=[1, 4, 16],
+                        help="comma separated -j values (default 1,4,16)")
+    parser.add_argument("--members", type=int_list, default=[100, 1000],
+                        help="comma separated bitcode member counts")
+    parser.add_argument("--member-size", type=int, default=4096,
+                        help="payload bytes per member")
+    parser.add_argument("--options", type=int, default=16,
+                        help="tool options per member")
+    parser.add_argument("--swift-ratio", type=float, default=0.0,
+                        help="fraction of members compiled with swiftc")
+    parser.add_argument("--objects", type=int, default=0,
+                        help="object members per bundle")
+    parser.add_argument("--lto", type=int, default=0,
+                        help="LTO members per bundle")
+    parser.add_argument("--nested", type=int, default=0,
+                        help="nested bundles per bundle")
+    parser.add_argument("--nested-members", type=int, default=10,
+                        help="bitcode members per nested bundle")
+    parser.add_argument("--archs", default="arm64",
+                        help="comma separated archs of the input Mach-O")
+    parser.add_argument("--platform", default="iOS",
+                        choices=sorted(synthetic.PLATFORMS))
+    parser.add_argument("--tool-sleep", type=float, default=0.0,
+                        help="seconds every stub tool invocation takes")
+    parser.add_argument("--compile-sleep", type=float, default=None,
+                        help="seconds per clang/swiftc invocation")
+    parser.add_argument("--link-sleep", type=float, default=None,
+                        help="seconds per ld invocation")
+    parser.add_argument("--output-size", type=int, default=1024,
+                        help="bytes written by stub compilers and linker")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="runs per configuration, the fastest is kept")
+    parser.add_argument("--extra-args", default="",
+                        help="extra arguments passed to bitcode-build-tool")
+    parser.add_argument("--json", dest="json_path",
+                        help="also write the results as JSON to this path")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the benchmark workspace")
+    return parser.parse_args(argv[1:])
+
+
+def make_input(workspace, args, members):
+    """Write the synthetic input Mach-O for a member count"""
+    path = os.path.join(workspace, "inputs", "app-{}".format(members))
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    slices = []
+    for arch in args.archs.split(","):
+        bundle = synthetic.make_bundle(
+            arch, args.platform, members, args.member_size, args.options,
+            args.swift_ratio, args.objects, args.lto, args.nested,
+            args.nested_members)
+        slices.append((arch, synthetic.make_thin_macho(arch, bundle,
+                                                       platform=args.platform)))
+    if len(slices) == 1:
+        data = slices[0][1]
+    else:
+        data = synthetic.make_fat_macho(slices)
+    return synthetic.write_file(path, data, 0o755)
+
+
+def run_build(workspace, stub_bin, sdk, input_path, jobs, extra_args):
+    """Build input_path once and return the measurements"""
+    out_dir = tempfile.mkdtemp(prefix="out", dir=workspace)
+    result_path = os.path.join(out_dir, "result.json")
+    cmd = [sys.executable, os.path.join(BENCH_DIR, "run_build.py"), stub_bin,
+           result_path, "--", input_path, "-o", os.path.join(out_dir, "a.out"),
+           "-j", str(jobs), "--sdk", sdk, "-t", stub_bin] + extra_args
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    wall = time.perf_counter() - start
+    try:
+        with open(result_path) as f:
+            result = json.load(f)
+    except (IOError, ValueError):
+        sys.stderr.write(proc.stdout.decode("utf-8", "replace"))
+        raise SystemExit("benchmark build crashed: {}".format(
+            " ".join(cmd)))
+    if result["status"] != "ok":
+        sys.stderr.write(proc.stdout.decode("utf-8", "replace"))
+    result["wall"] = wall
+    result["log_bytes"] = len(proc.stdout)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    return result
+
+
+def main(argv=None):
+    args = parse_args(argv or sys.argv)
+    workspace = tempfile.mkdtemp(prefix="bitcode-build-tool-bench")
+    sleep = {"default": args.tool_sleep}
+    if args.compile_sleep is not None:
+        sleep["clang"] = sleep["swiftc"] = args.compile_sleep
+    if args.link_sleep is not None:
+        sleep["ld"] = args.link_sleep
+    try:
+        stub_bin = stubtool.create_toolchain(
+            os.path.join(workspace, "toolchain"), sleep, args.output_size)
+        sdk = stubtool.create_sdk(os.path.join(workspace, "sdk"))
+        extra_args = shlex.split(args.extra_args)
+        results = []
+        header = "{:>8} {:>4} {:>10} {:>10} {:>10} {:>8}".format(
+            "members", "-j", "wall (s)", "cpu (s)", "rss (MB)", "status")
+        print(header)
+        print("-" * len(header))
+        for members in args.members:
+            input_path = make_input(workspace, args, members)
+            for jobs in args.jobs:
+                runs = [run_build(workspace, stub_bin, sdk, input_path, jobs,
+                                  extra_args)
+                        for _ in range(args.repeat)]
+                best = min(runs, key=lambda x: x["wall"])
+                best.update({"members": members, "jobs": jobs})
+                results.append(best)
+                print("{:>8} {:>4} {:>10.3f} {:>10.3f} {:>10.1f} {:>8}".format(
+                    members, jobs, best["wall"], best["cpu"],
+                    best["maxrss_kb"] / 1024.0, best["status"]))
+                sys.stdout.flush()
+        if args.json_path:
+            with open(args.json_path, "w") as f:
+                json.dump({"config": vars(args), "results": results}, f,
+                          indent=2, default=str)
+    finally:
+        if args.keep:
+            print("workspace: {}".format(workspace))
+        else:
+            shutil.rmtree(workspace, ignore_errors=True)
+    return 0 if all(x["status"] == "ok" for x in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,49 @@
+"""Run one bitcode-build-tool build against the stub toolchain.
+
+Usage: run_build.py STUB_BIN RESULT_JSON -- [bitcode-build-tool arguments]
+
+The build runs in this process so the rusage written to RESULT_JSON covers
+only the orchestrator itself, not the tools it launched.
+"""
+
+import json
+import os
+import resource
+import sys
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..",
+                       "lib")
+sys.path.insert(0, LIB_DIR)
+
+from bitcode_build_tool import bitcode_build_tool_main, BitcodeBuildFailure
+from bitcode_build_tool import bundle, cmdtool
+
+
+def main(argv):
+    stub_bin, result_path = argv[1], argv[2]
+    tool_args = argv[argv.index("--") + 1:]
+    # The tools below are invoked by absolute path rather than looked up on
+    # the tool search path, so point them at the stubs explicitly.
+    bundle.xar.XAR_EXEC = os.path.join(stub_bin, "xar")
+    cmdtool.CopyFile.DITTO = os.path.join(stub_bin, "ditto")
+
+    status = "ok"
+    try:
+        bitcode_build_tool_main(["bitcode-build-tool"] + tool_args)
+    except BitcodeBuildFailure:
+        status = "failed"
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    maxrss = usage.ru_maxrss
+    if sys.platform == "darwin":
+        maxrss //= 1024
+    with open(result_path, "w") as f:
+        json.dump({"status": status,
+                   "cpu": usage.ru_utime + usage.ru_stime,
+                   "utime": usage.ru_utime,
+                   "stime": usage.ru_stime,
+                   "maxrss_kb": maxrss}, f)
+    return 0 if status == "ok" else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
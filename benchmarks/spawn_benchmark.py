@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""Compare tool launch throughput of the executor backends.
+
+Runs COUNT short commands through each backend from a pool of -j threads
+(-j coroutines of the event loop for the asyncio backend), optionally after
+growing the orchestrator heap to mimic a large TOC and job list, and
+reports jobs per second and the threads the process used.
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "lib"))
+
+from bitcode_build_tool.executor import EXECUTORS, createExecutor
+from bitcode_build_tool.scheduler import JobSlots
+
+
+def int_list(value):
+    return [int(x) for x in value.split(",") if x]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-j", "--jobs", type=int_list, default=[16, 64],
+                        help="comma separated thread counts (default 16,64)")
+    parser.add_argument("--count", type=int, default=2000,
+                        help="commands launched per measurement")
+    parser.add_argument("--heap-mb", type=int_list, default=[0, 512],
+                        help="comma separated orchestrator heap sizes")
+    parser.add_argument("--backends", default=",".join(sorted(EXECUTORS)),
+                        help="comma separated executor backends")
+    parser.add_argument("--command", default="/bin/true",
+                        help="command to launch (default /bin/true)")
+    return parser.parse_args(argv[1:])
+
+
+def measure(backend, jobs, count, command):
+    executor = createExecutor(backend)
+    if executor.engine is not None:
+        return measureAsync(executor, jobs, count, command)
+    pool = ThreadPool(jobs)
+    try:
+        start = time.perf_counter()
+        results = pool.map(lambda _: executor.run(command, cwd=os.getcwd()),
+                           range(count))
+        elapsed = time.perf_counter() - start
+        threads = threading.active_count()
+    finally:
+        pool.close()
+        pool.join()
+        executor.close()
+    failures = sum(1 for result in results if result[0] != 0)
+    return count / elapsed, failures, threads
+
+
+def measureAsync(executor, jobs, count, command):
+    slots = JobSlots(jobs)
+
+    async def job(_):
+        taken = await slots.acquireAsync()
+        try:
+            return await executor.runAsync(command, os.getcwd())
+        finally:
+            slots.release(taken)
+
+    try:
+        start = time.perf_counter()
+        results = executor.engine.map(job, range(count))
+        elapsed = time.perf_counter() - start
+        threads = threading.active_count()
+    finally:
+        executor.close()
+    failures = sum(1 for result in results if result[0] != 0)
+    return count / elapsed, failures, threads
+
+
+def main(argv=None):
+    args = parse_args(argv or sys.argv)
+    command = args.command.split()
+    header = "{:>14} {:>8} {:>5} {:>10} {:>8} {:>8}".format(
+        "backend", "heap MB", "-j", "jobs/s", "failed", "threads")
+    print(header)
+    print("-" * len(header))
+    ballast = []
+    for heap_mb in sorted(args.heap_mb):
+        # touch every page so forking has to copy the page tables
+        while len(ballast) < heap_mb:
+            ballast.append(bytearray(b"\1") * (1 << 20))
+        for jobs in args.jobs:
+            for backend in args.backends.split(","):
+                rate, failures, threads = measure(backend, jobs, args.count,
+                                                  command)
+                print("{:>14} {:>8} {:>5} {:>10.1f} {:>8} {:>8}".format(
+                    backend, heap_mb, jobs, rate, failures, threads))
+                sys.stdout.flush()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
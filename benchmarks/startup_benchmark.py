@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Measure and guard the startup cost of bitcode-build-tool.
+
+Runs the import of the command line entry point and `--help` in fresh
+interpreters under `python -X importtime`, and reports the import time the
+package adds on top of a bare interpreter, the wall time of the process
+and the heaviest modules.  With --budget-ms it fails when the median import
+time goes over budget, and it always fails when one of the --forbid modules
+(only needed once a build runs) is imported at startup.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+LIB_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..",
+                       "lib")
+
+SCENARIOS = {
+    "import": "from bitcode_build_tool import bitcode_build_tool_main",
+    "help": "from bitcode_build_tool import bitcode_build_tool_main\n"
+            "try:\n"
+            "    bitcode_build_tool_main(['bitcode-build-tool', '--help'])\n"
+            "except SystemExit:\n"
+            "    pass",
+}
+
+FORBIDDEN = ["asyncio", "multiprocessing", "concurrent.futures",
+             "urllib.request", "http.client", "xml.etree.ElementTree",
+             "hashlib", "zipfile", "cProfile"]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=10,
+                        help="interpreters started per scenario (default 10)")
+    parser.add_argument("--budget-ms", type=float, default=None,
+                        help="fail when the median import time of a "
+                        "scenario is above this")
+    parser.add_argument("--forbid", default=",".join(FORBIDDEN),
+                        help="comma separated modules that must not be "
+                        "imported at startup")
+    parser.add_argument("--top", type=int, default=8,
+                        help="heaviest modules listed (default 8)")
+    return parser.parse_args(argv[1:])
+
+
+def importtime(code):
+    """Run code in a fresh interpreter, return (wall, {module: (self, cum,
+    top level)})"""
+    env = dict(os.environ, PYTHONPATH=LIB_DIR)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          env=env, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, check=True)
+    wall = time.perf_counter() - start
+    modules = dict()
+    for line in proc.stderr.decode().splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            # the header line
+            continue
+        name = fields[2].rstrip()
+        top_level = len(name) - len(name.lstrip()) == 1
+        modules[name.strip()] = (self_us, cumulative_us, top_level)
+    return wall, modules
+
+
+def addedImportTime(modules, baseline):
+    """Import time of the top level imports a bare interpreter doesn't do"""
+    return sum(cumulative for name, (_, cumulative, top_level)
+               in modules.items() if top_level and name not in baseline)
+
+
+def main(argv=None):
+    args = parse_args(argv or sys.argv)
+    forbidden = [x for x in args.forbid.split(",") if x]
+    # warm the bytecode caches, the first run would measure compilation
+    for code in SCENARIOS.values():
+        importtime(code)
+    baseline_walls = []
+    baseline = set()
+    for _ in range(args.runs):
+        wall, modules = importtime("pass")
+        baseline_walls.append(wall)
+        baseline.update(modules)
+    baseline_wall = statistics.median(baseline_walls)
+    failed = False
+    header = "{:>8} {:>10} {:>10} {:>8}".format("scenario", "import ms",
+                                                "wall ms", "modules")
+    print(header)
+    print("-" * len(header))
+    heaviest = dict()
+    for scenario, code in sorted(SCENARIOS.items()):
+        imports, walls = [], []
+        for _ in range(args.runs):
+            wall, modules = importtime(code)
+            imports.append(addedImportTime(modules, baseline) / 1000.0)
+            walls.append((wall - baseline_wall) * 1000.0)
+        imported = set(modules) - baseline
+        print("{:>8} {:>10.1f} {:>10.1f} {:>8}".format(
+            scenario, statistics.median(imports), statistics.median(walls),
+            len(imported)))
+        for name in imported:
+            heaviest[name] = max(heaviest.get(name, 0), modules[name][0])
+        if args.budget_ms is not None and \
+                statistics.median(imports) > args.budget_ms:
+            print("  over budget: {:.1f} ms > {:.1f} ms".format(
+                statistics.median(imports), args.budget_ms))
+            failed = True
+        for name in forbidden:
+            if name in imported:
+                print("  {} imports {} at startup".format(scenario, name))
+                failed = True
+    print("")
+    print("heaviest modules (self ms):")
+    for name in sorted(heaviest, key=heaviest.get, reverse=True)[:args.top]:
+        print("  {:<40} {:>6.1f}".format(name, heaviest[name] / 1000.0))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
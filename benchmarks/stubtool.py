@@ -0,0 +1,282 @@
+"""Stub implementations of the Xcode tools bitcode-build-tool drives.
+
+Each stub executable written by ``create_toolchain`` imports this module and
+calls ``main``.  The stubs do just enough work for the orchestrator to run
+its full pipeline (they read their inputs and write plausible outputs), and
+sleep for a configurable time to stand in for the real tool's cost.
+"""
+
+import json
+import os
+import shutil
+import stat
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+import synthetic
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+
+TOOLS = ["clang", "swiftc", "ld", "lipo", "strip", "dsymutil", "segedit",
+         "dwarfdump", "xar", "ditto"]
+
+STUB_TEMPLATE = u"""#!{python} -S
+import sys
+sys.path.insert(0, {bench_dir!r})
+import stubtool
+sys.exit(stubtool.main({tool!r}, {config!r}, sys.argv[1:]))
+"""
+
+# Passes of the timer report printed for -ftime-report and -time-passes,
+# with their share of the invocation's time.
+TIMED_PASSES = [("AArch64 Instruction Selection", 0.4),
+                ("Greedy Register Allocator", 0.3),
+                ("AArch64 Assembly Printer", 0.2),
+                ("Prologue/Epilogue Insertion & Frame Finalization", 0.1)]
+
+# Options that take a value, per tool, so positional arguments can be found.
+VALUE_OPTIONS = {
+    "dsymutil": {"-o", "--symbol-map", "--num-threads", "-j", "--arch"},
+    "strip": {"-s", "-R", "-o"},
+}
+
+
+def create_toolchain(root, sleep=None, output_size=1024, fail_on=()):
+    """Write the stub toolchain under root and return its bin directory
+
+    sleep maps a tool name (or "default") to the seconds each invocation
+    should take.  Any invocation that mentions an argument listed in
+    fail_on exits with an error, to exercise failure paths.
+    """
+    bin_dir = os.path.join(root, "usr", "bin")
+    rt_dir = os.path.join(root, "usr", "lib", "clang", "1.0", "lib",
+                          "darwin")
+    for d in (bin_dir, rt_dir):
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    clang_rt = os.path.join(rt_dir, "libclang_rt.ios.a")
+    synthetic.write_file(clang_rt, b"!<arch>\n")
+    config = json.dumps({"sleep": sleep or {}, "output_size": output_size,
+                         "fail_on": list(fail_on), "clang_rt": clang_rt})
+    for tool in TOOLS:
+        script = STUB_TEMPLATE.format(python=sys.executable,
+                                      bench_dir=BENCH_DIR, tool=tool,
+                                      config=config)
+        path = os.path.join(bin_dir, tool)
+        with open(path, "w") as f:
+            f.write(script)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP |
+                 stat.S_IXOTH)
+    return bin_dir
+
+
+def create_sdk(root):
+    """Write a minimal SDK containing the dylibs synthetic bundles link"""
+    for lib in ("usr/lib/libSystem.B.tbd",
+                "System/Library/Frameworks/Foundation.framework/"
+                "Foundation.tbd"):
+        path = os.path.join(root, lib)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        synthetic.write_file(path, b"--- !tapi-tbd\n")
+    with open(os.path.join(root, "SDKSettings.json"), "w") as f:
+        json.dump({"Version": "14.0"}, f)
+    return root
+
+
+def _value_after(args, flag):
+    try:
+        return args[args.index(flag) + 1]
+    except (ValueError, IndexError):
+        raise SystemExit("missing {}".format(flag))
+
+
+def _positional(tool, args):
+    takes_value = VALUE_OPTIONS.get(tool, set())
+    positional = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in takes_value:
+            skip = True
+        elif not arg.startswith("-"):
+            positional.append(arg)
+    return positional
+
+
+def _read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _compile(args, config):
+    output = _value_after(args, "-o")
+    _read(args[args.index("-o") - 1])
+    synthetic.write_file(output, b"\xcf\xfa\xed\xfe" +
+                         b"\0" * max(0, config["output_size"] - 4))
+    return 0
+
+
+def clang(args, config):
+    if "-###" in args:
+        sys.stderr.write(' "ld" "-o" "a.out" "{}"\n'.format(config["clang_rt"]))
+        return 0
+    return _compile(args, config)
+
+
+def swiftc(args, config):
+    return _compile(args, config)
+
+
+def ld(args, config):
+    if args == ["-v"]:
+        sys.stderr.write("@(#)PROGRAM:ld  PROJECT:ld64-711\n")
+        return 0
+    arch = _value_after(args, "-arch")
+    output = _value_after(args, "-o")
+    with open(_value_after(args, "-filelist")) as f:
+        for line in f:
+            path = line.rstrip("\n")
+            if path and not os.path.isfile(path):
+                sys.stderr.write("ld: file not found: {}\n".format(path))
+                return 1
+            _read(path)
+    filetype = synthetic.MH_OBJECT if "-r" in args else synthetic.MH_EXECUTE
+    synthetic.write_file(output, synthetic.make_thin_macho(
+        arch, filetype=filetype, text_size=config["output_size"]), 0o755)
+    return 0
+
+
+def lipo(args, config):
+    if args[0] == "-info":
+        slices = synthetic.parse_macho(_read(args[1]))
+        if len(slices) == 1 and slices[0]["offset"] == 0:
+            print("Non-fat file: {} is architecture: {}".format(
+                args[1], slices[0]["arch"]))
+        else:
+            print("Architectures in the fat file: {} are: {}".format(
+                args[1], " ".join(x["arch"] for x in slices)))
+        return 0
+    if args[0] == "-create":
+        inputs = args[1:args.index("-output")]
+        thin = []
+        for path in inputs:
+            data = _read(path)
+            thin.append((synthetic.parse_macho(data)[0]["arch"], data))
+        synthetic.write_file(_value_after(args, "-output"),
+                             synthetic.make_fat_macho(thin), 0o755)
+        return 0
+    data = _read(args[0])
+    slices = synthetic.parse_macho(data)
+    if args[1] == "-thin":
+        for s in slices:
+            if s["arch"] == args[2]:
+                synthetic.write_file(_value_after(args, "-output"),
+                                     data[s["offset"]:s["offset"] + s["size"]])
+                return 0
+        sys.stderr.write("lipo: missing arch {}\n".format(args[2]))
+        return 1
+    if args[1] == "-verify_arch":
+        archs = set(x["arch"] for x in slices)
+        return 0 if all(a in archs for a in args[2:]) else 1
+    sys.stderr.write("lipo: unsupported stub invocation\n")
+    return 1
+
+
+def segedit(args, config):
+    slices = synthetic.parse_macho(_read(args[0]))
+    bundle = slices[0]["bundle"]
+    if bundle is None:
+        sys.stderr.write("segedit: section not found\n")
+        return 1
+    synthetic.write_file(args[-1], bundle)
+    return 0
+
+
+def dwarfdump(args, config):
+    path = args[-1]
+    for s in synthetic.parse_macho(_read(path)):
+        print("UUID: {} ({}) {}".format(s["uuid"].upper(), s["arch"], path))
+    return 0
+
+
+def dsymutil(args, config):
+    if "--symbol-map" in args:
+        return 0
+    source = _positional("dsymutil", args)[0]
+    output = _value_after(args, "-o")
+    dwarf_dir = os.path.join(output, "Contents", "Resources", "DWARF")
+    if not os.path.isdir(dwarf_dir):
+        os.makedirs(dwarf_dir)
+    shutil.copyfile(source, os.path.join(dwarf_dir, os.path.basename(source)))
+    with open(os.path.join(output, "Contents", "Info.plist"), "w") as f:
+        f.write("<plist version=\"1.0\"><dict/></plist>\n")
+    return 0
+
+
+def strip(args, config):
+    path = _positional("strip", args)[-1]
+    _read(path)
+    return 0
+
+
+def xar(args, config):
+    archive = _read(_value_after(args, "-f"))
+    toc, heap = synthetic.read_xar(archive)
+    if args[0] == "-d":
+        out = getattr(sys.stdout, "buffer", sys.stdout)
+        out.write(toc)
+        return 0
+    if args[0] == "-x":
+        directory = _value_after(args, "-C")
+        wanted = set(args[args.index("-f") + 2:])
+        for node in ET.fromstring(toc).find("toc").findall("file"):
+            name = node.find("name").text
+            if wanted and name not in wanted:
+                continue
+            data = node.find("data")
+            offset = heap + int(data.find("offset").text)
+            length = int(data.find("length").text)
+            synthetic.write_file(os.path.join(directory, name),
+                                 archive[offset:offset + length])
+        return 0
+    sys.stderr.write("xar: unsupported stub invocation\n")
+    return 1
+
+
+def ditto(args, config):
+    shutil.copyfile(args[0], args[1])
+    return 0
+
+
+def _time_report(args, seconds):
+    """Print an LLVM timer group, as -ftime-report and -time-passes do"""
+    if "-ftime-report" not in args and "-time-passes" not in args:
+        return
+    rule = "===" + "-" * 73 + "===\n"
+    lines = [rule, "{:^79}\n".format("Pass execution timing report"), rule,
+             "  Total Execution Time: {0:.4f} seconds ({0:.4f} wall "
+             "clock)\n\n".format(seconds),
+             "   ---User Time---   --System Time--   --User+System--   "
+             "---Wall Time---  --- Name ---\n"]
+    for name, share in TIMED_PASSES + [("Total", 1.0)]:
+        lines.append("   {0:.4f} ({1:5.1f}%)   0.0000 (  0.0%)   {0:.4f} "
+                     "({1:5.1f}%)   {0:.4f} ({1:5.1f}%)  {2}\n".format(
+                         seconds * share, share * 100, name))
+    sys.stderr.write("".join(lines) + "\n")
+
+
+def main(tool, config, args):
+    config = json.loads(config)
+    for arg in args:
+        if arg in config["fail_on"]:
+            sys.stderr.write("{}: error: injected failure for {}\n".format(
+                tool, arg))
+            return 1
+    delay = config["sleep"].get(tool, config["sleep"].get("default", 0.0))
+    if delay:
+        time.sleep(delay)
+    _time_report(args, delay)
+    return globals()[tool](args, config)
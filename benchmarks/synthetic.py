@@ -0,0 +1,375 @@
+"""Generate synthetic bitcode bundles and Mach-O wrappers.
+
+The files written here are small but structurally valid: xar archives use
+the real header/TOC/heap layout and the Mach-O files carry an __LLVM,__bundle
+section, an LC_UUID and an LC_BUILD_VERSION, so the stub toolchain in
+stubtool.py can answer lipo/segedit/dwarfdump/xar queries on them.
+"""
+
+import hashlib
+import os
+import struct
+import uuid
+import zlib
+from xml.sax.saxutils import escape
+
+
+XAR_HEADER = struct.Struct(">4sHHQQI")
+XAR_CKSUM_SHA1 = 1
+
+CPU_ARCH_ABI64 = 0x01000000
+CPU_ARCH_ABI64_32 = 0x02000000
+CPU_TYPE_X86 = 7
+CPU_TYPE_ARM = 12
+
+ARCHS = {
+    "armv7": (CPU_TYPE_ARM, 9),
+    "armv7s": (CPU_TYPE_ARM, 11),
+    "armv7k": (CPU_TYPE_ARM, 12),
+    "arm64": (CPU_TYPE_ARM | CPU_ARCH_ABI64, 0),
+    "arm64e": (CPU_TYPE_ARM | CPU_ARCH_ABI64, 2),
+    "arm64_32": (CPU_TYPE_ARM | CPU_ARCH_ABI64_32, 1),
+    "x86_64": (CPU_TYPE_X86 | CPU_ARCH_ABI64, 3),
+}
+
+PLATFORMS = {
+    "macOS": 1,
+    "iOS": 2,
+    "tvOS": 3,
+    "watchOS": 4,
+}
+
+TRIPLE_OS = {
+    "macOS": "macosx",
+    "iOS": "ios",
+    "tvOS": "tvos",
+    "watchOS": "watchos",
+}
+
+VERSION_MIN_FLAG = {
+    "macOS": "-macosx_version_min",
+    "iOS": "-ios_version_min",
+    "tvOS": "-tvos_version_min",
+    "watchOS": "-watchos_version_min",
+}
+
+MH_MAGIC = 0xfeedface
+MH_MAGIC_64 = 0xfeedfacf
+FAT_MAGIC = 0xcafebabe
+MH_EXECUTE = 2
+MH_OBJECT = 1
+LC_SEGMENT = 0x1
+LC_SEGMENT_64 = 0x19
+LC_UUID = 0x1b
+LC_BUILD_VERSION = 0x32
+
+# Options the verifiers accept, cycled to build option lists of any length.
+CLANG_EXTRA_OPTIONS = [
+    ["-disable-llvm-passes"],
+    ["-target-abi", "darwinpcs"],
+    ["-mllvm", "-enable-machine-outliner=never"],
+    ["-ffp-contract", "on"],
+    ["-fno-signed-zeros"],
+    ["-mllvm", "-arm64-enable-ccmp=false"],
+    ["-target-sdk-version", "14.0"],
+]
+
+SWIFT_EXTRA_OPTIONS = [
+    ["-module-name", "Synthetic"],
+    ["-disable-llvm-optzns"],
+    ["-Xllvm", "-aarch64-use-tbi"],
+    ["-target-cpu", "generic"],
+]
+
+
+def is_64bit(arch):
+    return ARCHS[arch][0] & (CPU_ARCH_ABI64 | CPU_ARCH_ABI64_32) == \
+        CPU_ARCH_ABI64
+
+
+def triple(arch, platform, version="12.0.0"):
+    return "{}-apple-{}{}".format(arch, TRIPLE_OS[platform], version)
+
+
+def clang_options(arch, platform, count):
+    options = ["-triple", triple(arch, platform), "-emit-obj"]
+    i = 0
+    while len(options) < count:
+        options.extend(CLANG_EXTRA_OPTIONS[i % len(CLANG_EXTRA_OPTIONS)])
+        i += 1
+    return options
+
+
+def swift_options(arch, platform, count):
+    options = ["-emit-object", "-target", triple(arch, platform), "-Onone"]
+    i = 0
+    while len(options) < count:
+        options.extend(SWIFT_EXTRA_OPTIONS[i % len(SWIFT_EXTRA_OPTIONS)])
+        i += 1
+    return options
+
+
+class Member(object):
+
+    """A single file stored in a synthetic bitcode bundle"""
+
+    def __init__(self, name, data, file_type, tool=None, options=None):
+        self.name = name
+        self.data = data
+        self.file_type = file_type
+        self.tool = tool
+        self.options = options or []
+
+
+def _toc_xml(subdoc, members, heap):
+    """Build the TOC and append member payloads to heap (a bytearray)"""
+    out = ['<?xml version="1.0" encoding="UTF-8"?>\n<xar>\n', subdoc,
+           ' <toc>\n',
+           '  <checksum style="sha1"><offset>0</offset><size>20</size>'
+           '</checksum>\n',
+           '  <creation-time>2015-01-01T00:00:00</creation-time>\n']
+    for i, member in enumerate(members, 1):
+        offset = len(heap)
+        heap.extend(member.data)
+        digest = hashlib.sha1(member.data).hexdigest()
+        out.append('  <file id="{}">\n'.format(i))
+        out.append('   <name>{}</name>\n   <type>file</type>\n'.format(
+            escape(member.name)))
+        out.append('   <data><length>{0}</length><offset>{1}</offset>'
+                   '<size>{0}</size>'
+                   '<encoding style="application/octet-stream"/>'
+                   '<extracted-checksum style="sha1">{2}'
+                   '</extracted-checksum>'
+                   '<archived-checksum style="sha1">{2}</archived-checksum>'
+                   '</data>\n'.format(len(member.data), offset, digest))
+        out.append('   <file-type>{}</file-type>\n'.format(member.file_type))
+        if member.tool is not None:
+            out.append('   <{}>'.format(member.tool))
+            out.extend('<cmd>{}</cmd>'.format(escape(x))
+                       for x in member.options)
+            out.append('</{}>\n'.format(member.tool))
+        out.append('  </file>\n')
+    out.append(' </toc>\n</xar>\n')
+    return "".join(out).encode("utf-8")
+
+
+def subdoc_xml(arch, platform, sdk_version, link_options, dylibs,
+               hide_symbols=False):
+    out = [' <subdoc subdoc_name="Ignore">\n',
+           '  <version>1.0</version>\n',
+           '  <architecture>{}</architecture>\n'.format(arch),
+           '  <platform>{}</platform>\n'.format(platform),
+           '  <sdkversion>{}</sdkversion>\n'.format(sdk_version),
+           '  <hide-symbols>{}</hide-symbols>\n'.format(
+               1 if hide_symbols else 0),
+           '  <dylibs>']
+    out.extend('<lib>{}</lib>'.format(escape(x)) for x in dylibs)
+    out.append('</dylibs>\n  <link-options>')
+    out.extend('<option>{}</option>'.format(escape(x)) for x in link_options)
+    out.append('</link-options>\n </subdoc>\n')
+    return "".join(out)
+
+
+def write_xar(subdoc, members):
+    """Return the bytes of a xar archive containing members"""
+    heap = bytearray(20)
+    toc = _toc_xml(subdoc, members, heap)
+    compressed = zlib.compress(toc)
+    heap[0:20] = hashlib.sha1(compressed).digest()
+    header = XAR_HEADER.pack(b"xar!", XAR_HEADER.size, 1, len(compressed),
+                             len(toc), XAR_CKSUM_SHA1)
+    return header + compressed + bytes(heap)
+
+
+def read_xar(data):
+    """Return (toc bytes, heap start) of a xar archive"""
+    magic, size, _, toc_len, _, _ = XAR_HEADER.unpack_from(data, 0)
+    if magic != b"xar!":
+        raise ValueError("not a xar archive")
+    toc = zlib.decompress(data[size:size + toc_len])
+    return toc, size + toc_len
+
+
+def payload(size, seed):
+    """Deterministic, incompressible-enough member payload"""
+    block = hashlib.sha256(seed.encode("utf-8")).digest()
+    return (block * (size // len(block) + 1))[:size]
+
+
+def make_bundle(arch, platform="iOS", members=100, member_size=4096,
+                options=16, swift_ratio=0.0, objects=0, lto=0, nested=0,
+                nested_members=10, sdk_version="14.0.0", executable=True,
+                seed="bundle"):
+    """Return the bytes of a synthetic bitcode bundle for arch"""
+    contents = []
+    swift_count = int(members * swift_ratio)
+    for i in range(members):
+        name = "{:d}".format(len(contents) + 1)
+        data = payload(member_size, "{}-{}-{}".format(seed, arch, i))
+        if i < swift_count:
+            contents.append(Member(name, data, "Bitcode", "swift",
+                                   swift_options(arch, platform, options)))
+        else:
+            contents.append(Member(name, data, "Bitcode", "clang",
+                                   clang_options(arch, platform, options)))
+    for i in range(objects):
+        name = "{:d}".format(len(contents) + 1)
+        contents.append(Member(name, payload(member_size, name), "Object"))
+    for i in range(lto):
+        name = "{:d}".format(len(contents) + 1)
+        contents.append(Member(name, payload(member_size, name), "LTO"))
+    for i in range(nested):
+        name = "{:d}".format(len(contents) + 1)
+        data = make_bundle(arch, platform, nested_members, member_size,
+                           options, swift_ratio, sdk_version=sdk_version,
+                           executable=False,
+                           seed="{}-nested-{}".format(seed, i))
+        contents.append(Member(name, data, "Bundle"))
+
+    if executable:
+        link_options = ["-execute", "-e", "_main", "-dead_strip",
+                        VERSION_MIN_FLAG[platform], "12.0.0",
+                        "-rpath", "@executable_path/Frameworks"]
+        dylibs = ["{SDKPATH}/usr/lib/libSystem.B.dylib",
+                  "{SDKPATH}/System/Library/Frameworks/"
+                  "Foundation.framework/Foundation"]
+    else:
+        link_options = ["-r", VERSION_MIN_FLAG[platform], "12.0.0"]
+        dylibs = []
+    subdoc = subdoc_xml(arch, platform, sdk_version, link_options, dylibs)
+    return write_xar(subdoc, contents)
+
+
+def _pad(name):
+    return name.encode("ascii").ljust(16, b"\0")
+
+
+def make_thin_macho(arch, bundle=None, uuid_bytes=None, platform="iOS",
+                    filetype=MH_EXECUTE, text_size=4096):
+    """Return the bytes of a thin Mach-O with an optional bitcode bundle"""
+    cputype, cpusubtype = ARCHS[arch]
+    wide = is_64bit(arch)
+    if uuid_bytes is None:
+        uuid_bytes = uuid.uuid4().bytes
+    header_size = 32 if wide else 28
+    seg_size = 72 + 80 if wide else 56 + 68
+    cmds_size = 24 + 24 + (seg_size if bundle is not None else 0)
+    data_start = (header_size + cmds_size + 15) & ~15
+    text = b"\0" * text_size
+    commands = [struct.pack("<II16s", LC_UUID, 24, uuid_bytes),
+                struct.pack("<IIIIII", LC_BUILD_VERSION, 24,
+                            PLATFORMS.get(platform, 0), 12 << 16,
+                            14 << 16, 0)]
+    body = text
+    if bundle is not None:
+        offset = data_start + len(text)
+        if wide:
+            commands.append(struct.pack(
+                "<II16sQQQQiiII", LC_SEGMENT_64, seg_size, _pad("__LLVM"),
+                0x100000000, len(bundle), offset, len(bundle), 1, 1, 1, 0))
+            commands.append(struct.pack(
+                "<16s16sQQIIIIIIII", _pad("__bundle"), _pad("__LLVM"),
+                0x100000000, len(bundle), offset, 0, 0, 0, 0, 0, 0, 0))
+        else:
+            commands.append(struct.pack(
+                "<II16sIIIIiiII", LC_SEGMENT, seg_size, _pad("__LLVM"),
+                0x4000, len(bundle), offset, len(bundle), 1, 1, 1, 0))
+            commands.append(struct.pack(
+                "<16s16sIIIIIIIII", _pad("__bundle"), _pad("__LLVM"),
+                0x4000, len(bundle), offset, 0, 0, 0, 0, 0, 0))
+        body = text + bundle
+    load_commands = b"".join(commands)
+    if wide:
+        header = struct.pack("<IiiIIIII", MH_MAGIC_64, cputype, cpusubtype,
+                             filetype, len(commands) - (1 if bundle else 0),
+                             len(load_commands), 0, 0)
+    else:
+        header = struct.pack("<IiiIIII", MH_MAGIC, cputype, cpusubtype,
+                             filetype, len(commands) - (1 if bundle else 0),
+                             len(load_commands), 0)
+    head = header + load_commands
+    return head + b"\0" * (data_start - len(head)) + body
+
+
+def make_fat_macho(slices, align=14):
+    """Return the bytes of a fat file built from (arch, thin bytes) pairs"""
+    alignment = 1 << align
+    offset = alignment
+    entries = []
+    layout = []
+    for arch, data in slices:
+        cputype, cpusubtype = ARCHS[arch]
+        entries.append(struct.pack(">iiIII", cputype, cpusubtype,
+                                   offset, len(data), align))
+        layout.append((offset, data))
+        offset = (offset + len(data) + alignment - 1) & ~(alignment - 1)
+    out = bytearray(layout[-1][0] + len(layout[-1][1]))
+    header = struct.pack(">II", FAT_MAGIC, len(slices)) + b"".join(entries)
+    out[0:len(header)] = header
+    for start, data in layout:
+        out[start:start + len(data)] = data
+    return bytes(out)
+
+
+def parse_macho(data):
+    """Return a list of slice dicts: arch, offset, size, uuid, bundle"""
+    magic, = struct.unpack_from(">I", data, 0)
+    if magic == FAT_MAGIC:
+        count, = struct.unpack_from(">I", data, 4)
+        slices = []
+        for i in range(count):
+            _, _, offset, size, _ = struct.unpack_from(">iiIII", data,
+                                                       8 + 20 * i)
+            info = _parse_thin(data, offset)
+            info["offset"] = offset
+            info["size"] = size
+            slices.append(info)
+        return slices
+    info = _parse_thin(data, 0)
+    info["offset"] = 0
+    info["size"] = len(data)
+    return [info]
+
+
+def arch_name(cputype, cpusubtype):
+    for name, value in ARCHS.items():
+        if value == (cputype, cpusubtype & 0xffffff):
+            return name
+    return "unknown"
+
+
+def _parse_thin(data, base):
+    magic, cputype, cpusubtype, _, ncmds, _ = struct.unpack_from(
+        "<IiiIII", data, base)
+    if magic == MH_MAGIC_64:
+        cursor = base + 32
+    elif magic == MH_MAGIC:
+        cursor = base + 28
+    else:
+        raise ValueError("not a Mach-O file")
+    info = {"arch": arch_name(cputype, cpusubtype), "uuid": None,
+            "bundle": None}
+    for _ in range(ncmds):
+        cmd, cmdsize = struct.unpack_from("<II", data, cursor)
+        if cmd == LC_UUID:
+            info["uuid"] = str(uuid.UUID(bytes=data[cursor + 8:cursor + 24]))
+        elif cmd in (LC_SEGMENT, LC_SEGMENT_64):
+            segname = data[cursor + 8:cursor + 24].rstrip(b"\0")
+            if segname == b"__LLVM":
+                if cmd == LC_SEGMENT_64:
+                    size, offset = struct.unpack_from(
+                        "<QI", data, cursor + 72 + 40)
+                else:
+                    size, offset = struct.unpack_from(
+                        "<II", data, cursor + 56 + 36)
+                start = base + offset
+                info["bundle"] = data[start:start + size]
+        cursor += cmdsize
+    return info
+
+
+def write_file(path, data, mode=0o644):
+    with open(path, "wb") as f:
+        f.write(data)
+    os.chmod(path, mode)
+    return path
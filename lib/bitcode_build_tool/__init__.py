@@ -1,6 +1,29 @@
-from .buildenv import BuildEnvironment, BitcodeBuildFailure
-from .bundle import BitcodeBundle
-from .main import main as bitcode_build_tool_main
+"""Rebuild Mach-O files from the bitcode they carry
 
-__all__ = [BuildEnvironment, BitcodeBundle,
-           bitcode_build_tool_main, BitcodeBuildFailure]
+The names below are imported on first use: running the tool only imports
+what the build at hand needs.
+"""
+from importlib import import_module
+
+_EXPORTS = {
+    "BuildEnvironment": (".buildenv", "BuildEnvironment"),
+    "BitcodeBuildFailure": (".buildenv", "BitcodeBuildFailure"),
+    "BitcodeBundle": (".bundle", "BitcodeBundle"),
+    "bitcode_build_tool_main": (".main", "main"),
+    "BuildConfig": (".api", "BuildConfig"),
+    "BuildResult": (".api", "BuildResult"),
+    "build": (".api", "build"),
+}
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    try:
+        module, attr = _EXPORTS[name]
+    except KeyError:
+        raise AttributeError(u"module {} has no attribute {}".format(
+            __name__, name))
+    value = getattr(import_module(module, __name__), attr)
+    globals()[name] = value
+    return value
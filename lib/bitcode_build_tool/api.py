@@ -0,0 +1,147 @@
+"""Build from Python, several builds at once in one process
+
+    from bitcode_build_tool.api import BuildConfig, build
+
+    config = BuildConfig(sdk_path=sdk, j=8, dsym_output="App.dSYM")
+    result = build("App", config, output="App.rebuilt")
+    if not result.ok:
+        print("\\n".join(result.log))
+
+Every build gets its own BuildEnvironment (tool cache, thread pool, job
+slots, executor, logger and temporary directories), so builds may run
+concurrently from different threads.
+"""
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from .buildenv import BitcodeBuildFailure, BuildEnvironment
+from .main import finish, parse_args, run
+
+
+class BuildConfig(object):
+
+    """Options of a build, named after the command line destinations
+
+    The names are those of the parsed command line (j, sdk_path,
+    tool_path, include, dsym_output, symbol_map, verify, cache_dir, ...)
+    and default to the command line defaults, except output which
+    defaults to a new temporary directory.
+    """
+
+    def __init__(self, **options):
+        defaults = vars(parse_args(["bitcode-build-tool", ""]))
+        del defaults["input_macho_file"]
+        defaults["output"] = None
+        defaults["metrics"] = True
+        unknown = set(options) - set(defaults)
+        if unknown:
+            raise TypeError(u"Unknown build options: {}".format(
+                ", ".join(sorted(unknown))))
+        defaults.update(options)
+        self.__dict__.update(defaults)
+
+    def copy(self, **options):
+        values = dict(vars(self))
+        values.update(options)
+        return BuildConfig(**values)
+
+
+class BuildResult(object):
+
+    """What a build produced
+
+    ok tells whether it succeeded, output and dsym_output are the paths
+    written, log the messages of the build (errors and warnings
+    included) and metrics the wall time plus the per-phase time of the
+    profiler.
+    """
+
+    def __init__(self, ok, output, dsym_output, log, metrics, error=None):
+        self.ok = ok
+        self.output = output
+        self.dsym_output = dsym_output
+        self.log = log
+        self.metrics = metrics
+        self.error = error
+
+    def __repr__(self):
+        return u"BuildResult(ok={}, output={})".format(self.ok, self.output)
+
+
+class _RecordingHandler(logging.Handler):
+
+    """Keep the log messages of a build"""
+    PREFIX = {logging.ERROR: u"error: ",
+              logging.WARNING: u"warning: ",
+              logging.DEBUG: u"Debug: "}
+
+    def __init__(self, level):
+        logging.Handler.__init__(self, level)
+        self.messages = []
+        self.errors = []
+
+    def emit(self, record):
+        message = record.getMessage()
+        self.messages.append(self.PREFIX.get(record.levelno, u"") + message)
+        if record.levelno >= logging.ERROR:
+            self.errors.append(message)
+
+
+def build(input, config=None, **options):
+    """Rebuild input (a path or the bytes of a Mach-O, .ipa) from bitcode
+
+    options override the fields of config.  Build failures are reported
+    in the returned BuildResult rather than raised.
+    """
+    if config is None:
+        config = BuildConfig(**options)
+    elif options:
+        config = config.copy(**options)
+    args = argparse.Namespace(**vars(config))
+    scratch = None
+    try:
+        if isinstance(input, (bytes, bytearray)):
+            scratch = tempfile.mkdtemp(prefix="bitcode-input")
+            args.input_macho_file = os.path.join(scratch, "input")
+            with open(args.input_macho_file, "wb") as f:
+                f.write(input)
+        else:
+            args.input_macho_file = input
+        if args.output is None:
+            # the caller owns this directory
+            args.output = os.path.join(
+                tempfile.mkdtemp(prefix="bitcode-output"),
+                os.path.basename(args.input_macho_file))
+        if args.verbose:
+            level = logging.DEBUG
+        elif args.verify:
+            level = logging.WARNING
+        else:
+            level = logging.INFO
+        handler = _RecordingHandler(level)
+        environment = BuildEnvironment()
+        start = time.time()
+        ok = True
+        with environment.activate():
+            try:
+                environment.initState(args, handler)
+                run(args)
+            except BitcodeBuildFailure:
+                ok = False
+            finally:
+                finish(args)
+        if environment.profiler is not None:
+            metrics = environment.profiler.toJSON()
+        else:
+            metrics = dict()
+        metrics["wall"] = time.time() - start
+    finally:
+        if scratch is not None:
+            shutil.rmtree(scratch, ignore_errors=True)
+    return BuildResult(ok, args.output if ok and not args.verify else None,
+                       args.dsym_output if ok else None, handler.messages,
+                       metrics, handler.errors[0] if handler.errors else None)
@@ -0,0 +1,143 @@
+"""Whole application inputs (.ipa archives and .app directories)"""
+import os
+import shutil
+import stat
+import tempfile
+import zipfile
+
+from .buildenv import env
+from .fat import hasBitcode
+
+# directories whose binary a dSYM is named after
+BUNDLE_EXTENSIONS = (".app", ".appex", ".framework", ".bundle", ".xpc")
+
+
+class AppBundle(object):
+
+    """An .ipa or .app whose bitcode Mach-O files are rebuilt together
+
+    The input is staged into a writable tree (the output directory for an
+    .app, a temporary directory for an .ipa), the rebuilt binaries replace
+    their originals in that tree, and repack() writes the final output.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_archive = not os.path.isdir(path)
+        self.root = None
+        self._extracted = dict()
+        self._symlinks = set()
+
+    @staticmethod
+    def isApp(path):
+        """Whether path is an input for the whole application mode"""
+        return os.path.isdir(path) or zipfile.is_zipfile(path)
+
+    def stage(self, output=None):
+        """Make the tree binaries are read from and installed into
+
+        With output None (verification) nothing is written and an .app is
+        read in place.
+        """
+        if not self.is_archive:
+            if output is None:
+                self.root = self.path
+                return self.root
+            if os.path.exists(output):
+                env.error(u"Output already exists: {}".format(output))
+            try:
+                shutil.copytree(self.path, output, symlinks=True)
+            except (IOError, OSError, shutil.Error):
+                env.error(u"Cannot copy {} to {}".format(self.path, output))
+            self.root = output
+            return self.root
+        self.root = env.createTempDirectory(prefix="app")
+        try:
+            with zipfile.ZipFile(self.path) as archive:
+                for info in archive.infolist():
+                    mode = info.external_attr >> 16
+                    target = archive.extract(info, self.root)
+                    self._extracted[info.filename] = target
+                    if stat.S_ISLNK(mode):
+                        # the link target was extracted as a plain file
+                        self._symlinks.add(target)
+                    elif mode and not info.is_dir():
+                        os.chmod(target, stat.S_IMODE(mode))
+        except (IOError, OSError, zipfile.BadZipfile):
+            env.error(u"Cannot extract {}".format(self.path))
+        return self.root
+
+    def findBinaries(self):
+        """Return the Mach-O files of the staged tree carrying bitcode"""
+        binaries = []
+        for root, dirs, files in os.walk(self.root):
+            dirs.sort()
+            rel_root = os.path.relpath(root, self.root)
+            if "Watch" in rel_root.split(os.sep):
+                # watch apps need the watchOS SDK, build them on their own
+                if any(hasBitcode(os.path.join(root, x)) for x in files):
+                    env.warning(u"Skipping watch app binaries in {}, "
+                                "rebuild them separately".format(rel_root))
+                continue
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                if os.path.islink(path) or path in self._symlinks:
+                    continue
+                if hasBitcode(path):
+                    binaries.append(path)
+        return binaries
+
+    def relativePath(self, path):
+        return os.path.relpath(path, self.root)
+
+    def dsymNames(self, binaries):
+        """Return the dSYM name of each binary
+
+        Like Xcode, a dSYM is named after the bundle enclosing its binary
+        (Foo.app.dSYM, Foo.framework.dSYM) or after a binary outside of one.
+        Binaries whose names would clash are named after their path in the
+        tree instead.
+        """
+        names = dict()
+        for path in binaries:
+            parent = os.path.basename(os.path.dirname(path))
+            if os.path.splitext(parent)[1] in BUNDLE_EXTENSIONS:
+                names[path] = parent + ".dSYM"
+            else:
+                names[path] = os.path.basename(path) + ".dSYM"
+        counts = dict()
+        for name in names.values():
+            counts[name] = counts.get(name, 0) + 1
+        for path, name in names.items():
+            if counts[name] > 1:
+                names[path] = self.relativePath(path).replace(
+                    os.sep, "_") + ".dSYM"
+        return names
+
+    def repack(self, output):
+        """Write the staged tree to output (.ipa only, .app is in place)"""
+        if not self.is_archive:
+            return
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(
+            os.path.abspath(output)), prefix=".ipa")
+        os.close(fd)
+        try:
+            with zipfile.ZipFile(self.path) as source, \
+                    zipfile.ZipFile(temp, "w",
+                                    zipfile.ZIP_DEFLATED) as archive:
+                for info in source.infolist():
+                    path = self._extracted[info.filename]
+                    if info.is_dir() or path in self._symlinks:
+                        archive.writestr(info, source.read(info))
+                        continue
+                    # info has the original size, zipfile only switches to
+                    # ZIP64 by itself for files already near its limit
+                    grown = os.path.getsize(path) > info.file_size
+                    with open(path, "rb") as src, \
+                            archive.open(info, "w",
+                                         force_zip64=grown) as dst:
+                        shutil.copyfileobj(src, dst, 1 << 20)
+            os.rename(temp, output)
+        except (IOError, OSError, zipfile.BadZipfile):
+            os.unlink(temp)
+            env.error(u"Cannot write {}".format(output))
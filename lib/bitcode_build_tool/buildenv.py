@@ -1,12 +1,21 @@
 import os
+import shlex
 import sys
 import subprocess
 import logging
 import tempfile
 import shutil
-import json
-from multiprocessing.pool import ThreadPool
+import threading
+from contextlib import contextmanager
 from .translate import FrameworkUpgrader
+from .profiler import BuildProfiler
+from .executor import createExecutor
+from .scheduler import JobSlots
+from .jobserver import JobServer, JobServerClient
+from .cache import pruneDirectory, BuildCache, RemoteCache
+from .scratch import ScratchSpace, inputDigest, makeDirectory
+from .usage import UsageReport
+from .timereport import TimeReport
 
 
 class BitcodeBuildFailure(Exception):
@@ -15,6 +24,12 @@ class BitcodeBuildFailure(Exception):
     pass
 
 
+class BuildCancelled(BitcodeBuildFailure):
+
+    """The job was stopped because another one failed"""
+    pass
+
+
 class LogFormatter(logging.Formatter):
 
     """Customized logging formatter"""
@@ -50,22 +65,22 @@ class LogDeobfuscator(object):
     """Deobfuscator the error messages"""
     def __init__(self, bcsymbolmap):
         self.input = bcsymbolmap
-        self.bcsymbolmap = bcsymbolmap
 
-    def selectUUID(self, uuid):
-        if os.path.isdir(self.input):
+    def symbolMap(self, uuid):
+        """The symbol map of the binary slice with uuid"""
+        if os.path.isdir(self.input) and uuid is not None:
             # directory
-            self.bcsymbolmap = os.path.join(self.input, uuid + ".bcsymbolmap")
-        else:
-            # file
-            self.bcsymbolmap = self.input
+            return os.path.join(self.input, uuid + ".bcsymbolmap")
+        # file
+        return self.input
 
-    def tryDeobfuscate(self, msg):
+    def tryDeobfuscate(self, msg, uuid):
         if msg.find("__hidden#") == -1:
             return None
-        if not os.path.isfile(self.bcsymbolmap):
+        bcsymbolmap = self.symbolMap(uuid)
+        if not os.path.isfile(bcsymbolmap):
             return None
-        with open(self.bcsymbolmap, 'r') as f:
+        with open(bcsymbolmap, 'r') as f:
             symbol_map = f.readlines()
         seg_log = msg.split("__hidden#")
         new_msg = []
@@ -111,43 +126,106 @@ class BuildEnvironment(object):
 
     SUPPORTED_VERSION = set(["1.0"])
 
+    # first ld64 with -oso_prefix
+    OSO_PREFIX_LINKER = "609"
+
+    # tools probed in the background once the platform is known
+    TOOLCHAIN_TOOLS = ["clang", "swiftc", "ld", "lipo", "segedit",
+                       "dwarfdump", "dsymutil", "strip"]
+
     def __init__(self, args=None):
         if args is None:
             return
         self.initState(args)
 
-    def initState(self, args):
+    def initState(self, args, log_handler=None):
+        """Configure the environment for a build
+
+        The console logger is shared by the command line builds; with
+        log_handler the build logs to a logger of its own instead.
+        """
         # initialize temp directories first because it is needed when error.
         self.save_temp = args.save_temp
         self._temp_directories = []
+        # what main() tears down, None until built: an error may stop the
+        # initialization anywhere
+        self.profiler = None
+        self.usage = None
+        self.time_report = None
+        self.jobserver = None
+        self.executor = None
+        self.thread_pool = None
+        self._probe_pool = None
+        self.remote_cache = None
+        self._input_path = args.input_macho_file
+        self._scratch_root = None
+        self._scratch_root_lock = threading.Lock()
         self._tool_cache = dict()
-        # create console handler and set level to debug
-        self.logger = logging.getLogger("bitcode-build-tool")
-        ch = logging.StreamHandler(sys.stdout)
-        if args.verbose:
-            ch.setLevel(logging.DEBUG)
-        elif args.verify:
-            ch.setLevel(logging.WARNING)
+        self._probes = dict()
+        self._probe_lock = threading.Lock()
+        self._commands = dict()
+        self._commands_lock = threading.Lock()
+        self.profiler = BuildProfiler(args.profile or args.metrics,
+                                      cprofile=args.profile)
+        self.usage = UsageReport() if args.resource_report else None
+        self.time_report = TimeReport() if args.time_report else None
+        # join the jobserver of the build running us, or serve our own -j
+        # slots to the tools when asked to
+        self.jobserver = JobServerClient.fromEnvironment()
+        if self.jobserver is None and args.jobserver:
+            self.jobserver = JobServer(args.j)
+        if self.jobserver is not None:
+            pass_fds = self.jobserver.pass_fds
+            extra_env = self.jobserver.childEnvironment()
         else:
-            ch.setLevel(logging.INFO)
-        # create formatter
-        formatter = LogFormatter()
-        # add formatter to ch
-        ch.setFormatter(formatter)
-        # add ch to logger
-        self.logger.addHandler(ch)
-        self.logger.setLevel(logging.DEBUG)
+            pass_fds, extra_env = (), None
+        # start the executor early, a spawn server should be forked while
+        # the orchestrator is still small
+        self.executor = createExecutor(args.exec_backend, pass_fds,
+                                       extra_env, args.job_timeout,
+                                       self.bindThread)
+        if log_handler is not None:
+            # not registered with logging, so it goes away with the build
+            self.logger = logging.Logger("bitcode-build-tool")
+            self.initLog(args, log_handler)
+        else:
+            self.initConsoleLogger(args)
         # init variables
         self.version = "1.0"
         self.platform = None
         self.tool_path = args.tool_path + [self.TOOL_PATH]
         self.addLibraryList(args.library_list)
-        self.dylib_search_path = args.include
+        self.dylib_search_path = list(args.include)
         self.translate_watchos = args.translate_watchos
-        self.thread_pool = None
+        self.stream_output = args.verbose
         self.verify_mode = args.verify
-        self.thread_pool = ThreadPool(args.j)
+        self.setThreadPool(args.j)
+        self.keep_going = args.keep_going
+        self.speculative_swift = args.speculative_swift
+        self._cancelled = threading.Event()
+        if args.max_scratch is not None:
+            max_scratch = args.max_scratch * 1024 * 1024
+        else:
+            max_scratch = None
+        self.scratch = ScratchSpace(max_scratch, self.save_temp,
+                                    self._cancelled)
+        self.jobs = args.j
+        self.job_slots = JobSlots(args.j, self.jobserver)
+        self.cache_dir = args.cache_dir
+        if args.remote_cache is not None:
+            self.remote_cache = RemoteCache(args.remote_cache,
+                                            args.remote_cache_timeout)
+            if self.cache_dir is None:
+                # the local layer in front of the server lasts this build
+                self.cache_dir = self.createTempDirectory(prefix="cache")
+        if args.cache_size is not None:
+            self.cache_size = args.cache_size * 1024 * 1024
+        else:
+            self.cache_size = None
         self.liblto = args.liblto
+        self.compiler_launcher = shlex.split(args.compiler_launcher or "")
+        self.linker_launcher = shlex.split(args.linker_launcher or "")
+        self._launcher_env = None
         self.compile_with_clang = args.compile_with_clang
         if self.liblto is not None and not os.path.exists(self.liblto):
             env.error("libLTO path does not exists: {}".format(self.liblto))
@@ -159,6 +237,81 @@ class BuildEnvironment(object):
         self.logger.debug("SDK path: {}".format(self.sdk))
         self.logger.debug("SDK version: {}".format(self.sdk_version))
         self.logger.debug("PATH: {}".format(self.tool_path))
+        if self.jobserver is not None:
+            self.logger.debug("Jobserver: {}".format(self.jobserver.makeflags))
+
+    def initConsoleLogger(self, args):
+        # create console handler and set level to debug
+        self.logger = logging.getLogger("bitcode-build-tool")
+        if getattr(self, "_log", None) is not None:
+            # initialized again, replace the handler of the last build
+            self.closeLog()
+        ch = logging.StreamHandler(sys.stdout)
+        if args.verbose:
+            ch.setLevel(logging.DEBUG)
+        elif args.verify:
+            ch.setLevel(logging.WARNING)
+        else:
+            ch.setLevel(logging.INFO)
+        # create formatter
+        formatter = LogFormatter()
+        # add formatter to ch
+        ch.setFormatter(formatter)
+        self.initLog(args, ch)
+
+    def initLog(self, args, handler):
+        """Log to handler, and to the --log-json file, from a background
+        writer"""
+        from .logsink import BufferedLog, JSONLinesFormatter
+        handlers = [handler]
+        if args.log_json is not None:
+            json_handler = logging.FileHandler(args.log_json, mode="w",
+                                               encoding="utf-8")
+            json_handler.setLevel(logging.DEBUG)
+            json_handler.setFormatter(JSONLinesFormatter())
+            handlers.append(json_handler)
+        self._log = BufferedLog(handlers)
+        self.logger.addHandler(self._log.handler)
+        # records nobody writes aren't even created
+        self.logger.setLevel(self._log.level)
+
+    def closeLog(self):
+        """Write the records still queued, stop the writer"""
+        if getattr(self, "_log", None) is None:
+            return
+        self._log.close()
+        self.logger.removeHandler(self._log.handler)
+        self._log = None
+
+    def commandRan(self, name):
+        """Count a tool run of the Cmd class name for the summary"""
+        with self._commands_lock:
+            self._commands[name] = self._commands.get(name, 0) + 1
+
+    def commandSummary(self):
+        """The tool runs of the build, by kind, None if there were none"""
+        with self._commands_lock:
+            counts = sorted(self._commands.items(),
+                            key=lambda x: (-x[1], x[0]))
+        if len(counts) == 0:
+            return None
+        return u"Ran {} commands ({})".format(
+            sum(x[1] for x in counts),
+            u", ".join(u"{} {}".format(n, name) for name, n in counts))
+
+    def bindThread(self):
+        """Make env refer to this environment in the calling thread"""
+        _current.environment = self
+
+    @contextmanager
+    def activate(self):
+        """Make env refer to this environment in the block"""
+        previous = getattr(_current, "environment", None)
+        _current.environment = self
+        try:
+            yield self
+        finally:
+            _current.environment = previous
 
     def error(self, msg, exception=BitcodeBuildFailure("Bitcode Build Failure")):
         self.logger.error(msg)
@@ -174,6 +327,12 @@ class BuildEnvironment(object):
         self.logger.debug(msg)
 
     def getSDK(self):
+        if self.sdk is None and "sdk" in self._probes:
+            sdk = self.waitProbe("sdk", self._probeSDK)
+            if sdk is None:
+                self.error("Could not infer SDK path")
+            self.setSDKPath(sdk)
+            self.debug("SDK PATH: {}".format(self.sdk))
         return self.sdk
 
     def addToolPath(self, paths):
@@ -181,12 +340,14 @@ class BuildEnvironment(object):
 
     def setSDKPath(self, sdk):
         if sdk is None:
+            self.sdk = None
             self.sdk_version = "0.0"
             return
 
         self.sdk = sdk
         sdk_setting_path = os.path.join(self.sdk, "SDKSettings.json")
         if os.path.isfile(sdk_setting_path):
+            import json
             with open(sdk_setting_path, 'r') as f:
                 try:
                     settings = json.load(f)
@@ -196,26 +357,184 @@ class BuildEnvironment(object):
         else:
             self.sdk_version = "0.0"
 
+    def setThreadPool(self, number):
+        # imported here, multiprocessing is slow to import and only builds
+        # need it
+        from multiprocessing.pool import ThreadPool
+        self.thread_pool = ThreadPool(number, initializer=self.bindThread)
+
     def setParallelJobs(self, number):
-        self.thread_pool = ThreadPool(number)
+        self.setThreadPool(number)
+        self.jobs = number
+        self.job_slots = JobSlots(number, self.jobserver)
+
+    @property
+    def engine(self):
+        """The AsyncEngine of the asyncio backend, None for the others"""
+        return self.executor.engine
 
     @property
     def map(self):
         if self.thread_pool is None:
             return map
-        else:
+        elif self.keep_going:
             return self.thread_pool.map
+        else:
+            return self.mapFailFast
+
+    def mapFailFast(self, func, iterable):
+        """thread_pool.map that cancels the build on the first failure
 
-    def createTempDirectory(self, prefix="temp"):
-        tempDir = tempfile.mkdtemp(prefix=prefix)
+        The failure is raised as soon as it happens instead of after every
+        other job has run; the jobs still queued are skipped.
+        """
+        def call(item):
+            index, value = item
+            self.checkCancelled()
+            try:
+                return index, func(value)
+            except Exception as e:
+                self.jobFailed(e)
+                raise
+        items = list(iterable)
+        results = [None] * len(items)
+        for index, result in self.thread_pool.imap_unordered(
+                call, enumerate(items)):
+            results[index] = result
+        return results
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """Start no more tools and kill the running ones"""
+        if not self._cancelled.is_set():
+            self._cancelled.set()
+            self.debug("Cancelling the outstanding jobs")
+            self.executor.cancel()
+
+    def checkCancelled(self):
+        if self._cancelled.is_set():
+            raise BuildCancelled("Build cancelled")
+
+    def jobFailed(self, exception):
+        """Fail fast on a job failure, unless --keep-going"""
+        if not self.keep_going:
+            self.cancel()
+
+    def createTempDirectory(self, prefix="temp", parent=None, replace=False):
+        """Create a directory named prefix in parent, the scratch root
+        by default
+
+        A directory left at that name is deleted with replace, given
+        another name (prefix-1, ...) otherwise.
+        """
+        if parent is None:
+            parent = self.scratchRoot()
+        if replace:
+            tempDir = os.path.join(parent, prefix)
+            shutil.rmtree(tempDir, ignore_errors=True)
+            os.mkdir(tempDir, 0o700)
+        else:
+            tempDir = makeDirectory(parent, prefix)
         self._temp_directories.append(tempDir)
         return tempDir
 
+    def scratchRoot(self):
+        """The directory of the intermediate files, named after the input
+
+        The paths of the intermediates are the same from one build of an
+        input to the next, and the root is remapped out of the outputs
+        (see osoPrefix), so identical inputs build identical outputs.
+        """
+        with self._scratch_root_lock:
+            if self._scratch_root is None:
+                name = u"bitcode-build-{}".format(
+                    inputDigest(self._input_path)[:16])
+                self._scratch_root = makeDirectory(tempfile.gettempdir(),
+                                                   name)
+                self._temp_directories.append(self._scratch_root)
+                for report in (self.usage, self.time_report):
+                    if report is not None:
+                        report.root = self._scratch_root
+            return self._scratch_root
+
+    def launcherEnvironment(self):
+        """Environment of the compile commands behind --compiler-launcher
+
+        The launcher is given the cc1 and frontend command lines as they
+        are, and needs PATH, HOME and its own settings.  None without a
+        launcher.
+        """
+        if not self.compiler_launcher:
+            return None
+        if self._launcher_env is None:
+            self._launcher_env = dict(os.environ)
+        return self._launcher_env
+
+    def osoPrefix(self):
+        """The scratch root, as stripped by ld from the debug map paths
+
+        None if the linker is too old for -oso_prefix.
+        """
+        if not self.satisfiesLinkerVersion(self.OSO_PREFIX_LINKER):
+            return None
+        return self.scratchRoot() + os.sep
+
+    def getCacheDirectory(self, name):
+        """Return the named cache directory, None if caching is off"""
+        if self.cache_dir is None:
+            return None
+        path = os.path.join(os.path.realpath(self.cache_dir), name)
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                self.error(u"Cannot create cache directory: {}".format(path))
+        return path
+
+    def getCache(self, name):
+        """Return the named BuildCache, None if caching is off"""
+        path = self.getCacheDirectory(name)
+        if path is None:
+            return None
+        return BuildCache(path, name, self.remote_cache)
+
+    def pruneCache(self, name):
+        """Keep the named cache directory under --cache-size"""
+        path = self.getCacheDirectory(name)
+        if path is None or self.cache_size is None:
+            return
+        removed = pruneDirectory(path, self.cache_size)
+        if removed > 0:
+            self.debug(u"Pruned {} bytes from {}".format(removed, path))
+
+    def closeCaches(self):
+        """Finish the uploads to the remote cache"""
+        if self.remote_cache is not None:
+            self.remote_cache.close()
+
     def cleanupTempDirectories(self):
         if not self.save_temp:
             for d in self._temp_directories:
                 shutil.rmtree(d, ignore_errors=True)
 
+    def shutdownExecutor(self):
+        if self._probe_pool is not None:
+            self._probe_pool.shutdown()
+            self._probe_pool = None
+        if self.thread_pool is not None:
+            self.thread_pool.close()
+            self.thread_pool.join()
+            self.thread_pool = None
+        if self.executor is not None:
+            self.executor.close()
+            self.executor = None
+        if self.jobserver is not None:
+            self.jobserver.close()
+            self.jobserver = None
+
     def setPlatform(self, platform):
         self.debug("Setting platform to: {}".format(platform))
         if platform == "Unknown" or platform is None:
@@ -231,16 +550,66 @@ class BuildEnvironment(object):
                         self.platform,
                         platform))
             self._tool_cache = dict()
+            with self._probe_lock:
+                self._probes = dict()
         self.platform = platform
         self.XCRUN = ["/usr/bin/xcrun", "--sdk", self.getPlatform()]
         if self.sdk is None:
-            cmd = self.XCRUN + ["--show-sdk-path"]
-            try:
-                sdk = subprocess.check_output(cmd, env=self.XCRUN_ENV).decode('utf-8')
-            except subprocess.CalledProcessError:
-                env.error("Could not infer SDK path")
-            self.setSDKPath(sdk.split()[0])
-            self.debug("SDK PATH: {}".format(self.sdk))
+            # getSDK() waits for it
+            self.startProbe("sdk", self._probeSDK)
+
+    def warmUpToolchain(self, arch):
+        """Start every toolchain probe of the build at once
+
+        The probes run in the background while the bundle is extracted and
+        the jobs are constructed; getTool(), getSDK(), getlibclang_rt() and
+        satisfiesLinkerVersion() wait for their result instead of running
+        them one after the other on the critical path.
+        """
+        for name in self.TOOLCHAIN_TOOLS:
+            self.startProbe(name, self._findTool, name)
+        self.startProbe("libclang_rt", self._probeClangRT, arch)
+        self.startProbe("ld_version", self._probeLinkerVersion)
+
+    def startProbe(self, key, func, *args):
+        """Run func(*args) in the background, unless key is known already"""
+        with self._probe_lock:
+            if key in self._tool_cache or key in self._probes:
+                return
+            if self._probe_pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self._probe_pool = ThreadPoolExecutor(
+                    len(self.TOOLCHAIN_TOOLS),
+                    thread_name_prefix="toolchain-probe",
+                    initializer=self.bindThread)
+            self._probes[key] = self._probe_pool.submit(func, *args)
+
+    def waitProbe(self, key, func, *args):
+        """Return the result of the probe of key, run func if none started"""
+        with self.profiler.phase("toolchain probe"):
+            return self._probeResult(key, func, *args)
+
+    def _probeResult(self, key, func, *args):
+        # waitProbe() for the probes, which have no phase of their own
+        future = self._probes.get(key)
+        if future is None:
+            return func(*args)
+        return future.result()
+
+    def _checkOutput(self, cmd, **kwargs):
+        """Output of a probe command, None if it failed"""
+        try:
+            with self.profiler.subprocess("toolchain probe"):
+                return subprocess.check_output(cmd, **kwargs).decode('utf-8')
+        except (subprocess.CalledProcessError, OSError):
+            return None
+
+    def _probeSDK(self):
+        out = self._checkOutput(self.XCRUN + ["--show-sdk-path"],
+                                env=self.XCRUN_ENV)
+        if out is None:
+            return None
+        return out.split()[0]
 
     def getPlatform(self):
         if self.platform is not None:
@@ -260,30 +629,30 @@ class BuildEnvironment(object):
         try:
             tool = self._tool_cache[name]
         except KeyError:
-            for path in self.tool_path:
-                tool = os.path.join(path, name)
-                if os.path.isfile(tool):
-                    self.debug("Using: {}".format(tool))
-                    self._tool_cache[name] = tool
-                    return tool
-                else:
-                    continue
-            # fall back plan, always uses default toolchain
-            self.debug("Inferring {} from xcrun".format(name))
-            cmd = self.XCRUN + ["-f", name]
-            try:
-                out = subprocess.check_output(cmd, env=self.XCRUN_ENV).decode('utf-8')
-            except subprocess.CalledProcessError:
-                pass
-            else:
-                tool = out.split()[0]
-                self.debug("Using: {}".format(tool))
-                self._tool_cache[name] = tool
-                return tool
-            self.error("Cannot find {} in PATH".format(name))
+            tool = self.waitProbe(name, self._findTool, name)
+            if tool is None:
+                self.error("Cannot find {} in PATH".format(name))
+            self._tool_cache[name] = tool
+            return tool
         else:
             return tool
 
+    def _findTool(self, name):
+        """Search the tool path then xcrun for name, None if not found"""
+        for path in self.tool_path:
+            tool = os.path.join(path, name)
+            if os.path.isfile(tool):
+                self.debug("Using: {}".format(tool))
+                return tool
+        # fall back plan, always uses default toolchain
+        self.debug("Inferring {} from xcrun".format(name))
+        out = self._checkOutput(self.XCRUN + ["-f", name], env=self.XCRUN_ENV)
+        if out is None:
+            return None
+        tool = out.split()[0]
+        self.debug("Using: {}".format(tool))
+        return tool
+
     def addDylibSearchPath(self, path):
         self.dylib_search_path.append(os.path.realpath(path))
 
@@ -337,7 +706,7 @@ class BuildEnvironment(object):
             # Check if framework upgrading is needed
             lib = FrameworkUpgrader.translate(lib[9:])
             # this is mapped to one of the real sdk
-            lib_path = self.sdk + lib
+            lib_path = self.getSDK() + lib
             found = self.findLibraryInDir(os.path.dirname(lib_path),
                                           os.path.basename(lib_path))
             if found:
@@ -357,7 +726,7 @@ class BuildEnvironment(object):
                 self.debug("Found framework/dylib: {}".format(found))
                 return found
             # try SDK
-            found = self.findLibraryInDir(os.path.join(self.sdk, "usr", "lib", "swift"), libname)
+            found = self.findLibraryInDir(os.path.join(self.getSDK(), "usr", "lib", "swift"), libname)
             if found:
                 self.debug("Found framework/dylib: {}".format(found))
                 return found
@@ -374,8 +743,8 @@ class BuildEnvironment(object):
                                                  "usr", "lib", "swift",
                                                  self.getPlatform()))
         # search the SDK as well
-        sdk_search_path = [os.path.join(env.getSDK(), "usr", "lib")]
-        sdk_search_path.append(os.path.join(env.getSDK(), "System",
+        sdk_search_path = [os.path.join(self.getSDK(), "usr", "lib")]
+        sdk_search_path.append(os.path.join(self.getSDK(), "System",
                                             "Library", "Frameworks"))
         dylib_search_path = (self.dylib_search_path + toolchain_dylib_path +
                              sdk_search_path)
@@ -414,17 +783,29 @@ class BuildEnvironment(object):
         try:
             tool = self._tool_cache["libclang_rt"]
         except KeyError:
-            clang = self.getTool("clang")
-            out = subprocess.check_output(
-                [clang, "-arch", arch, "/dev/null",
-                    "-isysroot", self.getSDK(), "-###"],
-                stderr=subprocess.STDOUT).decode('utf-8')
-            clang_rt = out.split('\"')[-2]
+            clang_rt = self.waitProbe("libclang_rt", self._probeClangRT, arch)
+            if clang_rt is None:
+                self.error("Cannot find libclang_rt with {}".format(
+                    self.getTool("clang")))
             self._tool_cache["libclang_rt"] = clang_rt
             return clang_rt
         else:
             return tool
 
+    def _probeClangRT(self, arch):
+        clang = self._probeResult("clang", self._findTool, "clang")
+        sdk = self.sdk
+        if sdk is None:
+            sdk = self._probeResult("sdk", self._probeSDK)
+        if clang is None or sdk is None:
+            return None
+        out = self._checkOutput([clang, "-arch", arch, "/dev/null",
+                                 "-isysroot", sdk, "-###"],
+                                stderr=subprocess.STDOUT)
+        if out is None:
+            return None
+        return out.split('\"')[-2]
+
     def getlibSwiftPath(self, arch):
         try:
             # try to look for libswiftCore.dylib
@@ -451,18 +832,53 @@ class BuildEnvironment(object):
         try:
             ld_version = self._tool_cache["ld_version"]
         except KeyError:
-            linker_vers = subprocess.check_output([self.getTool('ld'), '-v'],
-                                                  stderr=subprocess.STDOUT).decode('utf-8')
-            ld_version = linker_vers.split('\n')[0].split('-')[-1]
+            ld_version = self.waitProbe("ld_version", self._probeLinkerVersion)
+            if ld_version is None:
+                self.error("Cannot get the version of {}".format(
+                    self.getTool("ld")))
             self._tool_cache["ld_version"] = ld_version
-        finally:
-            return BuildEnvironment.satisfiesVersion(version, ld_version)
+        return BuildEnvironment.satisfiesVersion(version, ld_version)
+
+    def _probeLinkerVersion(self):
+        linker = self._probeResult("ld", self._findTool, "ld")
+        if linker is None:
+            return None
+        linker_vers = self._checkOutput([linker, '-v'],
+                                        stderr=subprocess.STDOUT)
+        if linker_vers is None:
+            return None
+        return linker_vers.split('\n')[0].split('-')[-1]
 
     def satisfiesSDKVersion(self, version):
+        self.getSDK()
         return BuildEnvironment.satisfiesVersion(version, self.sdk_version)
 
-    def setUUID(self, uuid):
-        if self.deobfuscator is not None:
-            self.deobfuscator.selectUUID(uuid)
+class EnvironmentProxy(object):
+
+    """The BuildEnvironment of the build running in the current thread
+
+    Command line builds use a single default environment.  Builds started
+    through the api module activate their own, and their worker threads
+    are bound to it, so several builds can run in one process.
+    """
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        return getattr(currentEnvironment(), name)
+
+    def __setattr__(self, name, value):
+        setattr(currentEnvironment(), name, value)
+
+
+_current = threading.local()
+_default_environment = BuildEnvironment()
+
+
+def currentEnvironment():
+    environment = getattr(_current, "environment", None)
+    if environment is None:
+        return _default_environment
+    return environment
+
 
-env = BuildEnvironment()
+env = EnvironmentProxy()
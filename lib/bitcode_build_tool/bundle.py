@@ -1,13 +1,56 @@
+import functools
 import os
 import subprocess
 import shutil
+import threading
+import time
 import xml.etree.ElementTree as ET
 
-from .buildenv import env, BitcodeBuildFailure, BuildEnvironment
+from .buildenv import env, BitcodeBuildFailure, BuildCancelled, \
+    BuildEnvironment
 from .cmdtool import Clang, Swift, Ld, CopyFile, RewriteArch
 from .verifier import clang_option_verifier, ld_option_verifier, \
     swift_option_verifier
 from .translate import SwiftArgTranslator, ClangCC1Translator
+from .toc import XarTOC
+from .scratch import diskSize
+
+
+@functools.lru_cache(maxsize=4096)
+def translateOptions(tool, options, arch, mode):
+    """Translate and verify the options tuple of a bitcode member
+
+    Return (arguments tuple, verification error or None).  The members of
+    a bundle share a handful of command lines, so the translation runs once
+    per distinct options, arch and BitcodeBundle.option_mode, and the jobs
+    share the arguments.
+    """
+    watchos, translate_watchos, swift_to_clang, optimize, async_patch = mode
+    options = list(options)
+    if tool == "clang":
+        options = ClangCC1Translator.upgrade(options, arch)
+        if translate_watchos:
+            options = ClangCC1Translator.translate_triple(options)
+        error = clang_option_verifier.check(options)
+        if watchos:
+            options.append("-fno-gnu-inline-asm")
+        return tuple(options), error
+    error = swift_option_verifier.check(options)
+    if swift_to_clang:
+        options = SwiftArgTranslator.upgrade(options, arch)
+        options = SwiftArgTranslator.translate_to_clang(options)
+        if optimize:
+            options = ClangCC1Translator.add_optimization(options)
+        if translate_watchos:
+            options = ClangCC1Translator.translate_triple(options)
+    else:
+        if optimize:
+            options = SwiftArgTranslator.add_optimization(options)
+        if translate_watchos:
+            options = SwiftArgTranslator.translate_triple(options)
+        if async_patch:
+            options.append("-swift-async-frame-pointer=never")
+    return tuple(options), error
 
 
 class xar(object):
@@ -15,56 +58,94 @@ class xar(object):
     """xar class"""
     XAR_EXEC = "/usr/bin/xar"
 
-    def __init__(self, xar_path):
+    def __init__(self, xar_path, suffix=".d", replace=False):
+        with env.profiler.phase("xar extraction"):
+            self.extract(xar_path, suffix, replace)
+
+    def extract(self, xar_path, suffix=".d", replace=False):
         if os.path.isfile(xar_path):
             self.input = xar_path
         else:
             env.error(u"Input XAR doesn't exist: {}".format(xar_path))
 
-        cmd = [self.XAR_EXEC, "-d", "-", "-f", self.input]
-        try:
-            out = subprocess.check_output(cmd)
-        except subprocess.CalledProcessError:
-            env.error(u"toc cannot be extracted: {}".format(xar_path))
-        else:
-            self.xml = ET.fromstring(out)
-        self.dir = env.createTempDirectory()
+        self.toc = self.readTOC()
+        # next to the xar (in the bundle of a nested one)
+        self.dir = env.createTempDirectory(
+            prefix=os.path.basename(self.input) + suffix,
+            parent=os.path.dirname(os.path.abspath(self.input)),
+            replace=replace)
         cmd = [self.XAR_EXEC, "-x", "-C", self.dir, "-f", self.input]
-        try:
-            out = subprocess.check_output(cmd)
-        except subprocess.CalledProcessError:
+        members = self.toc.members
+        if env.verify_mode:
+            # verification only needs the TOC, except for nested bundles
+            # which are verified from their own TOC
+            members = self.toc.files("Bundle")
+            if len(members) == 0:
+                return
+            cmd.extend(x.name for x in members)
+        with env.profiler.phase("scratch space"):
+            env.scratch.reserve(sum(x.size for x in members))
+        with env.profiler.subprocess("xar extraction"):
+            launched = time.time()
+            returncode, _, usage = env.executor.run(cmd)
+        if env.usage is not None:
+            env.usage.record("xar", "xar extraction", self.input,
+                             time.time() - launched, usage, self.input)
+        # deleted member by member as they are compiled, then once linked
+        env.scratch.track(self.dir)
+        if returncode != 0:
             env.error(u"XAR cannot be extracted: {}".format(xar_path))
         cmd = ['/bin/chmod', "-R", "+r", self.dir]
-        try:
-            out = subprocess.check_output(cmd)
-        except subprocess.CalledProcessError:
+        with env.profiler.subprocess("xar extraction"):
+            returncode, _, _ = env.executor.run(cmd)
+        if returncode != 0:
             env.error(u"Permission fixup failed: {}".format(xar_path))
 
-    @property
-    def subdoc(self):
-        return self.xml.find("subdoc")
+    def readTOC(self):
+        """Stream the TOC out of xar and index it in a single pass"""
+        cmd = [self.XAR_EXEC, "-d", "-", "-f", self.input]
+        with env.profiler.subprocess("xar extraction"):
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            try:
+                toc = XarTOC.parse(proc.stdout)
+            except ET.ParseError:
+                toc = None
+            finally:
+                proc.stdout.close()
+                returncode = proc.wait()
+        if returncode != 0 or toc is None:
+            env.error(u"toc cannot be extracted: {}".format(self.input))
+        return toc
 
     @property
-    def toc(self):
-        return self.xml.find("toc")
+    def subdoc(self):
+        return self.toc.subdoc
 
 
 class BitcodeBundle(xar):
 
     """BitcodeBundle class"""
 
-    def __init__(self, arch, input_xar, output_path):
+    def __init__(self, arch, input_xar, output_path, uuid=None,
+                 optimized=False):
         self.output = os.path.realpath(output_path)
         self.returncode = 0
         self.stdout = ""
         self.arch = arch
+        # the UUID of the slice the bundle comes from, names its symbol map
+        self.uuid = uuid
         self.input = input_xar
         self.is_executable = False
         self.contain_swift = False
         self.deployment_target = None
-        self.force_optimize_swift = False
+        self.force_optimize_swift = optimized
         self.is_compile_with_clang = env.compile_with_clang
-        super(BitcodeBundle, self).__init__(input_xar)
+        # the SpeculativeBuild this bundle is (part of), if any
+        self.speculation = None
+        # a failed speculative rebuild may have left (--save-temps) the
+        # directory of the optimized one, which always uses that name
+        super(BitcodeBundle, self).__init__(
+            input_xar, ".opt.d" if optimized else ".d", replace=optimized)
         try:
             self.platform = self.subdoc.find("platform").text
             self.sdk_version = self.subdoc.find("sdkversion").text
@@ -76,6 +157,7 @@ class BitcodeBundle(xar):
             env.setPlatform(self.platform)
         if env.translate_watchos and env.getPlatform() == "watchos" and arch == "armv7k":
             self.arch = "arm64_32"
+        env.warmUpToolchain(self.arch)
         self._linker_options = [x.text if x.text is not None else "" for x in
                                 self.subdoc.find("link-options").findall("option")]
         is_swift_concurrency = any(flag == "-install_name" and opt == "@rpath/libswift_Concurrency.dylib"
@@ -105,11 +187,10 @@ class BitcodeBundle(xar):
     def linkOptions(self):
         """Return all the link options"""
         linker_options = self._linker_options
-        if not ld_option_verifier.verify(linker_options):
+        error = ld_option_verifier.check(linker_options)
+        if error is not None:
             env.error(u"Linker option verification "
-                      "failed for bundle {} ({})".format(
-                          self.input,
-                          ld_option_verifier.error_msg))
+                      "failed for bundle {} ({})".format(self.input, error))
         if linker_options.count("-execute") != 0:
             self.is_executable = True
 
@@ -190,111 +271,199 @@ class BitcodeBundle(xar):
     def run_job(self, job):
         """Run sub command and catch errors"""
         try:
+            self.adopt(job)
             rv = job.run()
+        except BuildCancelled:
+            raise
         except BitcodeBuildFailure:
             # Catch and log an error
-            env.error(u"Failed to compile bundle: {}".format(self.input))
+            self.fail(u"Failed to compile bundle: {}".format(self.input))
+        else:
+            self.consumed(job, rv)
+            return rv
+
+    async def run_job_async(self, job):
+        """run_job() as a coroutine of the asyncio engine"""
+        try:
+            self.adopt(job)
+            rv = await job.run_async()
+        except BuildCancelled:
+            raise
+        except BitcodeBuildFailure:
+            self.fail(u"Failed to compile bundle: {}".format(self.input))
         else:
+            self.consumed(job, rv)
             return rv
 
+    def adopt(self, job):
+        """Make job part of this bundle, and of its speculation unless that
+        is abandoned already"""
+        job.bundle = self.input
+        if env.time_report is not None and isinstance(job, BitcodeBundle):
+            env.time_report.nest(job.input, self.input)
+        if self.speculation is None:
+            return
+        if self.speculation.abandoned.is_set():
+            raise BitcodeBuildFailure("Speculative build abandoned")
+        job.speculation = self.speculation
+
+    def fail(self, msg):
+        """env.error(), only logged in debug by a speculative build"""
+        if self.speculation is None:
+            env.error(msg)
+        env.debug(msg)
+        raise BitcodeBuildFailure(msg)
+
+    def consumed(self, job, rv):
+        """Delete the member a finished job compiled, account its output"""
+        member = getattr(job, "input", None)
+        if member is None:
+            # the link, the bundle is released by whoever built it
+            return
+        if isinstance(rv, BitcodeBundle):
+            env.scratch.release(rv.dir)
+        env.scratch.remove(os.path.join(self.dir, member), self.dir)
+        env.scratch.grow(self.dir,
+                         diskSize(os.path.join(self.dir, job.output)))
+
+    def runJobs(self, jobs):
+        """Run the commands of a fan-out, on the asyncio engine if any"""
+        if self.speculation is not None:
+            # a failure ends the speculation, not the build
+            if env.engine is None:
+                return env.thread_pool.map(self.run_job, jobs)
+            return env.engine.map(self.run_job_async, jobs)
+        if env.engine is None:
+            return env.map(self.run_job, jobs)
+        return env.engine.map(self.run_job_async, jobs,
+                              fail_fast=not env.keep_going,
+                              on_failure=env.jobFailed)
+
+    @property
+    def option_mode(self):
+        """What the translation of the member options depends on"""
+        return (env.getPlatform() == "watchos", self.is_translate_watchos,
+                self.is_compile_with_clang, self.force_optimize_swift,
+                self.need_swift_async_patch)
+
+    def translateOptions(self, member):
+        """The shared arguments of a bitcode member, error if illegal"""
+        args, error = translateOptions(member.tool, member.options,
+                                       self.arch, self.option_mode)
+        if error is not None:
+            self.fail(u"{} option verification failed for bitcode {} "
+                      "({})".format(member.tool.capitalize(), member.name,
+                                    error))
+        return args
+
     def getFileNode(self, file_type):
-        """Return all the XML node of file type"""
-        return list(filter(lambda x: x.find("file-type").text == file_type,
-                      self.toc.findall("file")))
+        """Return all the TOC members of file type"""
+        return self.toc.files(file_type)
 
-    def constructBitcodeJob(self, xml_node):
+    def constructBitcodeJob(self, member):
         """construct a single bitcode workload"""
-        name = xml_node.find("name").text
+        name = member.name
         output_name = name + ".o"
-        if xml_node.find("clang") is not None:
+        if member.tool == "clang":
             clang = Clang(name, output_name, self.dir)
-            options = [x.text if x.text is not None else ""
-                       for x in xml_node.find("clang").findall("cmd")]
-            options = ClangCC1Translator.upgrade(options, self.arch)
-            if self.is_translate_watchos:
-                options = ClangCC1Translator.translate_triple(options)
-            if clang_option_verifier.verify(options):
-                clang.addArgs(options)
-            else:
-                env.error(u"Clang option verification "
-                          "failed for bitcode {} ({})".format(
-                              name, clang_option_verifier.error_msg))
-            if env.getPlatform() == "watchos":
-                clang.addArgs(["-fno-gnu-inline-asm"])
+            clang.addArgs(self.translateOptions(member))
             return clang
-        elif xml_node.find("swift") is not None:
+        elif member.tool == "swift":
             # swift uses extension to distinguish input type
             # we need to move the file to have .bc extension first
             self.contain_swift = True
             if self.is_compile_with_clang:
                 clang = Clang(name, output_name, self.dir)
-                options = [x.text if x.text is not None else ""
-                           for x in xml_node.find("swift").findall("cmd")]
-                if swift_option_verifier.verify(options):
-                    options = SwiftArgTranslator.upgrade(options, self.arch)
-                    options = SwiftArgTranslator.translate_to_clang(options)
-                    if self.force_optimize_swift:
-                        options = ClangCC1Translator.add_optimization(options)
-                    if self.is_translate_watchos:
-                        options = ClangCC1Translator.translate_triple(options)
-                    clang.addArgs(options)
-                else:
-                    env.error(u"Swift option verification "
-                              "failed for bitcode {} ({})".format(
-                                  name, clang_option_verifier.error_msg))
+                clang.addArgs(self.translateOptions(member))
                 return clang
             else:
                 bcname = name + ".bc"
-                shutil.move(os.path.join(self.dir, name),
-                            os.path.join(self.dir, bcname))
+                if not env.verify_mode:
+                    shutil.move(os.path.join(self.dir, name),
+                                os.path.join(self.dir, bcname))
                 swift = Swift(bcname, output_name, self.dir)
-                options = [x.text if x.text is not None else ""
-                           for x in xml_node.find("swift").findall("cmd")]
-                if swift_option_verifier.verify(options):
-                    if self.force_optimize_swift:
-                        options = SwiftArgTranslator.add_optimization(options)
-                    if self.is_translate_watchos:
-                        options = SwiftArgTranslator.translate_triple(options)
-                    swift.addArgs(options)
-                    if self.need_swift_async_patch:
-                        swift.addArgs(["-swift-async-frame-pointer=never"])
-                else:
-                    env.error(u"Swift option verification "
-                              "failed for bitcode {} ({})".format(
-                                  name, swift_option_verifier.error_msg))
+                swift.addArgs(self.translateOptions(member))
                 return swift
         else:
             env.error("Cannot figure out bitcode kind: {}".format(name))
 
-    def constructBundleJob(self, xml_node):
+    def optimizedRebuild(self):
+        """The bundle again with swift optimization, for a failing link
+
+        Extracted to <xar>.opt.d and linked to <output>.optimized whether
+        it is built speculatively or not, so both give the same output.
+        """
+        rebuild = BitcodeBundle(self.arch, self.input,
+                                self.output + ".optimized", self.uuid,
+                                optimized=True)
+        rebuild.is_compile_with_clang = self.is_translate_watchos
+        rebuild.speculation = self.speculation
+        return rebuild
+
+    def installAt(self, output):
+        """Move the linked output to output, return self"""
+        shutil.move(self.output, output)
+        self.output = output
+        return self
+
+    def constructBundleJob(self, member):
         """construct a single XAR bundle workload"""
-        name = os.path.join(self.dir, xml_node.find("name").text)
+        name = os.path.join(self.dir, member.name)
         output_name = name + ".o"
-        xar_job = BitcodeBundle(self.arch, name, output_name)
+        xar_job = BitcodeBundle(self.arch, name, output_name, self.uuid)
+        xar_job.speculation = self.speculation
         return xar_job
 
-    def constructObjectJob(self, xml_node):
+    def constructObjectJob(self, member):
         """construct the job to build object which is just a copy"""
-        name = os.path.join(self.dir, xml_node.find("name").text)
+        name = os.path.join(self.dir, member.name)
         output_name = name + ".o"
         object_job = CopyFile(name, output_name, self.dir)
+        object_job.input = name
         object_job.output = output_name
         return object_job
 
     def rewriteLTOInputFiles(self, input_files):
-        new_file_list = []
-        for f in input_files:
-            out_f = self.output + f + ".rewrite.o"
-            RewriteArch(f, out_f, self.deployment_target, self.dir).run()
-            new_file_list.append(out_f)
-        return new_file_list
+        rewrite_jobs = [RewriteArch(f, self.output + f + ".rewrite.o",
+                                    self.deployment_target, self.dir)
+                        for f in input_files]
+        if env.verify_mode:
+            return [x.output for x in rewrite_jobs]
+        self.runJobs(rewrite_jobs)
+        env.pruneCache("rewrite")
+        return [x.output for x in rewrite_jobs]
 
     def run(self):
         """Build Bitcode Bundle"""
+        with env.profiler.phase("job construction"):
+            speculation = self.speculate()
+            try:
+                return self.build(speculation)
+            finally:
+                if speculation is not None:
+                    speculation.abandon()
+
+    def speculate(self):
+        """Start the optimized rebuild of a swift bundle, with
+        --speculative-swift-rebuild, None if there is no need"""
+        if not env.speculative_swift or env.verify_mode or \
+                self.force_optimize_swift or self.speculation is not None:
+            return None
+        if not any(x.tool == "swift" for x in self.getFileNode("Bitcode")):
+            return None
+        return SpeculativeBuild(self)
+
+    def build(self, speculation=None):
         linker_inputs = []
         linker = Ld(self.output, self.dir)
+        linker.uuid = self.uuid
         linker.addArgs(["-arch", self.arch])
         linker.addArgs(self.linkOptions)
+        # the object paths of the debug map are relative to the scratch
+        # root, it doesn't leak into the output (and its UUID)
+        oso_prefix = env.osoPrefix()
+        if oso_prefix is not None:
+            linker.addArgs(["-oso_prefix", oso_prefix])
         # handle bitcode input
         bitcode_files = self.getFileNode("Bitcode")
         if len(bitcode_files) > 0:
@@ -308,27 +477,32 @@ class BitcodeBundle(xar):
             object_jobs = list(map(self.constructObjectJob, object_files))
             linker_inputs.extend(object_jobs)
         # run compilation
-        env.map(self.run_job, linker_inputs)
+        with env.profiler.phase("compile"):
+            self.runJobs(linker_inputs)
+        env.pruneCache("compile")
         # run bundle compilation in sequential to avoid dead-lock
         bundle_files = self.getFileNode("Bundle")
         if len(bundle_files) > 0:
-            bundle_jobs = list(map(self.constructBundleJob, bundle_files))
-            list(map(self.run_job, bundle_jobs))
+            with env.profiler.phase("compile"):
+                bundle_jobs = list(map(self.constructBundleJob, bundle_files))
+                list(map(self.run_job, bundle_jobs))
             linker_inputs.extend(bundle_jobs)
         # sort object inputs
         inputs = sorted([os.path.basename(x.output) for x in linker_inputs])
         # handle LTO inputs
         LTO_inputs = self.getFileNode("LTO")
         if (len(LTO_inputs)) != 0:
-            lto_input_files = [x.find("name").text for x in LTO_inputs]
+            lto_input_files = [x.name for x in LTO_inputs]
             linker.addArgs(["-flto-codegen-only"])
             linker.addArgs(["-object_path_lto", self.output + ".lto.o"])
+            linker.enableLTO()
             linker.addArgs(ClangCC1Translator.compatibility_flags(self.arch))
             # watchOS doesn't support inline asm.
             if env.getPlatform() == "watchos":
                 linker.addArgs(["-mllvm", "-lto-module-no-asm"])
             if self.is_translate_watchos:
-                lto_input_files = self.rewriteLTOInputFiles(lto_input_files)
+                with env.profiler.phase("compile"):
+                    lto_input_files = self.rewriteLTOInputFiles(lto_input_files)
                 linker.addArgs(["-mllvm", "-aarch64-watch-bitcode-compatibility"])
             inputs.extend(lto_input_files)
         # add inputs to a LinkFileList
@@ -372,15 +546,81 @@ class BitcodeBundle(xar):
         linker.addArgs([env.getlibclang_rt(self.arch)])
         # linking
         try:
-            self.run_job(linker)
+            with env.profiler.phase("link"):
+                self.run_job(linker)
         except BitcodeBuildFailure as e:
-            if self.contain_swift and not self.force_optimize_swift:
+            if self.contain_swift and not self.force_optimize_swift and \
+                    not isinstance(e, BuildCancelled):
                 env.warning("Rebuild failing swift project with optimization")
-                rebuild = BitcodeBundle(self.arch, self.input, self.output)
-                rebuild.force_optimize_swift = True
-                rebuild.is_compile_with_clang = self.is_translate_watchos
-                return rebuild.run()
+                # extracted again from the (kept) input
+                env.scratch.release(self.dir)
+                if speculation is not None:
+                    rebuild = speculation.take(self.output)
+                    if rebuild is not None:
+                        return rebuild
+                    # failed too, build it again for the errors
+                rebuild = self.optimizedRebuild().run()
+                return rebuild.installAt(self.output)
             else:
                 raise e
         else:
             return self
+
+
+class SpeculativeBuild(object):
+
+    """The optimized rebuild of a swift bundle, started with its build
+
+    A swift bundle failing to link is rebuilt with optimization.  Built in
+    the background on the -j slots the bundle leaves idle, the rebuild is
+    ready (or nearly) if the link fails and costs nothing but idle time if
+    it succeeds.  Its failures are only logged in debug: they are reported
+    by the bundle's own build, or by a regular rebuild.
+    """
+
+    def __init__(self, bundle):
+        self.abandoned = threading.Event()
+        self._done = threading.Event()
+        self._rebuild = None
+        self._taken = False
+        self._thread = threading.Thread(
+            target=self._run, args=(bundle, env.bindThread),
+            name="bitcode-build-speculative")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, bundle, bind):
+        bind()
+        rebuild = None
+        try:
+            env.debug(u"Speculative optimized build of {}".format(
+                bundle.input))
+            # linked next to the bundle's own output, moved over it if used
+            rebuild = bundle.optimizedRebuild()
+            rebuild.speculation = self
+            self._rebuild = rebuild.run()
+        except BitcodeBuildFailure:
+            if rebuild is not None:
+                env.scratch.release(rebuild.dir)
+        finally:
+            self._done.set()
+
+    def take(self, output):
+        """Wait for the rebuild, install it at output and return it
+
+        None if it failed.
+        """
+        self._done.wait()
+        rebuild = self._rebuild
+        if rebuild is None:
+            return None
+        env.debug(u"Using the speculative build of {}".format(rebuild.input))
+        self._taken = True
+        return rebuild.installAt(output)
+
+    def abandon(self):
+        """Skip the jobs not started yet, wait for the ones running"""
+        self.abandoned.set()
+        self._done.wait()
+        if self._rebuild is not None and not self._taken:
+            env.scratch.release(self._rebuild.dir)
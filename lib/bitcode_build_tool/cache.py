@@ -0,0 +1,240 @@
+"""On-disk caches shared between builds"""
+import os
+import shutil
+import tempfile
+import threading
+
+
+def pruneDirectory(path, max_bytes):
+    """Delete the least recently used files until path fits in max_bytes
+
+    Returns the number of bytes removed.
+    """
+    entries = []
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            try:
+                st = os.lstat(file_path)
+            except OSError:
+                continue
+            entries.append((max(st.st_atime, st.st_mtime), st.st_size,
+                            file_path))
+            total += st.st_size
+    removed = 0
+    entries.sort()
+    for _, size, file_path in entries:
+        if total - removed <= max_bytes:
+            break
+        try:
+            os.unlink(file_path)
+        except OSError:
+            continue
+        removed += size
+    return removed
+
+
+class RemoteCache(object):
+
+    """Content addressed store of build outputs behind an HTTP server
+
+    Entries are fetched with GET and uploaded with PUT at URL/NAME/KEY,
+    using the same names and keys as the BuildCache in front of it.  Any
+    error or a reply slower than timeout counts as a miss, and after
+    MAX_FAILURES of those in a row the server isn't asked again, so a slow
+    or missing server only costs local builds.
+    """
+    MAX_FAILURES = 3
+
+    def __init__(self, url, timeout=5.0, upload_threads=4):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._failures = 0
+        self._lock = threading.Lock()
+        from concurrent.futures import ThreadPoolExecutor
+        self._uploads = ThreadPoolExecutor(upload_threads)
+
+    @property
+    def available(self):
+        with self._lock:
+            return self._failures < self.MAX_FAILURES
+
+    def _result(self, ok):
+        with self._lock:
+            if ok:
+                self._failures = 0
+            else:
+                self._failures += 1
+
+    def entryURL(self, name, key):
+        return u"{}/{}/{}".format(self.url, name, key)
+
+    def get(self, name, key, output):
+        """Download the entry to output, return whether it existed"""
+        if not self.available:
+            return False
+        # urllib and its dependencies are only imported for a remote cache
+        from urllib.error import HTTPError, URLError
+        from urllib.request import urlopen
+        try:
+            response = urlopen(self.entryURL(name, key), timeout=self.timeout)
+            try:
+                with open(output, "wb") as f:
+                    shutil.copyfileobj(response, f, 1 << 20)
+            finally:
+                response.close()
+        except HTTPError as e:
+            # a 404 is a plain miss, the server is fine
+            self._result(e.code == 404)
+            return False
+        except (URLError, IOError, OSError, ValueError):
+            self._result(False)
+            return False
+        self._result(True)
+        return True
+
+    def put(self, name, key, path):
+        """Upload the file at path in the background"""
+        if not self.available:
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        self._uploads.submit(self._upload, name, key, data)
+
+    def _upload(self, name, key, data):
+        from urllib.error import HTTPError, URLError
+        from urllib.request import Request, urlopen
+        request = Request(self.entryURL(name, key), data=data)
+        request.get_method = lambda: "PUT"
+        request.add_header("Content-Type", "application/octet-stream")
+        try:
+            urlopen(request, timeout=self.timeout).close()
+        except HTTPError:
+            # the server refused this entry (full, read-only, ...)
+            self._result(True)
+        except (URLError, IOError, OSError, ValueError):
+            self._result(False)
+        else:
+            self._result(True)
+
+    def close(self):
+        """Wait for the uploads still running"""
+        self._uploads.shutdown(wait=True)
+
+
+class BuildCache(object):
+
+    """Content addressed store of build outputs
+
+    Entries are files named by a key derived from everything that
+    determines their content (tool, options and input digests).  The keys
+    don't depend on the host or the paths of the build, so a RemoteCache
+    behind the local one shares entries between machines.
+    """
+    _tool_keys = dict()
+    _tool_keys_lock = threading.Lock()
+
+    def __init__(self, path, name=None, remote=None):
+        self.path = path
+        self.name = name or os.path.basename(path)
+        self.remote = remote
+
+    @staticmethod
+    def key(*parts):
+        # hashlib loads OpenSSL, only builds with a cache need it
+        import hashlib
+        digest = hashlib.sha256()
+        for part in parts:
+            if not isinstance(part, bytes):
+                part = u"{}".format(part).encode("utf-8")
+            digest.update(hashlib.sha256(part).digest())
+        return digest.hexdigest()
+
+    @staticmethod
+    def fileDigest(path):
+        import hashlib
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @classmethod
+    def toolKey(cls, path):
+        """Identify a tool binary by its content
+
+        The digest is computed once per process for a given path, size and
+        modification time.
+        """
+        real_path = os.path.realpath(path)
+        st = os.stat(real_path)
+        stamp = (real_path, st.st_size, st.st_mtime)
+        with cls._tool_keys_lock:
+            digest = cls._tool_keys.get(stamp)
+        if digest is None:
+            digest = cls.fileDigest(real_path)
+            with cls._tool_keys_lock:
+                cls._tool_keys[stamp] = digest
+        return digest
+
+    def entryPath(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def lookup(self, key, output):
+        """Copy the entry for key to output, return whether it existed"""
+        entry = self.entryPath(key)
+        try:
+            shutil.copyfile(entry, output)
+        except (IOError, OSError):
+            return self.lookupRemote(key, output)
+        try:
+            # refresh the entry for the least recently used pruning
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return True
+
+    def store(self, key, output):
+        """Add output to the cache under key"""
+        entry = self.entryPath(key)
+        try:
+            if not os.path.isdir(os.path.dirname(entry)):
+                os.makedirs(os.path.dirname(entry))
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(entry))
+            os.close(fd)
+        except (IOError, OSError):
+            return False
+        try:
+            shutil.copyfile(output, temp)
+            os.rename(temp, entry)
+        except (IOError, OSError):
+            os.unlink(temp)
+            return False
+        if self.remote is not None:
+            self.remote.put(self.name, key, entry)
+        return True
+
+    def lookupRemote(self, key, output):
+        """Fetch the entry from the remote cache into this one and output"""
+        if self.remote is None:
+            return False
+        entry = self.entryPath(key)
+        try:
+            if not os.path.isdir(os.path.dirname(entry)):
+                os.makedirs(os.path.dirname(entry))
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(entry))
+            os.close(fd)
+        except (IOError, OSError):
+            return False
+        try:
+            if not self.remote.get(self.name, key, temp):
+                return False
+            os.rename(temp, entry)
+            shutil.copyfile(entry, output)
+        except (IOError, OSError):
+            return False
+        finally:
+            if os.path.exists(temp):
+                os.unlink(temp)
+        return True
@@ -0,0 +1,168 @@
+"""Reference server for --remote-cache
+
+Serves GET, HEAD and PUT of NAME/KEY from a directory laid out like
+--cache-dir (DIR/NAME/KEY[:2]/KEY), so a local cache directory can be
+shared as is.  Run it with:
+
+  PYTHONPATH=lib python3 -m bitcode_build_tool.cache_server --dir DIR
+"""
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .cache import pruneDirectory
+
+ENTRY_PATH = re.compile(r"^/([A-Za-z0-9_-]+)/([0-9a-f]{64})$")
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+
+    """GET/HEAD/PUT of cache entries under the server's directory"""
+    protocol_version = "HTTP/1.1"
+
+    def entryPath(self):
+        match = ENTRY_PATH.match(self.path)
+        if match is None:
+            self.send_error(400, "Expected /NAME/KEY")
+            return None
+        name, key = match.groups()
+        return os.path.join(self.server.root, name, key[:2], key)
+
+    def do_HEAD(self):
+        self.sendEntry(False)
+
+    def do_GET(self):
+        self.sendEntry(True)
+
+    def sendEntry(self, with_body):
+        entry = self.entryPath()
+        if entry is None:
+            return
+        try:
+            f = open(entry, "rb")
+        except (IOError, OSError):
+            self.send_error(404)
+            return
+        with f:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length",
+                             str(os.fstat(f.fileno()).st_size))
+            self.end_headers()
+            if with_body:
+                shutil.copyfileobj(f, self.wfile, 1 << 20)
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+
+    def do_PUT(self):
+        entry = self.entryPath()
+        if entry is None:
+            return
+        try:
+            length = int(self.headers["Content-Length"])
+        except (TypeError, ValueError):
+            self.send_error(411)
+            return
+        if self.server.max_entry is not None and \
+                length > self.server.max_entry:
+            self.send_error(413)
+            return
+        directory = os.path.dirname(entry)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, temp = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, "wb") as f:
+                remaining = length
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, 1 << 20))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            if remaining > 0:
+                os.unlink(temp)
+                self.send_error(400, "Truncated upload")
+                return
+            os.rename(temp, entry)
+        except (IOError, OSError):
+            self.send_error(500)
+            return
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+        self.server.entryStored(length)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class CacheServer(ThreadingHTTPServer):
+
+    """Threaded HTTP server over a cache directory, pruned to max_bytes"""
+    daemon_threads = True
+
+    def __init__(self, address, root, max_bytes=None, verbose=False):
+        ThreadingHTTPServer.__init__(self, address, CacheRequestHandler)
+        self.root = os.path.realpath(root)
+        self.max_bytes = max_bytes
+        self.max_entry = max_bytes
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self._stored = 0
+
+    def entryStored(self, size):
+        """Prune the directory after every max_bytes / 10 uploaded"""
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            self._stored += size
+            if self._stored < self.max_bytes // 10:
+                return
+            self._stored = 0
+            pruneDirectory(self.root, self.max_bytes)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve a build cache "
+                                     "directory to --remote-cache clients.")
+    parser.add_argument("--dir", required=True, dest="root",
+                        help="Cache directory")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="Address to listen on (default=127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8080,
+                        help="Port to listen on (default=8080)")
+    parser.add_argument("--max-size", metavar="MB", type=int, default=None,
+                        dest="max_size", help="Prune the cache to this size")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.root):
+        os.makedirs(args.root)
+    max_bytes = None
+    if args.max_size is not None:
+        max_bytes = args.max_size * 1024 * 1024
+    server = CacheServer((args.host, args.port), args.root, max_bytes,
+                         args.verbose)
+    sys.stdout.write("Serving {} on http://{}:{}/\n".format(
+        server.root, *server.server_address[:2]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
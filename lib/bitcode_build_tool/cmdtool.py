@@ -1,16 +1,32 @@
 import os
-import subprocess
 import datetime
+import itertools
 import sys
 
-from .buildenv import env, BitcodeBuildFailure
+from .buildenv import env, BitcodeBuildFailure, BuildCancelled
 
 
 class Cmd(object):
 
     """Runs from subprocess"""
-    BOLD_START = u"\033[1m"
-    BOLD_END = u"\033[0;0m"
+    if sys.stdout.isatty():
+        BOLD_START = u"\033[1m"
+        BOLD_END = u"\033[0;0m"
+    else:
+        BOLD_START = BOLD_END = u""
+    # the --profile phase the command's time is charged to
+    phase = "other"
+    # -j slots held while the command runs
+    job_slots = 1
+    # whether the tool prints compiler timers under --time-report
+    time_report = False
+    # the SpeculativeBuild the command is part of: it runs on idle slots,
+    # fails without an error and is skipped once abandoned
+    speculation = None
+    # the input of the BitcodeBundle the command builds part of
+    bundle = None
+    # seconds the tool ran, once it did
+    wall = None
 
     def __init__(self, cmd, working_dir):
         self.working_dir = working_dir
@@ -20,12 +36,9 @@ class Cmd(object):
         self.env = None
 
     def __repr__(self):
-        if sys.stdout.isatty():
-            info = u"{}{}{}: cd {}\n".format(self.BOLD_START, type(self).__name__,
-                                             self.BOLD_END, self.working_dir)
-        else:
-            info = u"{}: cd {}\n".format(type(self).__name__, self.working_dir)
-        cmd_string = ' {}'.format(self.cmd)
+        info = u"{}{}{}: cd {}\n".format(self.BOLD_START, type(self).__name__,
+                                         self.BOLD_END, self.working_dir)
+        cmd_string = ' {}'.format(self.arguments())
         if self.stdout is None:
             return u"{}{}\n".format(info, cmd_string)
         else:
@@ -33,45 +46,223 @@ class Cmd(object):
                                                                    cmd_string, self.stdout,
                                                                    self.returncode)
 
+    def arguments(self):
+        """The command line of the tool"""
+        return self.cmd
+
+    def command(self):
+        """The command line run, behind a launcher for some tools"""
+        return self.arguments()
+
     def run(self):
         self.run_cmd(False)
         return self
 
+    async def run_async(self):
+        """run() as a coroutine of the asyncio engine
+
+        Only the jobs of the compile fan-outs are run this way, the commands
+        overriding run() to do more override this as well.
+        """
+        await self.run_cmd_async(False)
+        return self
+
     def run_cmd(self, xfail=False):
         """Run a command in a working directory."""
-        start_time = datetime.datetime.now()
-        try:
-            if not os.environ.get('TESTING', False):
-                out = subprocess.check_output(self.cmd,
-                                              stderr=subprocess.STDOUT,
-                                              env=self.env,
-                                              cwd=self.working_dir)
-            else:
-                out = "Skipped for testing mode."
-            end_time = datetime.datetime.now()
-        except subprocess.CalledProcessError as e:
-            self.returncode = e.returncode
-            self.stdout = e.output.decode('utf-8')
-            if xfail:
-                env.log(self)
-            else:
-                env.error(self)
+        if not os.environ.get('TESTING', False):
+            with env.job_slots.hold(self.job_slots,
+                                    idle_only=self.speculative), \
+                    env.profiler.subprocess(self.phase):
+                env.checkCancelled()
+                self.checkAbandoned()
+                launched = datetime.datetime.now()
+                returncode, out, usage = env.executor.run(
+                    self.command(), cwd=self.working_dir, env=self.env)
+                self.wall = (datetime.datetime.now() -
+                             launched).total_seconds()
+                self.recordUsage(usage)
+            if returncode != 0:
+                # killed because another job failed, that one is reported
+                env.checkCancelled()
         else:
-            self.returncode = 0
-            self.stdout = out.decode('utf-8')
-            env.log(self)
-            env.debug("Command took {} seconds".format(
-                (end_time - start_time).seconds))
+            returncode, out = 0, b"Skipped for testing mode."
+        self.report(returncode, out, xfail)
+
+    async def run_cmd_async(self, xfail=False):
+        """run_cmd() on the asyncio engine, holding no thread meanwhile"""
+        if not os.environ.get('TESTING', False):
+            slots = await env.job_slots.acquireAsync(
+                self.job_slots, idle_only=self.speculative)
+            try:
+                with env.profiler.subprocess(self.phase):
+                    env.checkCancelled()
+                    self.checkAbandoned()
+                    on_output = None
+                    if env.stream_output:
+                        on_output = OutputStream(self.cmd[0]).write
+                    launched = datetime.datetime.now()
+                    returncode, out, usage = await env.executor.runAsync(
+                        self.command(), self.working_dir, self.env,
+                        on_output)
+                    self.wall = (datetime.datetime.now() -
+                                 launched).total_seconds()
+                    self.recordUsage(usage)
+            finally:
+                env.job_slots.release(slots, self.speculative)
+            if returncode != 0:
+                # killed because another job failed, that one is reported
+                env.checkCancelled()
+        else:
+            returncode, out = 0, b"Skipped for testing mode."
+        self.report(returncode, out, xfail)
+
+    @property
+    def speculative(self):
+        return self.speculation is not None
+
+    def checkAbandoned(self):
+        """Skip a speculative command nobody needs anymore"""
+        if self.speculative and self.speculation.abandoned.is_set():
+            raise BitcodeBuildFailure("Speculative build abandoned")
+
+    def files(self):
+        """The input and output paths of the command, None if unknown"""
+        return [x if x is None else os.path.join(self.working_dir, x)
+                for x in (getattr(self, "input", None),
+                          getattr(self, "output", None))]
+
+    def recordUsage(self, usage):
+        """Add the tool run to the --resource-report"""
+        if env.usage is None:
+            return
+        env.usage.record(os.path.basename(self.cmd[0]), self.phase,
+                         self.bundle, self.wall, usage, *self.files())
+
+    def recordTimers(self):
+        """Move the compiler timers out of the output to the --time-report"""
+        if env.time_report is None or self.wall is None:
+            return
+        member = [x for x in self.files() if x is not None][0]
+        self.stdout = env.time_report.record(
+            os.path.basename(self.cmd[0]), self.bundle, member, self.wall,
+            self.stdout)
+
+    def report(self, returncode, out, xfail):
+        """Record the result of the command and log it
+
+        The full dump of a command (command line and output) is only logged
+        in debug, unless it failed.
+        """
+        self.returncode = returncode
+        self.stdout = out.decode('utf-8')
+        env.commandRan(type(self).__name__)
+        if self.time_report:
+            self.recordTimers()
+        if returncode == 0 or xfail:
+            env.debug(self)
+        elif self.speculative:
+            env.debug(self)
+            raise BitcodeBuildFailure("Speculative command failed")
+        else:
+            env.error(self)
+
+    def logFields(self):
+        """The fields of the command in the --log-json records"""
+        return {"tool": type(self).__name__,
+                "cwd": self.working_dir,
+                "command": self.arguments(),
+                "returncode": self.returncode,
+                "output": self.stdout,
+                "wall": self.wall,
+                "bundle": self.bundle}
+
+
+class OutputStream(object):
+
+    """Log the output of a running tool line by line, as it arrives"""
+
+    def __init__(self, tool):
+        self.tool = os.path.basename(tool)
+        self._partial = b""
+
+    def write(self, chunk):
+        lines = (self._partial + chunk).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            env.debug(u"{}: {}".format(self.tool,
+                                       line.decode("utf-8", "replace")))
 
 
 class CompileCmd(Cmd):
 
-    """Compile command that doesn't run under verify mode"""
+    """Compile command that doesn't run under verify mode
+
+    The command line is cmd, the options shared by the jobs of a bundle
+    (args, kept as a tuple) and the job's own inputOutput(), put together
+    only when the tool is launched.
+    """
+    phase = "compile"
+    args = ()
+
+    def inputOutput(self):
+        """The arguments after args: the job's input and output"""
+        return []
+
+    def arguments(self):
+        return self.cmd + list(self.args) + self.inputOutput()
 
     def run_cmd(self, xfail=False):
         if not env.verify_mode:
             super(CompileCmd, self).run_cmd(xfail)
 
+    async def run_cmd_async(self, xfail=False):
+        if not env.verify_mode:
+            await super(CompileCmd, self).run_cmd_async(xfail)
+
+    def lookupCache(self):
+        """Return (cache, key, output) and whether the output was found
+
+        The key is made of the tool's content, the arguments and the
+        content of the input.  Inputs and outputs are named relative to the
+        working directory, so the key doesn't depend on where the build
+        runs and the remote cache can share it.
+        """
+        cache = env.getCache("compile")
+        if cache is None or env.verify_mode:
+            return None, False
+        output = os.path.join(self.working_dir, self.output)
+        arguments = itertools.chain(self.cmd[1:], self.args,
+                                    self.inputOutput())
+        key = cache.key(type(self).__name__, cache.toolKey(self.cmd[0]),
+                        u"\0".join(arguments), cache.fileDigest(
+                            os.path.join(self.working_dir, self.input)))
+        if cache.lookup(key, output):
+            env.debug(u"Compiled object found in cache: {}".format(
+                self.input))
+            return (cache, key, output), True
+        return (cache, key, output), False
+
+    def runCached(self):
+        """Run the command, or reuse the output of an identical one"""
+        entry, found = self.lookupCache()
+        if found:
+            return
+        self.run_cmd(False)
+        if entry is not None:
+            entry[0].store(entry[1], entry[2])
+
+    async def runCachedAsync(self):
+        """runCached() as a coroutine, the cache is read off the loop"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        entry, found = await loop.run_in_executor(None, self.lookupCache)
+        if found:
+            return
+        await self.run_cmd_async(False)
+        if entry is not None:
+            await loop.run_in_executor(None, entry[0].store, entry[1],
+                                       entry[2])
+
 
 class Clang(CompileCmd):
 
@@ -82,19 +273,31 @@ class Clang(CompileCmd):
         self.input = bitcode
         self.output = output
         self.input_type = "ir"
+        self.time_report = env.time_report is not None
         super(Clang, self).__init__([self._clang, "-cc1"], working_dir)
+        self.env = env.launcherEnvironment()
+
+    def command(self):
+        return env.compiler_launcher + self.arguments()
 
     def addArgs(self, args):
-        self.cmd.extend(args)
+        # a tuple is kept as is, the jobs of a bundle share their options
+        self.args = self.args + tuple(args) if self.args else tuple(args)
 
     def setInputType(self, ty):
         self.input_type = ty
 
+    def inputOutput(self):
+        args = ["-ftime-report"] if self.time_report else []
+        args.extend(["-x", self.input_type, self.input, "-o", self.output])
+        return args
+
     def run(self):
-        self.cmd.extend(["-x", self.input_type])
-        self.cmd.append(self.input)
-        self.cmd.extend(["-o", self.output])
-        self.run_cmd(False)
+        self.runCached()
+        return self
+
+    async def run_async(self):
+        await self.runCachedAsync()
         return self
 
 
@@ -106,38 +309,89 @@ class Swift(CompileCmd):
         self._swift = env.getTool("swiftc")
         self.input = bitcode
         self.output = output
+        self.time_report = env.time_report is not None
         super(Swift, self).__init__([self._swift, "-frontend"], working_dir)
+        self.env = env.launcherEnvironment()
+
+    def command(self):
+        return env.compiler_launcher + self.arguments()
 
     def addArgs(self, args):
-        self.cmd.extend(args)
+        self.args = self.args + tuple(args) if self.args else tuple(args)
+
+    def inputOutput(self):
+        args = ["-Xllvm", "-time-passes"] if self.time_report else []
+        args.extend([self.input, "-o", self.output])
+        return args
 
     def run(self, dry_run=False):
-        self.cmd.append(self.input)
-        self.cmd.extend(["-o", self.output])
-        self.run_cmd(False)
+        self.runCached()
+        return self
+
+    async def run_async(self):
+        await self.runCachedAsync()
         return self
 
 
 class Ld(CompileCmd):
 
     """Run Ld command"""
+    phase = "link"
+    # libLTO option controlling the number of LTO code generation threads
+    LTO_THREADS_FLAG = ["-mllvm", "-threads={}"]
 
     def __init__(self, output="a.out", working_dir=os.getcwd()):
         self._ld = env.getTool("ld")
         self.output = output
+        self.lto = False
+        self.lto_cache = None
+        # the UUID of the original slice, to find its symbol map
+        self.uuid = None
         super(Ld, self).__init__([self._ld], working_dir)
 
     def addArgs(self, args):
         self.cmd.extend(args)
 
+    def enableLTO(self):
+        """Run LTO code generation threaded, and cached if possible"""
+        self.lto = True
+        self.lto_cache = env.getCacheDirectory("lto")
+        if self.lto_cache is not None:
+            self.addArgs(["-cache_path_lto", self.lto_cache])
+
     def run(self, dry_run=False):
         self.env = { "LD_WARN_ON_SWIFT_ABI_VERSION_MISMATCHES" : "1" }
+        if env.linker_launcher:
+            # the launcher needs PATH, HOME and its own settings
+            self.env = dict(os.environ, **self.env)
         self.cmd.extend(["-o", self.output])
+        if not self.lto:
+            return self.link()
+        # the LTO threads come out of the -j budget: take every free slot
+        with env.job_slots.hold(env.jobs, minimum=1,
+                                idle_only=self.speculative) as threads:
+            self.job_slots = 0
+            self.cmd.extend([x.format(threads) for x in self.LTO_THREADS_FLAG])
+            if env.time_report is not None:
+                self.time_report = True
+                self.cmd.extend(["-mllvm", "-time-passes"])
+            self.link()
+        if self.lto_cache is not None:
+            env.pruneCache("lto")
+        return self
+
+    def command(self):
+        return env.linker_launcher + self.cmd
+
+    def link(self):
         try:
             self.run_cmd(False)
+        except BuildCancelled:
+            raise
         except BitcodeBuildFailure:
             if env.deobfuscator is not None:
-                translated_msg = env.deobfuscator.tryDeobfuscate(self.stdout)
+                translated_msg = env.deobfuscator.tryDeobfuscate(
+                    self.stdout, self.uuid)
                 if translated_msg is not None:
                     env.log("Translation of the obfuscated symbols "
                             "using the bitcode symbol map:\n\n" +
@@ -150,6 +404,7 @@ class Ld(CompileCmd):
 class Lipo(Cmd):
 
     """Run Lipo command"""
+    phase = "lipo"
 
     def __init__(self, working_dir=os.getcwd()):
         self._lipo = env.getTool("lipo")
@@ -163,6 +418,7 @@ class Lipo(Cmd):
 class MachoInfo(Lipo):
 
     """Get Macho Type"""
+    phase = "front-end extraction"
 
     def __init__(self, input, working_dir=os.getcwd()):
         super(MachoInfo, self).__init__(working_dir)
@@ -205,6 +461,7 @@ class AddSlice(Lipo):
 class ExtractSlice(Lipo):
 
     """Extract slice"""
+    phase = "front-end extraction"
 
     def __init__(self, input, arch, output, working_dir=os.getcwd()):
         super(ExtractSlice, self).__init__(working_dir)
@@ -218,16 +475,19 @@ class LipoCreate(Lipo):
         self.cmd.extend(["-create"] + inputs + ["-output", output])
 
 
-class CopyFile(Cmd):
+class CopyFile(CompileCmd):
 
     """File Copy"""
+    phase = "compile"
+    DITTO = "/usr/bin/ditto"
 
     def __init__(self, src, dst, working_dir=os.getcwd()):
         super(CopyFile, self).__init__(
-            ["/usr/bin/ditto", src, dst], working_dir)
+            [self.DITTO, src, dst], working_dir)
 
 
 class ExtractXAR(Cmd):
+    phase = "front-end extraction"
 
     def __init__(self, input, output, working_dir=os.getcwd()):
         super(ExtractXAR, self).__init__([env.getTool("segedit"), input,
@@ -240,13 +500,26 @@ class ExtractXAR(Cmd):
 
 
 class Dsymutil(Cmd):
+    phase = "dsym"
 
     def __init__(self, input, output, working_dir=os.getcwd()):
         super(Dsymutil, self).__init__(
             [env.getTool("dsymutil"), input, "-o", output], working_dir)
+        if env.osoPrefix() is not None:
+            # the debug map paths are relative to the scratch root
+            self.cmd.append("--oso-prepend-path=" + env.scratchRoot())
+
+    def run(self):
+        # dsymutil threads come out of the -j budget, like LTO threads
+        with env.job_slots.hold(env.jobs, minimum=1) as threads:
+            self.job_slots = 0
+            self.cmd.extend(["--num-threads", str(threads)])
+            self.run_cmd(False)
+        return self
 
 
 class DsymMap(Cmd):
+    phase = "dsym"
 
     def __init__(self, input, mapfile, working_dir=os.getcwd()):
         super(DsymMap, self).__init__(
@@ -255,6 +528,7 @@ class DsymMap(Cmd):
 
 
 class StripSymbols(Cmd):
+    phase = "strip"
 
     def __init__(self, input, working_dir=os.getcwd()):
         super(StripSymbols, self).__init__([env.getTool("strip"), input],
@@ -262,6 +536,7 @@ class StripSymbols(Cmd):
 
 
 class StripDebug(Cmd):
+    phase = "strip"
 
     def __init__(self, input, strip_swift, working_dir=os.getcwd()):
         if strip_swift:
@@ -274,6 +549,7 @@ class StripDebug(Cmd):
 
 
 class GetUUID(Cmd):
+    phase = "front-end extraction"
 
     def __init__(self, input, working_dir=os.getcwd()):
         super(GetUUID, self).__init__([env.getTool("dwarfdump"), "-u", input],
@@ -281,10 +557,49 @@ class GetUUID(Cmd):
 
 
 class RewriteArch(Cmd):
+    phase = "compile"
+
     def __init__(self, input, output, deployment_target, working_dir=os.getcwd()):
         new_triple = "arm64_32-apple-watchos"
         if deployment_target is not None:
             new_triple += deployment_target
+        self.input = input
+        self.output = output
+        self.triple = new_triple
         super(RewriteArch, self).__init__([env.getTool("clang"), "-target", new_triple, "-c", "-Xclang",
                                            "-disable-llvm-passes", "-emit-llvm", "-x", "ir", input, "-o", output],
                                           working_dir)
+
+    def lookupCache(self):
+        """Return (cache, key) and whether the rewritten bitcode was found"""
+        cache = env.getCache("rewrite")
+        if cache is None:
+            return None, False
+        key = cache.key(type(self).__name__, cache.toolKey(self.cmd[0]),
+                        self.triple, cache.fileDigest(
+                            os.path.join(self.working_dir, self.input)))
+        if cache.lookup(key, self.output):
+            env.debug(u"Rewritten bitcode found in cache: {}".format(
+                self.input))
+            return (cache, key), True
+        return (cache, key), False
+
+    def run(self):
+        """Rewrite the input, reusing a cached result of the same bitcode"""
+        entry, found = self.lookupCache()
+        if not found:
+            self.run_cmd(False)
+            if entry is not None:
+                entry[0].store(entry[1], self.output)
+        return self
+
+    async def run_async(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        entry, found = await loop.run_in_executor(None, self.lookupCache)
+        if not found:
+            await self.run_cmd_async(False)
+            if entry is not None:
+                await loop.run_in_executor(None, entry[0].store, entry[1],
+                                           self.output)
+        return self
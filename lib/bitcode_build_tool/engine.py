@@ -0,0 +1,193 @@
+"""asyncio engine supervising the tools of a build from a single thread
+
+A job that runs a tool spends nearly all of its time waiting for the tool
+to exit.  The engine runs those jobs as coroutines of one event loop: the
+output pipe of every tool is watched by the loop, so thousands of tools can
+be supervised without a thread each.  The loop runs in a thread of its own
+so the rest of the build (synchronous code) can hand work to it.
+"""
+import asyncio
+import errno
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .usage import waitProcess
+
+
+class AsyncEngine(object):
+
+    """An event loop running in its own thread, and the tools it runs"""
+
+    # chunk size of the output reads
+    READ_SIZE = 1 << 16
+
+    def __init__(self, pass_fds=(), extra_env=None, initializer=None,
+                 blocking_threads=4):
+        self.pass_fds = tuple(pass_fds)
+        self.extra_env = extra_env or dict()
+        self.loop = asyncio.new_event_loop()
+        # for the little blocking work of the jobs (cache lookups)
+        self._blocking = ThreadPoolExecutor(
+            blocking_threads, thread_name_prefix="bitcode-build-blocking",
+            initializer=initializer)
+        self.loop.set_default_executor(self._blocking)
+        self._running = set()
+        self._cancelled = False
+        self._thread = threading.Thread(target=self._run,
+                                        args=(initializer,),
+                                        name="bitcode-build-engine")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, initializer):
+        if initializer is not None:
+            initializer()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    @property
+    def inLoop(self):
+        return threading.current_thread() is self._thread
+
+    def call(self, coro):
+        """Run coro on the loop and wait for its result from another thread"""
+        if self.inLoop:
+            coro.close()
+            raise RuntimeError("AsyncEngine.call() from the engine's loop")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def map(self, func, items, fail_fast=True, on_failure=None):
+        """Run the coroutine function func on every item, return the results
+
+        Like ThreadPool.map the results keep the order of items.  With
+        fail_fast the first failure is raised once on_failure(exception)
+        was called (to cancel the build) and the other jobs were cancelled
+        (their tools killed) and have ended: nothing writes to their
+        directories anymore.
+        """
+        return self.call(self._map(func, list(items), fail_fast, on_failure))
+
+    async def _map(self, func, items, fail_fast, on_failure):
+        done = asyncio.Queue()
+
+        async def call(index, item):
+            # exceptions are handed over here, never left unretrieved
+            try:
+                done.put_nowait((index, await func(item), None))
+            except Exception as e:
+                done.put_nowait((index, None, e))
+
+        tasks = [self.loop.create_task(call(index, item))
+                 for index, item in enumerate(items)]
+        results = [None] * len(items)
+        failure = None
+        for _ in range(len(items)):
+            index, result, error = await done.get()
+            if error is None:
+                results[index] = result
+                continue
+            if on_failure is not None:
+                on_failure(error)
+            if fail_fast:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.wait(tasks)
+                raise error
+            if failure is None or index < failure[0]:
+                failure = (index, error)
+        if failure is not None:
+            raise failure[1]
+        return results
+
+    async def runProcess(self, cmd, cwd=None, env=None, timeout=None,
+                         on_output=None):
+        """Run cmd, return (exit status, combined stdout/stderr bytes,
+        ToolUsage)
+
+        on_output(chunk) sees the output as it arrives.  A tool running
+        longer than timeout seconds is killed.
+        """
+        if self.extra_env:
+            env = dict(os.environ if env is None else env, **self.extra_env)
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env,
+                                pass_fds=self.pass_fds,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        self._running.add(proc)
+        if self._cancelled:
+            proc.kill()
+        chunks = []
+        eof = self.loop.create_future()
+        fd = proc.stdout.fileno()
+        os.set_blocking(fd, False)
+
+        def readable():
+            try:
+                chunk = os.read(fd, self.READ_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                chunk = b""
+            if not chunk:
+                self.loop.remove_reader(fd)
+                if not eof.done():
+                    eof.set_result(None)
+                return
+            chunks.append(chunk)
+            if on_output is not None:
+                on_output(chunk)
+
+        self.loop.add_reader(fd, readable)
+        try:
+            try:
+                await asyncio.wait_for(asyncio.shield(eof), timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await eof
+                chunks.append(u"\nKilled after {} seconds\n".format(
+                    timeout).encode())
+            # the output is closed, the tool is exiting
+            usage = waitProcess(proc, os.WNOHANG)
+            if usage is None:
+                usage = await self.loop.run_in_executor(None, waitProcess,
+                                                        proc)
+        except asyncio.CancelledError:
+            proc.kill()
+            raise
+        finally:
+            self.loop.remove_reader(fd)
+            proc.stdout.close()
+            self._running.discard(proc)
+        return proc.returncode, b"".join(chunks), usage
+
+    def cancel(self):
+        """Kill every running tool, and any started from now on"""
+        if self.inLoop:
+            self._killAll()
+        else:
+            self.loop.call_soon_threadsafe(self._killAll)
+
+    def _killAll(self):
+        self._cancelled = True
+        for proc in self._running:
+            try:
+                proc.kill()
+            except OSError:
+                pass
+
+    async def _drain(self):
+        """Wait for the jobs still running on the loop"""
+        tasks = asyncio.all_tasks(self.loop) - set([asyncio.current_task()])
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        self.call(self._drain())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._blocking.shutdown()
+        self.loop.close()
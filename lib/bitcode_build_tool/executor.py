@@ -0,0 +1,264 @@
+"""Backends that launch the tools for Cmd"""
+import os
+import subprocess
+import sys
+import threading
+
+from . import spawn_helper
+from .usage import ToolUsage, maxRSSBytes, waitProcess
+
+
+class SubprocessExecutor(object):
+
+    """Fork/exec every tool straight from the orchestrator"""
+    name = "subprocess"
+    engine = None
+
+    def __init__(self, pass_fds=(), extra_env=None, timeout=None,
+                 initializer=None):
+        self.pass_fds = tuple(pass_fds)
+        self.extra_env = extra_env or dict()
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._running = set()
+        self._cancelled = False
+
+    def run(self, cmd, cwd=None, env=None):
+        """Run cmd, return (exit status, combined stdout/stderr bytes,
+        ToolUsage)"""
+        if self.extra_env:
+            env = dict(os.environ if env is None else env, **self.extra_env)
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env,
+                                pass_fds=self.pass_fds,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        with self._lock:
+            self._running.add(proc)
+            if self._cancelled:
+                proc.kill()
+        timer = None
+        expired = threading.Event()
+        if self.timeout is not None:
+            timer = threading.Timer(self.timeout, self._expire,
+                                    (proc, expired))
+            timer.daemon = True
+            timer.start()
+        try:
+            # read to the end and reap the tool ourselves, Popen's wait()
+            # doesn't give the rusage
+            with proc.stdout:
+                out = proc.stdout.read()
+            usage = waitProcess(proc)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            with self._lock:
+                self._running.discard(proc)
+        if expired.is_set():
+            out += u"\nKilled after {} seconds\n".format(
+                self.timeout).encode()
+        return proc.returncode, out, usage
+
+    @staticmethod
+    def _expire(proc, expired):
+        expired.set()
+        proc.kill()
+
+    def cancel(self):
+        """Kill every running tool, and any started from now on"""
+        with self._lock:
+            self._cancelled = True
+            for proc in self._running:
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+
+    def close(self):
+        pass
+
+
+class SpawnServerExecutor(object):
+
+    """Launch the tools through a small helper process
+
+    Forking a process with a large heap is slow, and many threads forking
+    at once contend on it.  The helper is started once, while the
+    orchestrator is still small, and every tool is then launched from its
+    process; requests and results travel over a pipe using the compact
+    framing described in spawn_helper.
+    """
+    name = "spawn-server"
+    engine = None
+    HELPER = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          "spawn_helper.py")
+
+    def __init__(self, pass_fds=(), extra_env=None, timeout=None,
+                 initializer=None):
+        if timeout is not None:
+            raise ValueError("the spawn server doesn't support timeouts")
+        self._lock = threading.Lock()
+        self._pending = dict()
+        self._next_id = 0
+        self._closed = False
+        self.extra_env = extra_env or dict()
+        # the helper inherits pass_fds and hands them on to every tool
+        helper_env = dict(os.environ, **self.extra_env)
+        self._helper = subprocess.Popen(
+            [sys.executable, "-B", "-S", "-E", self.HELPER] +
+            [str(x) for x in pass_fds],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            env=helper_env, pass_fds=tuple(pass_fds))
+        self._reader = threading.Thread(target=self._readResponses,
+                                        name="spawn-server-reader")
+        self._reader.daemon = True
+        self._reader.start()
+
+    @staticmethod
+    def _encode(cmd, cwd, env):
+        fields = [cwd or ""]
+        if env is None:
+            fields.append("-1")
+        else:
+            fields.append(str(len(env)))
+            fields.extend(u"{}={}".format(k, v) for k, v in env.items())
+        fields.extend(cmd)
+        return b"".join(os.fsencode(x) + b"\0" for x in fields)
+
+    def _readExactly(self, size):
+        data = b""
+        while len(data) < size:
+            chunk = self._helper.stdout.read(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def _readResponses(self):
+        header_size = spawn_helper.RESPONSE.size
+        while True:
+            header = self._readExactly(header_size)
+            if header is None:
+                break
+            request_id, returncode, error, user, system, max_rss, \
+                length = spawn_helper.RESPONSE.unpack(header)
+            output = self._readExactly(length) if length else b""
+            if output is None:
+                break
+            with self._lock:
+                waiter = self._pending.pop(request_id)
+            usage = ToolUsage(user / 1e6, system / 1e6, maxRSSBytes(max_rss))
+            waiter[1] = (returncode, error, output, usage)
+            waiter[0].set()
+        # the helper went away, fail everything still waiting on it
+        with self._lock:
+            self._closed = True
+            waiters = list(self._pending.values())
+            self._pending.clear()
+        for waiter in waiters:
+            waiter[1] = (-1, 0, b"spawn server exited unexpectedly",
+                         ToolUsage())
+            waiter[0].set()
+
+    def run(self, cmd, cwd=None, env=None):
+        """Run cmd, return (exit status, combined stdout/stderr bytes,
+        ToolUsage)"""
+        if env is not None and self.extra_env:
+            env = dict(env, **self.extra_env)
+        payload = self._encode(cmd, cwd, env)
+        waiter = [threading.Event(), None]
+        with self._lock:
+            if self._closed:
+                raise OSError("spawn server is not running")
+            request_id = self._next_id
+            self._next_id += 1
+            self._pending[request_id] = waiter
+            self._helper.stdin.write(
+                spawn_helper.REQUEST.pack(request_id, len(payload)) + payload)
+            self._helper.stdin.flush()
+        waiter[0].wait()
+        returncode, error, output, usage = waiter[1]
+        if error:
+            raise OSError(error, output.decode("utf-8", "replace"))
+        return returncode, output, usage
+
+    def cancel(self):
+        """Have the helper kill every running tool"""
+        with self._lock:
+            if self._closed or self._helper.stdin.closed:
+                return
+            # an empty request, which carries no command line
+            self._helper.stdin.write(
+                spawn_helper.REQUEST.pack(spawn_helper.CANCEL_ID, 0))
+            self._helper.stdin.flush()
+
+    def close(self):
+        with self._lock:
+            if self._helper.stdin.closed:
+                return
+            self._helper.stdin.close()
+        self._helper.wait()
+        self._reader.join()
+
+
+class AsyncioExecutor(SubprocessExecutor):
+
+    """Run the tools from the event loop of an AsyncEngine
+
+    Jobs written as coroutines (Cmd.run_async) run on the engine and hold
+    no thread while their tool runs.  The synchronous callers run their
+    tool like the subprocess backend, so a build that never reaches a
+    compile fan-out doesn't start (or import) asyncio at all.
+    """
+    name = "asyncio"
+
+    def __init__(self, pass_fds=(), extra_env=None, timeout=None,
+                 initializer=None):
+        super(AsyncioExecutor, self).__init__(pass_fds, extra_env, timeout)
+        self._initializer = initializer
+        self._engine = None
+        self._engine_lock = threading.Lock()
+
+    @property
+    def engine(self):
+        with self._engine_lock:
+            if self._engine is None:
+                from .engine import AsyncEngine
+                self._engine = AsyncEngine(self.pass_fds, self.extra_env,
+                                           self._initializer)
+                if self._cancelled:
+                    self._engine.cancel()
+            return self._engine
+
+    def runAsync(self, cmd, cwd=None, env=None, on_output=None):
+        """Coroutine of run(), on_output(chunk) streams the output"""
+        return self.engine.runProcess(cmd, cwd, env, self.timeout, on_output)
+
+    def cancel(self):
+        """Kill every running tool, and any started from now on"""
+        super(AsyncioExecutor, self).cancel()
+        with self._engine_lock:
+            if self._engine is not None:
+                self._engine.cancel()
+
+    def close(self):
+        with self._engine_lock:
+            if self._engine is not None:
+                self._engine.close()
+
+
+EXECUTORS = {
+    SubprocessExecutor.name: SubprocessExecutor,
+    SpawnServerExecutor.name: SpawnServerExecutor,
+    AsyncioExecutor.name: AsyncioExecutor,
+}
+
+
+def createExecutor(name, pass_fds=(), extra_env=None, timeout=None,
+                   initializer=None):
+    """Create the named executor
+
+    timeout kills a tool running longer than that many seconds, initializer
+    is called in the threads the executor starts.
+    """
+    return EXECUTORS[name](pass_fds, extra_env, timeout, initializer)
@@ -0,0 +1,241 @@
+"""Read thin Mach-O headers and write fat files without lipo"""
+import binascii
+import os
+import shutil
+import struct
+
+FAT_MAGIC = 0xcafebabe
+FAT_HEADER = struct.Struct(">II")
+FAT_ARCH = struct.Struct(">iiIII")
+
+MH_MAGIC = 0xfeedface
+MH_MAGIC_64 = 0xfeedfacf
+LC_SEGMENT = 0x1
+LC_SEGMENT_64 = 0x19
+LC_UUID = 0x1b
+
+CPU_ARCH_ABI64 = 0x01000000
+CPU_ARCH_ABI64_32 = 0x02000000
+CPU_TYPE_X86 = 7
+CPU_TYPE_ARM = 12
+CPU_SUBTYPE_MASK = 0xff000000
+
+ARCH_NAMES = {
+    (CPU_TYPE_X86, 3): "i386",
+    (CPU_TYPE_X86 | CPU_ARCH_ABI64, 3): "x86_64",
+    (CPU_TYPE_X86 | CPU_ARCH_ABI64, 8): "x86_64h",
+    (CPU_TYPE_ARM, 6): "armv6",
+    (CPU_TYPE_ARM, 9): "armv7",
+    (CPU_TYPE_ARM, 11): "armv7s",
+    (CPU_TYPE_ARM, 12): "armv7k",
+    (CPU_TYPE_ARM | CPU_ARCH_ABI64, 0): "arm64",
+    (CPU_TYPE_ARM | CPU_ARCH_ABI64, 1): "arm64v8",
+    (CPU_TYPE_ARM | CPU_ARCH_ABI64, 2): "arm64e",
+    (CPU_TYPE_ARM | CPU_ARCH_ABI64_32, 1): "arm64_32",
+}
+
+# log2 of the slice alignment lipo uses for each cpu type
+PAGE_ALIGN = {
+    CPU_TYPE_ARM: 14,
+    CPU_TYPE_ARM | CPU_ARCH_ABI64: 14,
+    CPU_TYPE_ARM | CPU_ARCH_ABI64_32: 14,
+}
+DEFAULT_ALIGN = 12
+
+
+class FatError(Exception):
+    pass
+
+
+def formatUUID(data):
+    """The LC_UUID bytes as dwarfdump prints them"""
+    digits = binascii.hexlify(data).decode().upper()
+    return u"-".join([digits[:8], digits[8:12], digits[12:16],
+                      digits[16:20], digits[20:]])
+
+
+class SliceInfo(object):
+
+    """cputype, arch name and LC_UUID of a thin Mach-O file"""
+    __slots__ = ("path", "cputype", "cpusubtype", "arch", "uuid", "size")
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(32)
+            if len(header) < 28:
+                raise FatError(u"{} is not a Mach-O file".format(path))
+            magic = struct.unpack("<I", header[:4])[0]
+            if magic == MH_MAGIC_64:
+                header_size = 32
+            elif magic == MH_MAGIC:
+                header_size = 28
+            else:
+                raise FatError(u"{} is not a thin Mach-O file".format(path))
+            self.cputype, self.cpusubtype, _, ncmds, cmds_size = \
+                struct.unpack_from("<iiIII", header, 4)
+            f.seek(header_size)
+            commands = f.read(cmds_size)
+            self.size = os.fstat(f.fileno()).st_size
+        self.arch = ARCH_NAMES.get(
+            (self.cputype, self.cpusubtype & ~CPU_SUBTYPE_MASK))
+        if self.arch is None:
+            raise FatError(u"Unknown cpu type {}/{} in {}".format(
+                self.cputype, self.cpusubtype, path))
+        self.uuid = None
+        cursor = 0
+        for _ in range(ncmds):
+            if cursor + 8 > len(commands):
+                break
+            cmd, cmd_size = struct.unpack_from("<II", commands, cursor)
+            if cmd == LC_UUID and cmd_size >= 24:
+                self.uuid = formatUUID(commands[cursor + 8:cursor + 24])
+                break
+            if cmd_size < 8:
+                break
+            cursor += cmd_size
+
+    @property
+    def align(self):
+        return PAGE_ALIGN.get(self.cputype, DEFAULT_ALIGN)
+
+
+def _bundleSize(f, offset):
+    """Size of the __LLVM,__bundle section of the slice at offset"""
+    f.seek(offset)
+    header = f.read(32)
+    if len(header) < 28:
+        return 0
+    magic = struct.unpack("<I", header[:4])[0]
+    if magic == MH_MAGIC_64:
+        header_size, segment_cmd, segment_size, section_size = \
+            32, LC_SEGMENT_64, 72, 80
+        size_format, size_offset = "<Q", 40
+    elif magic == MH_MAGIC:
+        header_size, segment_cmd, segment_size, section_size = \
+            28, LC_SEGMENT, 56, 68
+        size_format, size_offset = "<I", 36
+    else:
+        return 0
+    ncmds, cmds_size = struct.unpack_from("<II", header, 16)
+    f.seek(offset + header_size)
+    commands = f.read(cmds_size)
+    cursor = 0
+    for _ in range(ncmds):
+        if cursor + 8 > len(commands):
+            break
+        cmd, cmd_size = struct.unpack_from("<II", commands, cursor)
+        if cmd == segment_cmd and \
+                commands[cursor + 8:cursor + 24].rstrip(b"\0") == b"__LLVM":
+            nsects = struct.unpack_from(
+                "<I", commands, cursor + segment_size - 8)[0]
+            section = cursor + segment_size
+            for _ in range(nsects):
+                if section + section_size > len(commands):
+                    break
+                if commands[section:section + 16].rstrip(b"\0") == \
+                        b"__bundle":
+                    return struct.unpack_from(size_format, commands,
+                                              section + size_offset)[0]
+                section += section_size
+        if cmd_size < 8:
+            break
+        cursor += cmd_size
+    return 0
+
+
+def hasBitcode(path):
+    """Whether any slice of the Mach-O at path has a bitcode bundle
+
+    Slices with only the bitcode marker (a bundle of a single byte) don't
+    count.  Files that aren't Mach-O return False.
+    """
+    try:
+        with open(path, "rb") as f:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            magic, nfat_arch = FAT_HEADER.unpack(header)
+            if magic == FAT_MAGIC:
+                offsets = []
+                for _ in range(min(nfat_arch, 64)):
+                    entry = f.read(FAT_ARCH.size)
+                    if len(entry) < FAT_ARCH.size:
+                        return False
+                    offsets.append(FAT_ARCH.unpack(entry)[2])
+            else:
+                offsets = [0]
+            return any(_bundleSize(f, x) > 1 for x in offsets)
+    except (IOError, OSError, struct.error):
+        return False
+
+
+def _copyRange(src, dst, offset, size):
+    """Copy size bytes of src to dst at offset, in the kernel if possible"""
+    copied = 0
+    copy_file_range = getattr(os, "copy_file_range", None)
+    try:
+        while copied < size:
+            if copy_file_range is not None:
+                count = copy_file_range(src.fileno(), dst.fileno(),
+                                        size - copied, copied,
+                                        offset + copied)
+            else:
+                # sendfile writes at the current position of dst
+                dst.seek(offset + copied)
+                count = os.sendfile(dst.fileno(), src.fileno(), copied,
+                                    size - copied)
+            if count == 0:
+                break
+            copied += count
+    except (AttributeError, OSError):
+        # no kernel copy between these files (e.g. sendfile on darwin)
+        pass
+    if copied < size:
+        src.seek(copied)
+        dst.seek(offset + copied)
+        remaining = size - copied
+        while remaining > 0:
+            chunk = src.read(min(remaining, 1 << 20))
+            if not chunk:
+                raise FatError(u"{} was truncated".format(src.name))
+            dst.write(chunk)
+            remaining -= len(chunk)
+
+
+def writeFat(inputs, output):
+    """Combine the thin Mach-O files in inputs into a fat file at output
+
+    Slices are placed like lipo -create does, ordered by alignment and each
+    at an offset aligned for its cpu type.  Returns the SliceInfo of every
+    slice so callers get the UUIDs without reading the output again.
+    """
+    slices = [SliceInfo(x) for x in inputs]
+    seen = set()
+    for s in slices:
+        if (s.cputype, s.cpusubtype) in seen:
+            raise FatError(u"{} and another input have the same arch ({})"
+                           .format(s.path, s.arch))
+        seen.add((s.cputype, s.cpusubtype))
+    slices.sort(key=lambda x: x.align)
+    offset = FAT_HEADER.size + FAT_ARCH.size * len(slices)
+    layout = []
+    for s in slices:
+        alignment = 1 << s.align
+        offset = (offset + alignment - 1) & ~(alignment - 1)
+        layout.append(offset)
+        offset += s.size
+    if offset > 0xffffffff:
+        raise FatError(u"{} would need a 64 bit fat header".format(output))
+    header = FAT_HEADER.pack(FAT_MAGIC, len(slices)) + b"".join(
+        FAT_ARCH.pack(s.cputype, s.cpusubtype, slice_offset, s.size,
+                      s.align) for s, slice_offset in zip(slices, layout))
+    with open(output, "wb") as dst:
+        dst.write(header)
+        dst.truncate(offset)
+        dst.flush()
+        for s, slice_offset in zip(slices, layout):
+            with open(s.path, "rb") as src:
+                _copyRange(src, dst, slice_offset, s.size)
+    shutil.copymode(inputs[0], output)
+    return slices
@@ -0,0 +1,171 @@
+"""GNU make jobserver client and server
+
+A jobserver is a pipe (or, since make 4.4, a named fifo) holding one byte
+per job slot beyond the first.  Every process that takes part owns one
+implicit slot, and reads a byte to run each additional job and writes the
+same byte back once the job is done.  The pipe is advertised to child
+processes through MAKEFLAGS:
+
+  --jobserver-auth=R,W       inherited pipe file descriptors
+  --jobserver-auth=fifo:PATH named fifo (make 4.4)
+  --jobserver-fds=R,W        older spelling of the pipe form
+"""
+import errno
+import os
+import select
+import shlex
+import sys
+
+
+class JobServerClient(object):
+
+    """Take and return tokens of a jobserver"""
+
+    def __init__(self, read_fd, write_fd, fifo=None, makeflags=None):
+        self.read_fd = read_fd
+        self.write_fd = write_fd
+        self.fifo = fifo
+        self._makeflags = makeflags
+        self._nonblocking_fd = self._openNonBlocking()
+
+    @classmethod
+    def fromEnvironment(cls, environ=None):
+        """Connect to the jobserver named in MAKEFLAGS, if it is usable"""
+        if environ is None:
+            environ = os.environ
+        auth = None
+        try:
+            flags = shlex.split(environ.get("MAKEFLAGS", ""))
+        except ValueError:
+            return None
+        for flag in flags:
+            for prefix in ("--jobserver-auth=", "--jobserver-fds="):
+                if flag.startswith(prefix):
+                    auth = flag[len(prefix):]
+        if auth is None:
+            return None
+        if auth.startswith("fifo:"):
+            path = auth[5:]
+            try:
+                fd = os.open(path, os.O_RDWR)
+            except OSError:
+                return None
+            return cls(fd, fd, path, environ["MAKEFLAGS"])
+        try:
+            read_fd, write_fd = [int(x) for x in auth.split(",")]
+            # make doesn't pass the pipe to commands it doesn't think are
+            # recursive, the descriptors may be closed or reused
+            os.fstat(read_fd)
+            os.fstat(write_fd)
+        except (ValueError, OSError):
+            return None
+        if read_fd < 0 or write_fd < 0:
+            return None
+        return cls(read_fd, write_fd, makeflags=environ["MAKEFLAGS"])
+
+    def _openNonBlocking(self):
+        """A private non-blocking reader for taking optional tokens
+
+        O_NONBLOCK can't be set on the shared descriptors without
+        affecting every other process of the build (a dup shares it too),
+        so open the pipe again where the system allows it: a fifo
+        anywhere, an anonymous pipe only through /proc on Linux.
+        """
+        if self.fifo is not None:
+            path = self.fifo
+        elif sys.platform.startswith("linux"):
+            path = "/proc/self/fd/{}".format(self.read_fd)
+        else:
+            return None
+        try:
+            return os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            return None
+
+    @property
+    def pollable(self):
+        """Whether tryAcquire() can take tokens, acquire() blocks if not"""
+        return self._nonblocking_fd is not None
+
+    @property
+    def makeflags(self):
+        return self._makeflags
+
+    def childEnvironment(self):
+        """Environment additions that hand the jobserver to child tools"""
+        if self.makeflags is None:
+            return dict()
+        return {"MAKEFLAGS": self.makeflags}
+
+    @property
+    def pass_fds(self):
+        """Descriptors child processes need to join the jobserver"""
+        if self.fifo is not None:
+            return ()
+        return (self.read_fd, self.write_fd)
+
+    def acquire(self):
+        """Wait for a token, return it (b"" if the jobserver went away)"""
+        while True:
+            try:
+                return os.read(self.read_fd, 1)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    return b""
+                # someone else made the shared descriptor non-blocking
+                select.select([self.read_fd], [], [])
+
+    def tryAcquire(self):
+        """Take a token if one is free right now, None otherwise"""
+        if self._nonblocking_fd is None:
+            return None
+        try:
+            token = os.read(self._nonblocking_fd, 1)
+        except OSError:
+            return None
+        return token or None
+
+    def release(self, token):
+        if token:
+            os.write(self.write_fd, token)
+
+    def close(self):
+        if self._nonblocking_fd is not None:
+            os.close(self._nonblocking_fd)
+            self._nonblocking_fd = None
+        if self.fifo is not None:
+            os.close(self.read_fd)
+
+
+class JobServer(JobServerClient):
+
+    """A jobserver of our own with total slots, shared with child tools
+
+    Served through a named fifo, as make 4.4 does: it can be opened again
+    non-blocking on every system, an anonymous pipe only on Linux.
+    """
+
+    TOKEN = b"+"
+
+    def __init__(self, total):
+        import tempfile
+        self._fifo_dir = tempfile.mkdtemp(prefix="bitcode-jobserver")
+        path = os.path.join(self._fifo_dir, "fifo")
+        os.mkfifo(path, 0o600)
+        fd = os.open(path, os.O_RDWR)
+        # this process owns the implicit slot
+        os.write(fd, self.TOKEN * (max(1, total) - 1))
+        super(JobServer, self).__init__(fd, fd, path)
+        self.total = max(1, total)
+
+    @property
+    def makeflags(self):
+        return u"-j{} --jobserver-auth=fifo:{}".format(self.total, self.fifo)
+
+    def close(self):
+        super(JobServer, self).close()
+        try:
+            os.unlink(self.fifo)
+            os.rmdir(self._fifo_dir)
+        except OSError:
+            pass
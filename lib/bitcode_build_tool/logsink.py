@@ -0,0 +1,62 @@
+"""The log handlers of a build, written from a background thread"""
+import json
+import logging
+import logging.handlers
+import queue
+
+
+class JSONLinesFormatter(logging.Formatter):
+
+    """One JSON object per record, for --log-json
+
+    A tool run logs its Cmd, whose logFields() are the fields of the
+    record.
+    """
+
+    def format(self, record):
+        entry = {"time": record.created,
+                 "level": record.levelname.lower(),
+                 "thread": record.threadName}
+        fields = getattr(record.msg, "logFields", None)
+        if fields is not None:
+            entry.update(fields())
+        else:
+            entry["message"] = record.getMessage()
+        return json.dumps(entry, sort_keys=True)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        # formatted by the writer: rendering a tool run (its command line
+        # and output) is left off the build threads
+        return record
+
+
+class BufferedLog(object):
+
+    """Handlers fed through a queue by a background writer
+
+    The build threads only queue their records; the writer formats them
+    and writes them to the console, the --log-json file or the handler of
+    an api build.  close() writes what is left.
+    """
+
+    def __init__(self, handlers):
+        self.handlers = list(handlers)
+        self.level = min(x.level for x in self.handlers)
+        self.handler = _QueueHandler(queue.SimpleQueue())
+        self.handler.setLevel(self.level)
+        self._listener = logging.handlers.QueueListener(
+            self.handler.queue, *self.handlers, respect_handler_level=True)
+        self._listener.start()
+
+    def close(self):
+        if self._listener is None:
+            return
+        self._listener.stop()
+        self._listener = None
+        for handler in self.handlers:
+            handler.flush()
+            if isinstance(handler, logging.FileHandler):
+                handler.close()
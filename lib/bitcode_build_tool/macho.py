@@ -1,8 +1,9 @@
 import os
 import shutil
+import threading
 
 from . import cmdtool
-from .bundle import BitcodeBundle
+from .fat import FatError, SliceInfo, writeFat
 from .buildenv import env
 
 
@@ -61,18 +62,37 @@ class MachoType(object):
 class Macho(object):
 
     """Class represent a macho input"""
+    UUID_PLIST_TEMPLATE = u"""<?xml version="1.0" encoding="UTF-8"?>""" \
+                          """<!DOCTYPE plist PUBLIC""" \
+                          """ "-//Apple//DTD PLIST 1.0//EN" """ \
+                          """"http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<dict>
+   <key>DBGOriginalUUID</key>
+   <string>{UUID}</string>
+</dict>
+</plist>"""
 
-    def __init__(self, path):
+    def __init__(self, path, scratch_name=None):
         self.path = path
         self.name = os.path.basename(path)
         self._slice_cache = dict()
         self._bitcode_cache = dict()
-        self._temp_dir = env.createTempDirectory(prefix=self.name)
+        # binaries of an app built at once need names of their own, taken
+        # in any order they'd swap directories from one build to the next
+        self._temp_dir = env.createTempDirectory(
+            prefix=scratch_name or self.name)
         self.type = MachoType.getType(path)
         self.archs = MachoType.getArch(path)
         self.uuid = MachoType.getUUID(path)
         self.output_uuid = None
+        self.output_path = None
         self.output_slices = []
+        self.post_link = False
+        self._post_link_jobs = []
+        self._slice_dsyms = dict()
+        # installs the outputs, releasing their scratch space
+        self._owner = threading.current_thread()
 
     def getArchs(self):
         return self.archs
@@ -95,6 +115,7 @@ class Macho(object):
                 if extract_job.returncode != 0:
                     env.error(u"Cannot extract arch {} from {}".format(
                                                             arch, self.path))
+                env.scratch.track(extract_path)
                 self._slice_cache[arch] = extract_path
                 return extract_path
             else:
@@ -113,6 +134,9 @@ class Macho(object):
                 env.error(
                     u"Cannot extract bundle from {} ({})".format(
                         self.path, arch))
+            # the slice is only needed for its bundle
+            env.scratch.release(self._slice_cache.pop(arch, None))
+            env.scratch.track(extract_path)
             if os.stat(extract_path).st_size <= 1:
                 env.error(
                     u"Bundle only contains bitcode-marker {} ({})".format(
@@ -123,43 +147,129 @@ class Macho(object):
             return file
 
     def buildBitcode(self, arch):
+        # the bundle modules (xml, the verifiers) wait for bitcode to build
+        from .bundle import BitcodeBundle
         output_path = os.path.join(self._temp_dir, '{}.{}.out'.format(self.name, arch))
-        bundle = self.getXAR(arch)
-        env.setUUID(self.uuid[arch])
-        bitcode_bundle = BitcodeBundle(arch, bundle, output_path).run()
+        with env.profiler.phase("front-end extraction"):
+            bundle = self.getXAR(arch)
+        bitcode_bundle = BitcodeBundle(arch, bundle, output_path,
+                                       self.uuid[arch]).run()
+        env.scratch.release(self._bitcode_cache.pop(arch))
+        env.scratch.track(bitcode_bundle.output)
         self.output_slices.append(bitcode_bundle)
+        if self.post_link:
+            # finish this slice while the next arch is being built, the
+            # objects are kept for dsymutil until then
+            env.scratch.handOff(bitcode_bundle.dir)
+            self._post_link_jobs.append(env.thread_pool.apply_async(
+                self.postLinkSlice, (arch, bitcode_bundle),
+                error_callback=env.jobFailed))
+        else:
+            env.scratch.release(bitcode_bundle.dir)
         return bitcode_bundle
 
+    def setPostLink(self, generate_dsym=False, symbol_map=None,
+                    strip_swift=False):
+        """Run dsymutil, symbol maps and strip on each slice once linked"""
+        self.post_link = True
+        self.generate_dsym = generate_dsym
+        self.symbol_map = symbol_map
+        self.strip_swift = strip_swift
+
+    def postLinkSlice(self, arch, bundle):
+        """Generate the dSYM of a linked slice, then strip the slice"""
+        output = bundle.output
+        if self.generate_dsym:
+            dsym = output + ".dSYM"
+            try:
+                with env.profiler.phase("dsym"):
+                    cmdtool.Dsymutil(output, dsym).run()
+                    # the symbol map lookup needs the original UUID plist
+                    new_uuid = SliceInfo(output).uuid
+                    if new_uuid is None:
+                        env.error(u"Cannot get UUID of {}".format(output))
+                    self.writeDsymUUIDPlist(dsym, self.uuid[arch], new_uuid)
+                    if self.symbol_map is not None:
+                        cmdtool.DsymMap(dsym, self.symbol_map).run()
+            finally:
+                env.scratch.release(bundle.dir)
+            env.scratch.track(dsym, owner=self._owner)
+            self._slice_dsyms[output] = dsym
+        else:
+            env.scratch.release(bundle.dir)
+        with env.profiler.phase("strip"):
+            if bundle.is_executable:
+                cmdtool.StripSymbols(output).run()
+            else:
+                cmdtool.StripDebug(output, self.strip_swift).run()
+
+    def finishPostLink(self):
+        """Wait for the post-link work of every slice"""
+        jobs = self._post_link_jobs
+        self._post_link_jobs = []
+        for job in jobs:
+            job.get()
+
+    def installDsym(self, path, binary_path):
+        """Merge the per slice dSYMs into the dSYM bundle at path"""
+        dwarf_dir = os.path.join(path, "Contents", "Resources", "DWARF")
+        slice_dwarfs = []
+        for bundle in self.output_slices:
+            dsym = self._slice_dsyms[bundle.output]
+            for root, _, files in os.walk(dsym):
+                rel = os.path.relpath(root, dsym)
+                if rel == os.path.join("Contents", "Resources", "DWARF"):
+                    slice_dwarfs.extend(os.path.join(root, x) for x in files)
+                    continue
+                target_dir = os.path.join(path, rel)
+                if not os.path.isdir(target_dir):
+                    os.makedirs(target_dir)
+                for name in files:
+                    shutil.copyfile(os.path.join(root, name),
+                                    os.path.join(target_dir, name))
+        if not os.path.isdir(dwarf_dir):
+            os.makedirs(dwarf_dir)
+        dwarf = os.path.join(dwarf_dir, os.path.basename(binary_path))
+        if len(slice_dwarfs) == 1:
+            shutil.copyfile(slice_dwarfs[0], dwarf)
+        else:
+            self.writeFat(slice_dwarfs, dwarf)
+        for dsym in self._slice_dsyms.values():
+            env.scratch.release(dsym)
+
+    @staticmethod
+    def writeFat(inputs, output):
+        """Combine thin files into output, return the slice infos"""
+        try:
+            return writeFat(inputs, output)
+        except (IOError, OSError, FatError) as e:
+            env.error(u"Cannot create {}: {}".format(output, e))
+
     def installOutput(self, path):
+        self.output_path = path
         if len(self.output_slices) == 0:
             env.error("Install failed: no bitcode build yet")
         elif len(self.output_slices) == 1:
             try:
+                slices = [SliceInfo(self.output_slices[0].output)]
                 shutil.move(self.output_slices[0].output, path)
-            except IOError:
+            except (IOError, FatError):
                 env.error(u"Install failed: can't create {}".format(path))
         else:
-            cmdtool.LipoCreate([x.output for x in self.output_slices],
-                               path).run()
-        self.output_uuid = MachoType.getUUID(path)
+            slices = self.writeFat([x.output for x in self.output_slices],
+                                   path)
+        for bundle in self.output_slices:
+            env.scratch.release(bundle.output)
+        self.output_uuid = dict((x.arch, x.uuid) for x in slices)
 
     @property
     def is_executable(self):
+        from .bundle import BitcodeBundle
         return all([isinstance(x, BitcodeBundle) and x.is_executable
                     for x in self.output_slices])
 
     def writeDsymUUIDMap(self, bundle_path):
         resource_dir = os.path.join(bundle_path, "Contents", "Resources")
-        plist_template = u"""<?xml version="1.0" encoding="UTF-8"?>""" \
-                         """<!DOCTYPE plist PUBLIC""" \
-                         """ "-//Apple//DTD PLIST 1.0//EN" """ \
-                         """"http://www.apple.com/DTDs/PropertyList-1.0.dtd">
-<plist version="1.0">
-<dict>
-   <key>DBGOriginalUUID</key>
-   <string>{UUID}</string>
-</dict>
-</plist>"""
         if not os.access(resource_dir, os.W_OK):
             env.error(u"Dsym bundle not writeable: {}".format(bundle_path))
         for arch in self.archs:
@@ -171,6 +281,15 @@ class Macho(object):
                     new_uuid = self.output_uuid[arch]
             except KeyError:
                 env.error("Cannot generate uuid map in dsym bundle")
-            with open(os.path.join(resource_dir, new_uuid + ".plist"),
-                      "w") as f:
-                f.write(plist_template.format(UUID=old_uuid))
+            if new_uuid is None:
+                env.error(u"Cannot get UUID of {} ({})".format(
+                    self.output_path, arch))
+            self.writeDsymUUIDPlist(bundle_path, old_uuid, new_uuid)
+
+    @staticmethod
+    def writeDsymUUIDPlist(bundle_path, old_uuid, new_uuid):
+        resource_dir = os.path.join(bundle_path, "Contents", "Resources")
+        if not os.access(resource_dir, os.W_OK):
+            env.error(u"Dsym bundle not writeable: {}".format(bundle_path))
+        with open(os.path.join(resource_dir, new_uuid + ".plist"), "w") as f:
+            f.write(Macho.UUID_PLIST_TEMPLATE.format(UUID=old_uuid))
@@ -5,9 +5,12 @@ import sys
 import os
 import argparse
 
-from . import cmdtool
-from .macho import Macho, MachoType
-from .buildenv import env
+from .buildenv import env, BitcodeBuildFailure
+from .executor import EXECUTORS
+
+# The modules of the build itself (macho, bundle, app and what they import)
+# are imported by the functions using them, so --help and the errors found
+# while parsing the command line don't pay for them.
 
 
 def parse_args(args):
@@ -17,10 +20,13 @@ def parse_args(args):
         description="Recompile MachO from bitcode.", )
 
     parser.add_argument("input_macho_file", type=str,
-                        help="The input MachO file contains bitcode section")
+                        help="The input MachO file contains bitcode section, "
+                        "or an .ipa/.app to rebuild all of its MachO files")
 
     parser.add_argument("-o", "--output", type=str, dest="output",
-                        default="a.out", help="Output file")
+                        default="a.out",
+                        help="Output file (the repacked .ipa/.app for "
+                        "application inputs)")
     parser.add_argument("-L", "--library", action="append", dest="include",
                         default=[], help="Dylib search path")
     parser.add_argument("-t", "--tool", action="append", dest="tool_path",
@@ -28,7 +34,8 @@ def parse_args(args):
     parser.add_argument("--sdk", type=str, dest="sdk_path",
                         help="SDK path")
     parser.add_argument("--generate-dsym", type=str, dest="dsym_output",
-                        help="Generate dSYM for the binary and output to path")
+                        help="Generate dSYM for the binary and output to path "
+                        "(a directory of dSYMs for application inputs)")
     parser.add_argument("--library-list", type=str, dest="library_list",
                         help="A list of dynamic libraries to link against")
     parser.add_argument("--symbol-map", type=str, dest="symbol_map",
@@ -45,16 +52,252 @@ def parse_args(args):
     parser.add_argument("-j", "--threads", metavar="N", type=int,
                         default=1, dest="j",
                         help="How many jobs to execute at once. (default=1)")
+    parser.add_argument("--jobserver", action="store_true",
+                        help="Share the -j slots with the tools through a "
+                        "GNU make jobserver (a jobserver in MAKEFLAGS is "
+                        "always joined)")
+    parser.add_argument("-k", "--keep-going", action="store_true",
+                        dest="keep_going",
+                        help="Keep running the other jobs after one fails, "
+                        "to see every error")
+    parser.add_argument("--cache-dir", type=str, dest="cache_dir",
+                        default=None,
+                        help="Directory for caches kept between builds "
+                        "(compiled objects, LTO code generation, ...)")
+    parser.add_argument("--cache-size", metavar="MB", type=int,
+                        dest="cache_size", default=None,
+                        help="Prune the caches to this many megabytes")
+    parser.add_argument("--remote-cache", metavar="URL", type=str,
+                        dest="remote_cache", default=None,
+                        help="HTTP cache server shared between machines, "
+                        "used behind the --cache-dir caches")
+    parser.add_argument("--remote-cache-timeout", metavar="SECONDS",
+                        type=float, dest="remote_cache_timeout", default=5.0,
+                        help="Build locally when the remote cache takes "
+                        "longer than this (default=5)")
+    parser.add_argument("--max-scratch", metavar="MB", type=int,
+                        dest="max_scratch", default=None,
+                        help="Hold back bundle extraction while the "
+                        "intermediate files would take more than this many "
+                        "megabytes")
     parser.add_argument("--liblto", type=str, dest="liblto", default=None,
                         help="libLTO.dylib path to overwrite the default")
+    parser.add_argument("--speculative-swift-rebuild", action="store_true",
+                        dest="speculative_swift",
+                        help="Build swift bundles with optimization on the "
+                        "idle -j slots as well, so the optimized rebuild of "
+                        "a failing link is ready when needed")
+    parser.add_argument("--compiler-launcher", metavar="CMD", type=str,
+                        dest="compiler_launcher", default=None,
+                        help="Run the compile commands (clang -cc1, swift "
+                        "-frontend) behind this wrapper, e.g. a remote "
+                        "execution client")
+    parser.add_argument("--linker-launcher", metavar="CMD", type=str,
+                        dest="linker_launcher", default=None,
+                        help="Run the link commands behind this wrapper")
+    parser.add_argument("--exec-backend", dest="exec_backend",
+                        choices=sorted(EXECUTORS), default="subprocess",
+                        help="How tools are launched: supervised by an "
+                        "asyncio event loop, by one thread each, or through "
+                        "a small spawn server that avoids forking a large "
+                        "process (default=subprocess)")
+    parser.add_argument("--job-timeout", metavar="SECONDS", type=float,
+                        dest="job_timeout", default=None,
+                        help="Kill and fail a tool running longer than this")
+    parser.add_argument("--resource-report", action="store_true",
+                        dest="resource_report",
+                        help="Write the CPU time, peak memory and file sizes "
+                        "of every tool run, added up per bundle and per "
+                        "tool, to OUTPUT.resources.json")
+    parser.add_argument("--time-report", action="store_true",
+                        dest="time_report",
+                        help="Have the compilers and the LTO link report "
+                        "their pass timings, log the slowest members and "
+                        "passes and write them all to "
+                        "OUTPUT.time-report.json")
+    parser.add_argument("--log-json", metavar="PATH", type=str,
+                        dest="log_json", default=None,
+                        help="Write every log record, and every tool run "
+                        "with its command line and output, to PATH as JSON "
+                        "lines")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile the build and write OUTPUT.prof and "
+                        "OUTPUT.profile.json")
     parser.add_argument("--compile-swift-with-clang", action="store_true",
                         dest="compile_with_clang", help=argparse.SUPPRESS)
 
+    # collect the per-phase metrics without cProfile (api builds)
+    parser.set_defaults(metrics=False)
+
     args = parser.parse_args(args[1:])
+    if args.job_timeout is not None and args.exec_backend == "spawn-server":
+        parser.error("--job-timeout is not supported by the spawn-server "
+                     "backend")
 
     return args
 
 
+def buildMacho(args, input_path, output, dsym_output, scratch_name=None):
+    """Rebuild a single Mach-O file from its bitcode
+
+    scratch_name names its directory of intermediates, the file name by
+    default.
+    """
+    from .macho import Macho, MachoType
+    with env.profiler.phase("front-end extraction"):
+        input_macho = Macho(input_path, scratch_name)
+    if input_macho == MachoType.Error:
+        env.error(u"Input is not a macho file: {}".format(input_path))
+
+    if not args.verify:
+        input_macho.setPostLink(dsym_output is not None,
+                                args.symbol_map, args.strip_swift)
+    for arch in input_macho.getArchs():
+        input_macho.buildBitcode(arch)
+
+    if (dsym_output is not None and
+        not any([x.contain_symbols for x in input_macho.output_slices]) and
+            args.symbol_map is None):
+        env.warning(
+            "Cannot generate useful dsym from input macho file: {}".format(
+                input_path))
+
+    if not args.verify:
+        # dSYMs, symbol maps and strip ran per slice as they linked
+        input_macho.finishPostLink()
+        with env.profiler.phase("lipo"):
+            input_macho.installOutput(output)
+
+        if dsym_output is not None:
+            with env.profiler.phase("dsym"):
+                input_macho.installDsym(dsym_output, output)
+                input_macho.writeDsymUUIDMap(dsym_output)
+    return input_macho
+
+
+def buildApp(args):
+    """Rebuild every bitcode Mach-O of an .ipa or .app at once
+
+    All the binaries share the -j job slots, the thread pool and the
+    caches, so one binary linking doesn't leave the host idle and several
+    compiling don't oversubscribe it.
+    """
+    from multiprocessing.pool import ThreadPool
+    from .app import AppBundle
+    if args.symbol_map is not None and not os.path.isdir(args.symbol_map):
+        env.error("--symbol-map must be a directory for .ipa and .app inputs")
+    app = AppBundle(args.input_macho_file)
+    app.stage(None if args.verify else args.output)
+    binaries = app.findBinaries()
+    if len(binaries) == 0:
+        env.error(u"No bitcode found in {}".format(args.input_macho_file))
+    env.log(u"Rebuilding {} binaries".format(len(binaries)))
+    dsym_names = app.dsymNames(binaries)
+
+    failures = []
+
+    def build(path):
+        rel_path = app.relativePath(path)
+        dsym_output = None
+        if args.dsym_output is not None and not args.verify:
+            dsym_output = os.path.join(args.dsym_output, dsym_names[path])
+        mode = os.stat(path).st_mode
+        try:
+            buildMacho(args, path, path, dsym_output,
+                       rel_path.replace(os.sep, "_"))
+        except BitcodeBuildFailure as e:
+            # the other binaries may be waiting for its scratch space
+            env.scratch.abandon()
+            env.jobFailed(e)
+            if not args.keep_going:
+                raise
+            failures.append(rel_path)
+            return None
+        if not args.verify:
+            os.chmod(path, mode)
+        return rel_path
+
+    # the binaries are driven from their own threads; their compile jobs
+    # still go through env.thread_pool and hold the shared job slots
+    pool = ThreadPool(max(1, min(len(binaries), env.jobs)),
+                      initializer=env.bindThread)
+    try:
+        for rel_path in pool.imap_unordered(build, binaries):
+            if rel_path is not None:
+                env.log(u"Rebuilt {}".format(rel_path))
+    finally:
+        pool.close()
+        pool.join()
+    if len(failures) > 0:
+        env.error(u"Failed to rebuild: {}".format(", ".join(failures)))
+    if not args.verify:
+        app.repack(args.output)
+
+
+def run(args):
+    """Build with an initialized env"""
+    from .app import AppBundle
+    env.profiler.start()
+
+    if not os.path.exists(args.input_macho_file):
+        env.error(
+            u"Input macho file doesn't exist: {}".format(
+                args.input_macho_file))
+    if args.symbol_map is not None and args.dsym_output is None:
+        env.error("--symbol-map can only be used "
+                  "together with --generate-dsym")
+    if args.symbol_map is not None and not os.path.exists(args.symbol_map):
+        env.error(u"path passed to --symbol-map doesn't exists: {}".format(
+                args.symbol_map))
+
+    if AppBundle.isApp(args.input_macho_file):
+        buildApp(args)
+    else:
+        buildMacho(args, args.input_macho_file, args.output,
+                   args.dsym_output)
+
+
+def finish(args):
+    """Release everything env holds for the build
+
+    Runs after a build that failed anywhere, initialization included: every
+    step skips what was never set up, and the log is written out whatever
+    happens.
+    """
+    try:
+        env.closeCaches()
+        env.cleanupTempDirectories()
+        env.shutdownExecutor()
+        writeReports(args)
+    finally:
+        env.closeLog()
+
+
+def writeReports(args):
+    """Log the --profile summary and write the reports asked for"""
+    if env.profiler is not None:
+        env.profiler.stop()
+        if args.profile:
+            env.log(env.profiler.summary())
+            for path in env.profiler.write(args.output):
+                env.log(u"Profile written to {}".format(path))
+    for report, name in ((env.usage, "resource report"),
+                         (env.time_report, "time report")):
+        if report is None:
+            continue
+        try:
+            path = report.write(args.output)
+        except (IOError, OSError) as e:
+            env.warning(u"Cannot write the {}: {}".format(name, e))
+        else:
+            env.log(u"{} written to {}".format(name.capitalize(), path))
+    if env.time_report is not None:
+        env.log(env.time_report.summary())
+    summary = env.commandSummary()
+    if summary is not None:
+        env.log(summary)
+
+
 def main(args=None):
     """Run the program, can override args for testing."""
     if args is None:
@@ -63,49 +306,16 @@ def main(args=None):
 
     try:
         env.initState(args)
+        run(args)
+    except BaseException:
+        # the reason the build stopped wins over a failing teardown
+        try:
+            finish(args)
+        except Exception:
+            pass
+        raise
+    finish(args)
 
-        if not os.path.isfile(args.input_macho_file):
-            env.error(
-                u"Input macho file doesn't exist: {}".format(
-                    args.input_macho_file))
-        if args.symbol_map is not None and args.dsym_output is None:
-            env.error("--symbol-map can only be used "
-                      "together with --generate-dsym")
-        if args.symbol_map is not None and not os.path.exists(args.symbol_map):
-            env.error(u"path passed to --symbol-map doesn't exists: {}".format(
-                    args.symbol_map))
-
-        input_macho = Macho(args.input_macho_file)
-        if input_macho == MachoType.Error:
-            env.error(u"Input is not a macho file: {}".format(
-                    args.input_macho_file))
-
-        for arch in input_macho.getArchs():
-            input_macho.buildBitcode(arch)
-
-        if (args.dsym_output is not None and
-            not any([x.contain_symbols for x in input_macho.output_slices]) and
-                args.symbol_map is None):
-            env.warning(
-                "Cannot generate useful dsym from input macho file: {}".format(args.input_macho_file))
-
-        if not args.verify:
-            input_macho.installOutput(args.output)
-
-            if args.dsym_output is not None:
-                cmdtool.Dsymutil(args.output, args.dsym_output).run()
-                input_macho.writeDsymUUIDMap(args.dsym_output)
-
-            if args.symbol_map is not None:
-                cmdtool.DsymMap(args.dsym_output, args.symbol_map).run()
-
-            # always strip the output
-            if input_macho.is_executable:
-                cmdtool.StripSymbols(args.output).run()
-            else:
-                cmdtool.StripDebug(args.output, args.strip_swift).run()
-    finally:
-        env.cleanupTempDirectories()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,209 @@
+"""Break the build time down by phase for --profile"""
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PhaseStats(object):
+
+    """Time accumulated by one phase"""
+
+    def __init__(self, name):
+        self.name = name
+        self.wall = 0.0
+        self.cpu = 0.0
+        # the part of wall during which no tool of the build was running
+        self.in_process_wall = 0.0
+        self.tool_wall = 0.0
+        self.tool_cpu = 0.0
+        self.tool_count = 0
+
+    def toJSON(self):
+        return {"wall": self.wall,
+                "cpu": self.cpu,
+                "in_process_wall": self.in_process_wall,
+                "tool_wall": self.tool_wall,
+                "tool_cpu": self.tool_cpu,
+                "tool_count": self.tool_count}
+
+
+class BuildProfiler(object):
+
+    """Record cProfile data and per-phase wall/CPU time
+
+    Phases nest; time is charged to the innermost phase only, so the phase
+    wall times add up to the total.  Subprocess time is charged to the phase
+    the command belongs to, whichever thread ran it.  The in-process wall
+    time of a phase is the part of its wall time when no tool at all was
+    running: tools run in parallel, their summed wall time says nothing of
+    how long the orchestrator kept the build waiting.  cProfile only covers
+    the thread that called start().
+    """
+    PHASES = ["front-end extraction", "xar extraction", "job construction",
+              "compile", "link", "lipo", "dsym", "strip", "toolchain probe",
+              "other"]
+
+    def __init__(self, enabled=False, cprofile=True):
+        self.enabled = enabled
+        self.cprofile = cprofile
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._stats = dict((x, PhaseStats(x)) for x in self.PHASES)
+        self._profile = None
+        self._start = None
+        # tools running, and the time none was accumulated up to _idle_since
+        self._running = 0
+        self._idle = 0.0
+        self._idle_since = time.time()
+
+    def _stat(self, name):
+        try:
+            return self._stats[name]
+        except KeyError:
+            return self._stats.setdefault(name, PhaseStats(name))
+
+    def _clock(self):
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        now = time.time()
+        with self._lock:
+            idle = self._idle
+            if self._running == 0:
+                idle += now - self._idle_since
+        return (now, time.process_time(),
+                children.ru_utime + children.ru_stime, idle)
+
+    def _charge(self, name, since):
+        now = self._clock()
+        with self._lock:
+            stat = self._stat(name)
+            stat.wall += now[0] - since[0]
+            stat.cpu += now[1] - since[1]
+            stat.tool_cpu += now[2] - since[2]
+            stat.in_process_wall += now[3] - since[3]
+        return now
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._start = self._clock()
+        self._stack().append(["other", self._start])
+        if self.cprofile:
+            import cProfile
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stop(self):
+        if not self.enabled or self._start is None:
+            return
+        if self._profile is not None:
+            self._profile.disable()
+        stack = self._stack()
+        while stack:
+            name, since = stack.pop()
+            self._charge(name, since)
+
+    @contextmanager
+    def phase(self, name):
+        """Charge the time spent in the block to the named phase"""
+        if not self.enabled:
+            yield
+            return
+        stack = self._stack()
+        if stack:
+            stack[-1][1] = self._charge(stack[-1][0], stack[-1][1])
+        stack.append([name, self._clock()])
+        try:
+            yield
+        finally:
+            name, since = stack.pop()
+            now = self._charge(name, since)
+            if stack:
+                stack[-1][1] = now
+
+    @contextmanager
+    def subprocess(self, name):
+        """Record a tool invocation belonging to the named phase"""
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        with self._lock:
+            if self._running == 0:
+                self._idle += start - self._idle_since
+            self._running += 1
+        try:
+            yield
+        finally:
+            end = time.time()
+            with self._lock:
+                self._running -= 1
+                if self._running == 0:
+                    self._idle_since = end
+                stat = self._stat(name)
+                stat.tool_wall += end - start
+                stat.tool_count += 1
+
+    def summary(self):
+        """Return the per-phase table as a string"""
+        rows = [x for x in self._stats.values()
+                if x.wall > 0 or x.tool_count > 0]
+        header = u"{:<22} {:>9} {:>9} {:>11} {:>9} {:>9} {:>6}".format(
+            "phase", "wall", "cpu", "in-process", "tool", "tool cpu",
+            "tools")
+        lines = [header, u"-" * len(header)]
+        total = PhaseStats("total")
+        for stat in rows:
+            data = stat.toJSON()
+            lines.append(u"{:<22} {:>9.3f} {:>9.3f} {:>11.3f} {:>9.3f} "
+                         "{:>9.3f} {:>6}".format(
+                             stat.name, data["wall"], data["cpu"],
+                             data["in_process_wall"], data["tool_wall"],
+                             data["tool_cpu"], data["tool_count"]))
+            total.wall += stat.wall
+            total.cpu += stat.cpu
+            total.in_process_wall += stat.in_process_wall
+            total.tool_wall += stat.tool_wall
+            total.tool_cpu += stat.tool_cpu
+            total.tool_count += stat.tool_count
+        data = total.toJSON()
+        lines.append(u"-" * len(header))
+        lines.append(u"{:<22} {:>9.3f} {:>9.3f} {:>11.3f} {:>9.3f} "
+                     "{:>9.3f} {:>6}".format(
+                         total.name, data["wall"], data["cpu"],
+                         data["in_process_wall"], data["tool_wall"],
+                         data["tool_cpu"], data["tool_count"]))
+        return u"\n".join(lines)
+
+    def toJSON(self):
+        phases = dict((x.name, x.toJSON()) for x in self._stats.values()
+                      if x.wall > 0 or x.tool_count > 0)
+        cpu = sum(x["cpu"] for x in phases.values())
+        tool_cpu = sum(x["tool_cpu"] for x in phases.values())
+        return {"phases": phases,
+                "wall": sum(x["wall"] for x in phases.values()),
+                "cpu": cpu,
+                "in_process_wall": sum(x["in_process_wall"]
+                                       for x in phases.values()),
+                "tool_cpu": tool_cpu,
+                "tool_wall": sum(x["tool_wall"] for x in phases.values()),
+                "tool_count": sum(x["tool_count"] for x in phases.values())}
+
+    def write(self, prefix):
+        """Write prefix.prof (cProfile) and prefix.profile.json"""
+        if not self.enabled or self._profile is None:
+            return []
+        prof_path = prefix + ".prof"
+        json_path = prefix + ".profile.json"
+        self._profile.dump_stats(prof_path)
+        import json
+        with open(json_path, "w") as f:
+            json.dump(self.toJSON(), f, indent=2, sort_keys=True)
+        return [prof_path, json_path]
@@ -0,0 +1,208 @@
+"""Job slot accounting behind -j"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class JobSlots(object):
+
+    """Pool of -j tokens shared by everything that runs a tool
+
+    A compile holds one slot while its tool runs; a multi-threaded tool (the
+    LTO link) holds one slot per thread it is allowed to use, so the host is
+    never asked to run more than -j threads of work at once.
+
+    With a jobserver the slots also have to be backed by its tokens: the
+    first slot is the implicit one every process of the build owns, each
+    other slot in use holds a token read from the jobserver.
+
+    Coroutines of the asyncio engine wait for slots with acquireAsync(),
+    which doesn't block the event loop.
+
+    Speculative work asks for idle_only slots: it only gets the slots no
+    other job is waiting for.  Without a jobserver these slots are only
+    lent, regular work takes them back at once (running next to the
+    speculative tool until it exits) so it is never held up by speculation.
+    Up to twice -j tools may then run for a while, -j regular ones and -j
+    speculative ones; no new speculative tool starts until regular work
+    leaves slots idle again.
+    """
+    # how often a coroutine retries the jobserver, whose tokens come back
+    # without notice from other processes
+    JOBSERVER_POLL = 0.05
+
+    def __init__(self, total, jobserver=None):
+        self.total = max(1, total)
+        self.jobserver = jobserver
+        self._available = self.total
+        self._implicit_free = True
+        self._tokens = []
+        self._cond = threading.Condition()
+        # futures of the waiting coroutines, first come first woken
+        self._waiters = OrderedDict()
+        self._idle_waiters = OrderedDict()
+        # threads waiting in acquire(), idle_only ones excluded
+        self._blocked = 0
+        # slots lent to idle_only work
+        self._lent = 0
+        # threads of the coroutines waiting for jobserver tokens, when the
+        # jobserver can't be polled
+        self._token_threads = None
+
+    @property
+    def available(self):
+        with self._cond:
+            return self._available
+
+    def _free(self, idle_only):
+        """Slots free for the caller, with the lock held"""
+        if not idle_only:
+            return self._available
+        if self._blocked > 0 or self._waiters:
+            return 0
+        return max(0, self._available - self._lent)
+
+    def _lends(self, idle_only):
+        # lent slots are taken back by regular work, which may run next to
+        # them: up to 2 * total tools at once
+        return idle_only and self.jobserver is None
+
+    def acquire(self, count=1, minimum=None, idle_only=False):
+        """Take up to count slots, waiting until at least minimum are free
+
+        Returns the number of slots taken.
+        """
+        count = min(max(0, count), self.total)
+        if minimum is None:
+            minimum = count
+        minimum = min(minimum, count)
+        if count == 0:
+            return 0
+        blocked = 0 if idle_only else 1
+        with self._cond:
+            while self._free(idle_only) < minimum:
+                self._blocked += blocked
+                try:
+                    self._cond.wait()
+                finally:
+                    self._blocked -= blocked
+            granted = min(count, self._free(idle_only))
+            if self._lends(idle_only):
+                self._lent += granted
+                return granted
+            self._available -= granted
+            if self.jobserver is None or granted == 0:
+                return granted
+            implicit = 1 if self._implicit_free else 0
+            self._implicit_free = False
+        # back the rest with jobserver tokens, waiting only for the
+        # minimum and taking the others if they are free right now
+        tokens = []
+        for _ in range(max(0, minimum - implicit)):
+            tokens.append(self.jobserver.acquire())
+        for _ in range(granted - implicit - len(tokens)):
+            token = self.jobserver.tryAcquire()
+            if token is None:
+                break
+            tokens.append(token)
+        with self._cond:
+            self._tokens.extend(tokens)
+            unused = granted - implicit - len(tokens)
+            if unused > 0:
+                self._available += unused
+                self._cond.notify_all()
+        return granted - unused
+
+    async def acquireAsync(self, count=1, idle_only=False):
+        """Coroutine taking up to count slots, waiting until one is free
+
+        Returns the number of slots taken.
+        """
+        if count <= 0:
+            return 0
+        import asyncio
+        if self.jobserver is not None and not self.jobserver.pollable:
+            return await self._acquireOnThread(count, idle_only)
+        granted = self.acquire(count, 0, idle_only)
+        loop = asyncio.get_running_loop()
+        waiters = self._idle_waiters if idle_only else self._waiters
+        while granted == 0:
+            future = loop.create_future()
+            with self._cond:
+                waiters[future] = loop
+            try:
+                # a release may have come before the waiter was registered
+                granted = self.acquire(count, 0, idle_only)
+                if granted == 0:
+                    timeout = None
+                    if self.jobserver is not None:
+                        timeout = self.JOBSERVER_POLL
+                    await asyncio.wait([future], timeout=timeout)
+                    granted = self.acquire(count, 0, idle_only)
+            finally:
+                with self._cond:
+                    waiters.pop(future, None)
+        return granted
+
+    async def _acquireOnThread(self, count, idle_only):
+        """acquireAsync() with a jobserver tryAcquire() can't take tokens
+        from: wait for a token with acquire() on a thread of its own"""
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        with self._cond:
+            if self._token_threads is None:
+                # at most total waits can be served at once
+                self._token_threads = ThreadPoolExecutor(
+                    self.total, thread_name_prefix="bitcode-build-jobserver")
+        future = asyncio.get_running_loop().run_in_executor(
+            self._token_threads, self.acquire, count, 1, idle_only)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # the thread still gets the slots, give them back then
+            future.add_done_callback(
+                lambda x: x.cancelled() or x.exception() is not None or
+                self.release(x.result(), idle_only))
+            raise
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
+
+    def release(self, count=1, idle_only=False):
+        if count <= 0:
+            return
+        tokens = []
+        with self._cond:
+            if self._lends(idle_only):
+                self._lent -= count
+            else:
+                self._available = min(self.total, self._available + count)
+            if self.jobserver is not None:
+                for _ in range(count):
+                    if self._tokens:
+                        tokens.append(self._tokens.pop())
+                    else:
+                        self._implicit_free = True
+            self._cond.notify_all()
+            woken = min(count, len(self._waiters))
+            for _ in range(woken):
+                future, loop = self._waiters.popitem(last=False)
+                loop.call_soon_threadsafe(self._wake, future)
+            # speculative work gets what nobody else waits for
+            if self._blocked == 0 and not self._waiters:
+                for _ in range(min(count - woken, len(self._idle_waiters))):
+                    future, loop = self._idle_waiters.popitem(last=False)
+                    loop.call_soon_threadsafe(self._wake, future)
+        for token in tokens:
+            self.jobserver.release(token)
+
+    @contextmanager
+    def hold(self, count=1, minimum=None, idle_only=False):
+        """Hold slots for the duration of the block, yield how many"""
+        granted = self.acquire(count, minimum, idle_only)
+        try:
+            yield granted
+        finally:
+            self.release(granted, idle_only)
@@ -0,0 +1,229 @@
+"""Scratch directory layout, reference counted intermediates and the
+--max-scratch budget"""
+import errno
+import os
+import shutil
+import threading
+
+
+def inputDigest(path):
+    """Hex digest naming the scratch root of a build of path
+
+    The content of a file, the names, sizes and modification times of the
+    files of a directory (.app).
+    """
+    import hashlib
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                try:
+                    st = os.lstat(full)
+                except OSError:
+                    continue
+                digest.update(u"{}\0{}\0{}\n".format(
+                    os.path.relpath(full, path), st.st_size,
+                    st.st_mtime_ns).encode("utf-8"))
+        return digest.hexdigest()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    except (IOError, OSError):
+        digest.update(os.path.abspath(path).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def makeDirectory(parent, name):
+    """Create parent/name, or name-1, name-2, ... if taken, return it
+
+    The names only depend on the order the directories of parent are
+    created in, so a build lays its scratch space out the same way every
+    time.
+    """
+    path = os.path.join(parent, name)
+    index = 0
+    while True:
+        try:
+            os.mkdir(path, 0o700)
+            return path
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        index += 1
+        path = os.path.join(parent, u"{}-{}".format(name, index))
+
+
+def diskSize(path):
+    """Bytes used by the file or directory tree at path"""
+    try:
+        if not os.path.isdir(path) or os.path.islink(path):
+            return os.lstat(path).st_size
+    except OSError:
+        return 0
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class ScratchSpace(object):
+
+    """Intermediate files of a build, deleted once their last user is done
+
+    An intermediate is tracked with the number of its consumers and each
+    consumer releases it when done: an extracted slice once its bundle is
+    extracted, a bitcode member once its object is built, the extracted
+    bundle (objects included) once it is linked.  Files created inside a
+    tracked directory are accounted to it with grow().
+
+    With a budget (max_bytes), reserve() holds an extraction back while the
+    scratch space in use plus the extraction would go over it, for as long
+    as another thread of the build still has intermediates to release.
+    """
+    # how often a waiting extraction checks for a cancelled build
+    POLL = 0.5
+
+    def __init__(self, max_bytes=None, keep=False, cancelled=None):
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.cancelled = cancelled
+        self.peak = 0
+        self._used = 0
+        self._entries = dict()
+        self._waiting = set()
+        self._cond = threading.Condition()
+
+    @property
+    def used(self):
+        with self._cond:
+            return self._used
+
+    def _add(self, size):
+        self._used += size
+        self.peak = max(self.peak, self._used)
+
+    def track(self, path, consumers=1, owner=None):
+        """Account path to the scratch space until released consumers times
+
+        The owner thread (the current one by default) is the one releasing
+        it, or waiting for it to be released.
+        """
+        size = diskSize(path)
+        with self._cond:
+            entry = self._entries.get(path)
+            if entry is not None:
+                entry[0] += consumers
+                return
+            self._entries[path] = [consumers, size,
+                                   owner or threading.current_thread()]
+            self._add(size)
+
+    def retain(self, path, consumers=1):
+        """Add consumers to a tracked intermediate"""
+        with self._cond:
+            entry = self._entries.get(path)
+            if entry is not None:
+                entry[0] += consumers
+
+    def handOff(self, path):
+        """path is now released by work that never waits for the budget"""
+        with self._cond:
+            entry = self._entries.get(path)
+            if entry is not None:
+                entry[2] = None
+
+    def grow(self, path, size):
+        """Account size more bytes (less if negative) to the tracked path"""
+        with self._cond:
+            entry = self._entries.get(path)
+            if entry is None:
+                return
+            size = max(size, -entry[1])
+            entry[1] += size
+            self._add(size)
+            if size < 0:
+                self._cond.notify_all()
+
+    def release(self, path):
+        """One consumer of path is done, delete it after the last one"""
+        with self._cond:
+            entry = self._entries.get(path)
+            if entry is None:
+                return
+            entry[0] -= 1
+            if entry[0] > 0:
+                return
+            del self._entries[path]
+        self._drop(path, entry)
+
+    def abandon(self):
+        """Delete what the current thread tracks, its build failed"""
+        me = threading.current_thread()
+        with self._cond:
+            dropped = [(path, entry) for path, entry in self._entries.items()
+                       if entry[2] is me]
+            for path, _ in dropped:
+                del self._entries[path]
+        for path, entry in dropped:
+            self._drop(path, entry)
+
+    def _drop(self, path, entry):
+        if not self.keep:
+            self._delete(path)
+        with self._cond:
+            self._used -= entry[1]
+            self._cond.notify_all()
+
+    def remove(self, path, owner):
+        """Delete a single file of the tracked directory owner early"""
+        if self.keep:
+            return
+        size = diskSize(path)
+        self._delete(path)
+        self.grow(owner, -size)
+
+    @staticmethod
+    def _delete(path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def _othersBusy(self, me):
+        """Whether a thread other than me, not waiting, holds intermediates"""
+        return any(entry[2] is None or
+                   (entry[2] is not me and entry[2] not in self._waiting)
+                   for entry in self._entries.values())
+
+    def reserve(self, size):
+        """Wait until size more bytes fit in the budget, if they ever can"""
+        if self.max_bytes is None:
+            return
+        me = threading.current_thread()
+        with self._cond:
+            if self._used + size <= self.max_bytes or \
+                    not self._othersBusy(me):
+                return
+            self._waiting.add(me)
+            # the other threads may be waiting on us to release space
+            self._cond.notify_all()
+            try:
+                while self._used + size > self.max_bytes and \
+                        self._othersBusy(me):
+                    if self.cancelled is not None and \
+                            self.cancelled.is_set():
+                        return
+                    self._cond.wait(self.POLL)
+            finally:
+                self._waiting.discard(me)
+                self._cond.notify_all()
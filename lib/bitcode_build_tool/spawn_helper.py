@@ -0,0 +1,120 @@
+"""Spawn server launched by executor.SpawnServerExecutor.
+
+This runs as a separate, small python process so that launching a tool
+forks this process instead of the (possibly very large) orchestrator.  It
+must only depend on the standard library.
+
+The arguments are file descriptors (jobserver pipes) inherited from the
+orchestrator that every tool must inherit as well.
+
+Requests arrive on stdin and responses leave on stdout, both as frames:
+
+  request:  !II  request id, payload length; payload is NUL terminated
+            fields: cwd, environment count (-1 to inherit), the environment
+            entries as KEY=VALUE, then the command line
+  response: !IiiQQQI  request id, exit status, errno (non-zero when the
+            tool could not be launched), user and system CPU time in
+            microseconds, ru_maxrss as wait4() reported it, output
+            length; followed by the output
+
+A request with id CANCEL_ID and no payload kills every running tool, and
+every tool requested afterwards; their responses are still sent.
+"""
+import os
+import selectors
+import struct
+import subprocess
+import sys
+
+REQUEST = struct.Struct("!II")
+RESPONSE = struct.Struct("!IiiQQQI")
+CANCEL_ID = 0xffffffff
+
+
+def decode_request(payload):
+    fields = [os.fsdecode(x) for x in payload.split(b"\0")[:-1]]
+    cwd = fields[0] or None
+    count = int(fields[1])
+    if count < 0:
+        env = None
+        argv = fields[2:]
+    else:
+        env = dict(x.split("=", 1) for x in fields[2:2 + count])
+        argv = fields[2 + count:]
+    return cwd, env, argv
+
+
+def respond(out, request_id, returncode, error, output, rusage=None):
+    if rusage is None:
+        usage = (0, 0, 0)
+    else:
+        usage = (int(rusage.ru_utime * 1e6), int(rusage.ru_stime * 1e6),
+                 rusage.ru_maxrss)
+    out.write(RESPONSE.pack(request_id, returncode, error, *usage,
+                            len(output)))
+    out.write(output)
+    out.flush()
+
+
+def serve(inp, out, pass_fds=()):
+    selector = selectors.DefaultSelector()
+    selector.register(inp, selectors.EVENT_READ, None)
+    pending = b""
+    running = 0
+    reading = True
+    cancelled = False
+    while reading or running:
+        for key, _ in selector.select():
+            if key.data is None:
+                data = os.read(inp.fileno(), 1 << 16)
+                if not data:
+                    selector.unregister(inp)
+                    reading = False
+                    continue
+                pending += data
+                while len(pending) >= REQUEST.size:
+                    request_id, length = REQUEST.unpack_from(pending)
+                    if len(pending) < REQUEST.size + length:
+                        break
+                    payload = pending[REQUEST.size:REQUEST.size + length]
+                    pending = pending[REQUEST.size + length:]
+                    if request_id == CANCEL_ID and length == 0:
+                        cancelled = True
+                        for other in selector.get_map().values():
+                            if other.data is not None:
+                                other.data[1].kill()
+                        continue
+                    cwd, env, argv = decode_request(payload)
+                    try:
+                        proc = subprocess.Popen(argv, cwd=cwd, env=env,
+                                                pass_fds=pass_fds,
+                                                stdin=subprocess.DEVNULL,
+                                                stdout=subprocess.PIPE,
+                                                stderr=subprocess.STDOUT)
+                    except OSError as e:
+                        respond(out, request_id, -1, e.errno or 1,
+                                os.fsencode(str(e)))
+                        continue
+                    running += 1
+                    if cancelled:
+                        proc.kill()
+                    selector.register(proc.stdout, selectors.EVENT_READ,
+                                      (request_id, proc, []))
+            else:
+                request_id, proc, chunks = key.data
+                data = os.read(key.fd, 1 << 16)
+                if data:
+                    chunks.append(data)
+                    continue
+                selector.unregister(key.fileobj)
+                proc.stdout.close()
+                _, status, rusage = os.wait4(proc.pid, 0)
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                running -= 1
+                respond(out, request_id, proc.returncode, 0,
+                        b"".join(chunks), rusage)
+
+
+if __name__ == "__main__":
+    serve(sys.stdin.buffer, sys.stdout.buffer,
+          tuple(int(x) for x in sys.argv[1:]))
@@ -0,0 +1,166 @@
+"""Compiler timer reports of a build, for --time-report"""
+import re
+import threading
+
+from .usage import relativePath
+
+# the rules around the title of an LLVM timer group
+_RULE = re.compile(r"^===-+===$")
+# the columns of a timer table: ---User Time---   ---Wall Time---  --- Name ---
+_COLUMN = re.compile(r"-{2,}\s*([A-Za-z+]+(?: [A-Za-z+]+)*)\s*-{2,}")
+# a value of a timer row: 0.0123 ( 12.3%), or a bare count (Mem, Instr)
+_VALUE = re.compile(r"\s*(\d+(?:\.\d+)?)(?:\s*\(\s*\d+(?:\.\d+)?%\))?")
+
+
+def _isRule(line):
+    return _RULE.match(line.strip()) is not None
+
+
+def parseTimers(text):
+    """Split the LLVM timer groups (-ftime-report, -time-passes) out of the
+    output of a tool
+
+    Return the [(group, timer, wall seconds)] of the groups and the rest of
+    the output.
+    """
+    timers = []
+    rest = []
+    lines = text.splitlines(True)
+    index = 0
+    while index < len(lines):
+        if not (_isRule(lines[index]) and index + 2 < len(lines) and
+                _isRule(lines[index + 2])):
+            rest.append(lines[index])
+            index += 1
+            continue
+        group = lines[index + 1].strip()
+        index += 3
+        columns = None
+        while index < len(lines) and not _isRule(lines[index]):
+            line = lines[index]
+            index += 1
+            if columns is None:
+                if line.strip().endswith("--- Name ---"):
+                    columns = _COLUMN.findall(line)
+                continue
+            if not line.strip():
+                # the end of the table
+                break
+            values = []
+            position = 0
+            for _ in columns[:-1]:
+                match = _VALUE.match(line, position)
+                if match is None:
+                    break
+                values.append(float(match.group(1)))
+                position = match.end()
+            name = line[position:].strip()
+            if len(values) != len(columns) - 1 or name == "Total":
+                continue
+            if "Wall Time" in columns:
+                wall = values[columns.index("Wall Time")]
+            elif "User+System" in columns:
+                wall = values[columns.index("User+System")]
+            else:
+                continue
+            timers.append((group, name, wall))
+    return timers, u"".join(rest)
+
+
+class TimeReport(object):
+
+    """Timers of every compile and LTO link, ranked by time
+
+    Members are the inputs of the compiles (the output of an LTO link),
+    named relative to the scratch root like their bundle.  A bundle's total
+    includes its nested bundles.
+    """
+    # members and passes listed in the log summary
+    TOP = 10
+    # passes kept per member in the JSON report
+    MEMBER_PASSES = 5
+
+    def __init__(self):
+        self.root = None
+        self._lock = threading.Lock()
+        self._jobs = []
+        self._parents = dict()
+
+    def nest(self, bundle, parent):
+        """bundle is a member of parent"""
+        with self._lock:
+            self._parents[bundle] = parent
+
+    def record(self, tool, bundle, member, wall, output):
+        """Add the timers of a tool run of wall seconds from its output,
+        return the output without them"""
+        timers, rest = parseTimers(output)
+        if len(timers) == 0:
+            return output
+        with self._lock:
+            self._jobs.append((tool, bundle, member, wall, timers))
+        return rest
+
+    def toJSON(self):
+        with self._lock:
+            jobs = list(self._jobs)
+            parents = dict(self._parents)
+        members = []
+        passes = dict()
+        bundles = dict()
+        for tool, bundle, member, wall, timers in jobs:
+            own = dict()
+            for group, name, seconds in timers:
+                stat = passes.setdefault((tool, group, name), [0.0, 0])
+                stat[0] += seconds
+                stat[1] += 1
+                own[name] = own.get(name, 0.0) + seconds
+            top = sorted(own.items(), key=lambda x: -x[1])
+            members.append({
+                "tool": tool,
+                "bundle": relativePath(bundle, self.root),
+                "member": relativePath(member, self.root),
+                "wall": wall,
+                "passes": dict(top[:self.MEMBER_PASSES])})
+            nested = False
+            while bundle is not None:
+                stat = bundles.setdefault(bundle, {"wall": 0.0, "total": 0.0,
+                                                   "members": 0})
+                if not nested:
+                    stat["wall"] += wall
+                    stat["members"] += 1
+                stat["total"] += wall
+                nested = True
+                bundle = parents.get(bundle)
+        members.sort(key=lambda x: (-x["wall"], x["member"] or ""))
+        passes = [{"tool": tool, "group": group, "pass": name,
+                   "wall": stat[0], "count": stat[1]}
+                  for (tool, group, name), stat in passes.items()]
+        passes.sort(key=lambda x: (-x["wall"], x["tool"], x["pass"]))
+        return {"members": members,
+                "passes": passes,
+                "bundles": dict((relativePath(k, self.root), v)
+                                for k, v in bundles.items())}
+
+    def summary(self):
+        """Return the slowest members and passes as a string"""
+        data = self.toJSON()
+        lines = [u"{:>9}  {:<8} {}".format("wall", "tool", "slowest members")]
+        for member in data["members"][:self.TOP]:
+            lines.append(u"{:>9.3f}  {:<8} {}".format(
+                member["wall"], member["tool"], member["member"]))
+        lines.append(u"{:>9}  {:<8} {}".format("wall", "tool",
+                                               "slowest passes"))
+        for stat in data["passes"][:self.TOP]:
+            lines.append(u"{:>9.3f}  {:<8} {} ({}, {} runs)".format(
+                stat["wall"], stat["tool"], stat["pass"], stat["group"],
+                stat["count"]))
+        return u"\n".join(lines)
+
+    def write(self, prefix):
+        """Write prefix.time-report.json, return its path"""
+        import json
+        path = prefix + ".time-report.json"
+        with open(path, "w") as f:
+            json.dump(self.toJSON(), f, indent=2, sort_keys=True)
+        return path
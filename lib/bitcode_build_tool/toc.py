@@ -0,0 +1,151 @@
+"""Compact, indexed view of a xar table of contents"""
+import xml.etree.ElementTree as ET
+
+
+class XarMember(object):
+
+    """A single <file> entry of the TOC"""
+    __slots__ = ["name", "file_type", "size", "length", "offset", "encoding",
+                 "tool", "options"]
+
+    def __init__(self, name, file_type, size=0, length=0, offset=0,
+                 encoding=None, tool=None, options=()):
+        self.name = name
+        self.file_type = file_type
+        self.size = size
+        self.length = length
+        self.offset = offset
+        self.encoding = encoding
+        self.tool = tool
+        self.options = options
+
+    def __repr__(self):
+        return u"XarMember({}, {})".format(self.name, self.file_type)
+
+
+class _TOCBuilder(object):
+
+    """XMLParser target turning <file> entries straight into XarMembers
+
+    No Element is created for the TOC entries; only the subdoc is built into
+    a tree, since the bundle queries it with ElementTree.
+    """
+    TOOLS = ("clang", "swift")
+    DATA_FIELDS = ("size", "length", "offset")
+
+    def __init__(self):
+        self.subdoc = None
+        self.members = []
+        self._stack = []
+        self._text = []
+        self._subdoc_builder = None
+        self._file = None
+        self._file_depth = 0
+        # members compiled alike share one options tuple
+        self._options = dict()
+
+    def start(self, tag, attrib):
+        stack = self._stack
+        if self._subdoc_builder is not None:
+            self._subdoc_builder.start(tag, attrib)
+        elif self._file is not None:
+            depth = len(stack) - self._file_depth
+            if depth == 1 and tag in self.TOOLS:
+                self._file["tool"] = tag
+                self._file["options"] = []
+            elif depth == 2 and tag == "encoding" and stack[-1] == "data":
+                self._file["encoding"] = attrib.get("style")
+        elif tag == "file" and stack and stack[-1] == "toc":
+            self._file = dict()
+            self._file_depth = len(stack)
+        elif tag == "subdoc" and self.subdoc is None and len(stack) == 1:
+            self._subdoc_builder = ET.TreeBuilder()
+            self._subdoc_builder.start(tag, attrib)
+        stack.append(tag)
+        self._text = []
+
+    def data(self, text):
+        if self._subdoc_builder is not None:
+            self._subdoc_builder.data(text)
+        else:
+            self._text.append(text)
+
+    def end(self, tag):
+        stack = self._stack
+        stack.pop()
+        if self._subdoc_builder is not None:
+            self._subdoc_builder.end(tag)
+            if len(stack) == 1:
+                self.subdoc = self._subdoc_builder.close()
+                self._subdoc_builder = None
+            return
+        if self._file is None:
+            return
+        depth = len(stack) - self._file_depth
+        if depth == 0:
+            entry = self._file
+            self._file = None
+            self.members.append(XarMember(
+                entry.get("name"), entry.get("file-type"),
+                entry.get("size", 0), entry.get("length", 0),
+                entry.get("offset", 0), entry.get("encoding"),
+                entry.get("tool"), self.internOptions(entry.get("options"))))
+        elif depth == 1:
+            if tag == "name" or tag == "file-type":
+                self._file[tag] = "".join(self._text)
+        elif depth == 2:
+            parent = stack[-1]
+            if parent == "data" and tag in self.DATA_FIELDS:
+                try:
+                    self._file[tag] = int("".join(self._text))
+                except ValueError:
+                    self._file[tag] = 0
+            elif tag == "cmd" and parent == self._file.get("tool"):
+                self._file["options"].append("".join(self._text))
+
+    def internOptions(self, options):
+        """Return the shared tuple equal to the options list"""
+        if not options:
+            return ()
+        options = tuple(options)
+        return self._options.setdefault(options, options)
+
+    def close(self):
+        return self
+
+
+class XarTOC(object):
+
+    """Members of a xar archive, indexed by file type
+
+    The TOC is parsed in a single pass from a stream and each <file> entry
+    is kept only as a XarMember, so only the (small) subdoc element outlives
+    the parse.
+    """
+
+    def __init__(self, subdoc, members):
+        self.subdoc = subdoc
+        self.members = members
+        self._index = dict()
+        for member in members:
+            self._index.setdefault(member.file_type, []).append(member)
+
+    def __len__(self):
+        return len(self.members)
+
+    def files(self, file_type):
+        """Return all the members of file type"""
+        return self._index.get(file_type, [])
+
+    @classmethod
+    def parse(cls, source, chunk_size=1 << 16):
+        """Parse the TOC incrementally from a binary file object"""
+        builder = _TOCBuilder()
+        parser = ET.XMLParser(target=builder)
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            parser.feed(chunk)
+        parser.close()
+        return cls(builder.subdoc, builder.members)
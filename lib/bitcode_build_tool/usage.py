@@ -0,0 +1,158 @@
+"""Resources used by the tools of a build, for --resource-report"""
+import os
+import sys
+import threading
+
+
+def maxRSSBytes(ru_maxrss):
+    """ru_maxrss in bytes: kilobytes on Linux, bytes on macOS"""
+    if sys.platform == "darwin":
+        return ru_maxrss
+    return ru_maxrss * 1024
+
+
+class ToolUsage(object):
+
+    """CPU time and peak memory of a tool, from the rusage of wait4()"""
+    __slots__ = ("user", "system", "max_rss")
+
+    def __init__(self, user=0.0, system=0.0, max_rss=0):
+        self.user = user
+        self.system = system
+        self.max_rss = max_rss
+
+    @classmethod
+    def fromRusage(cls, rusage):
+        return cls(rusage.ru_utime, rusage.ru_stime,
+                   maxRSSBytes(rusage.ru_maxrss))
+
+
+def waitProcess(proc, flags=0):
+    """Reap the Popen proc with wait4(), return its ToolUsage
+
+    None with os.WNOHANG while it is still running.  Popen reaps the tool
+    itself (and no usage is known) when something polled it first.
+    """
+    try:
+        pid, status, rusage = os.wait4(proc.pid, flags)
+    except ChildProcessError:
+        proc.wait()
+        return ToolUsage()
+    if pid == 0:
+        return None
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return ToolUsage.fromRusage(rusage)
+
+
+def relativePath(path, root):
+    """path relative to root if under it (and root not None)"""
+    if path is None or root is None:
+        return path
+    path = os.path.abspath(path)
+    if path.startswith(root + os.sep):
+        return os.path.relpath(path, root)
+    return path
+
+
+def fileSize(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+class UsageStats(object):
+
+    """Usage of the jobs of a tool or a bundle, added up"""
+
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.user = 0.0
+        self.system = 0.0
+        self.max_rss = 0
+        self.max_rss_job = None
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+    def add(self, job):
+        self.count += 1
+        self.wall += job["wall"]
+        self.user += job["user"]
+        self.system += job["system"]
+        if job["max_rss"] > self.max_rss or self.max_rss_job is None:
+            self.max_rss = job["max_rss"]
+            self.max_rss_job = job["input"] or job["output"]
+        self.input_bytes += job["input_bytes"] or 0
+        self.output_bytes += job["output_bytes"] or 0
+
+    def toJSON(self):
+        return {"count": self.count,
+                "wall": self.wall,
+                "user": self.user,
+                "system": self.system,
+                "max_rss": self.max_rss,
+                "max_rss_job": self.max_rss_job,
+                "input_bytes": self.input_bytes,
+                "output_bytes": self.output_bytes}
+
+
+class UsageReport(object):
+
+    """Every tool a build ran, with its resources, per bundle and per tool
+
+    Paths under the scratch root (root, once created) are written relative
+    to it, so the reports of two builds of an app line up.
+    """
+
+    def __init__(self):
+        self.root = None
+        self._lock = threading.Lock()
+        self._jobs = []
+
+    def record(self, tool, phase, bundle, wall, usage, input=None,
+               output=None):
+        """Add a tool run of wall seconds; input and output are measured
+        now, before the build deletes them"""
+        job = {"tool": tool,
+               "phase": phase,
+               "bundle": bundle,
+               "input": input,
+               "output": output,
+               "wall": wall,
+               "user": usage.user,
+               "system": usage.system,
+               "max_rss": usage.max_rss,
+               "input_bytes": fileSize(input) if input else None,
+               "output_bytes": fileSize(output) if output else None}
+        with self._lock:
+            self._jobs.append(job)
+
+    def toJSON(self):
+        with self._lock:
+            jobs = [dict(x) for x in self._jobs]
+        for job in jobs:
+            for name in ("bundle", "input", "output"):
+                job[name] = relativePath(job[name], self.root)
+        tools = dict()
+        bundles = dict()
+        total = UsageStats()
+        for job in jobs:
+            total.add(job)
+            tools.setdefault(job["tool"], UsageStats()).add(job)
+            if job["bundle"] is not None:
+                bundles.setdefault(job["bundle"], UsageStats()).add(job)
+        # the heaviest first, that's what the report is read for
+        jobs.sort(key=lambda x: (-x["max_rss"], x["tool"], x["input"] or ""))
+        return {"total": total.toJSON(),
+                "tools": dict((k, v.toJSON()) for k, v in tools.items()),
+                "bundles": dict((k, v.toJSON()) for k, v in bundles.items()),
+                "jobs": jobs}
+
+    def write(self, prefix):
+        """Write prefix.resources.json, return its path"""
+        import json
+        path = prefix + ".resources.json"
+        with open(path, "w") as f:
+            json.dump(self.toJSON(), f, indent=2, sort_keys=True)
+        return path
@@ -1,5 +1,6 @@
 """This module verify the options in the bitcode are valid"""
 import argparse
+import threading
 
 
 # The exception for verificaion failed
@@ -22,6 +23,7 @@ class OptionVerifier(argparse.ArgumentParser):
         # clang/ld/swift so options like -mllvm/-Xllvm can take an option
         # begins with '-'
         self._negative_number_matcher = FlagMatcher()
+        self._check_lock = threading.Lock()
 
     def error(self, message):
         """Overwrite the error method so SystemExit is not raised"""
@@ -39,6 +41,16 @@ class OptionVerifier(argparse.ArgumentParser):
             self._error_msg = ''
             return True
 
+    def check(self, options):
+        """Return None if the options are legal, the error message if not
+
+        Unlike verify() and error_msg, safe to call from several threads.
+        """
+        with self._check_lock:
+            if self.verify(options):
+                return None
+            return self.error_msg
+
     @property
     def error_msg(self):
         """Return the error message if there is one"""
@@ -180,8 +192,30 @@ class SwiftOptVerifier(OptionVerifier):
     def verify(self, options):
         return super(SwiftOptVerifier, self).verify(options)
 
-# Initialized verifier
-# For sequential uses
-clang_option_verifier = ClangOptVerifier()
-ld_option_verifier = LinkerOptVerifier()
-swift_option_verifier = SwiftOptVerifier()
+
+class LazyVerifier(object):
+
+    """Construct a verifier on first use
+
+    Building the argparse parsers is a large part of the import time, and
+    inputs without bitcode never verify anything.
+    """
+
+    def __init__(self, cls):
+        self._cls = cls
+        self._verifier = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if self._verifier is None:
+            with self._lock:
+                if self._verifier is None:
+                    self._verifier = self._cls()
+        return getattr(self._verifier, name)
+
+
+# Shared verifiers, built on first use
+# For concurrent uses call check(), not verify() and error_msg
+clang_option_verifier = LazyVerifier(ClangOptVerifier)
+ld_option_verifier = LazyVerifier(LinkerOptVerifier)
+swift_option_verifier = LazyVerifier(SwiftOptVerifier)
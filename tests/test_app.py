@@ -0,0 +1,49 @@
+"""AppBundle.repack"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "lib"))
+
+from bitcode_build_tool.app import AppBundle
+
+
+class RepackTest(unittest.TestCase):
+
+    BINARY = "Payload/Foo.app/Foo"
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="bitcode-app-test")
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.ipa = os.path.join(self.dir, "Foo.ipa")
+        with zipfile.ZipFile(self.ipa, "w") as archive:
+            archive.writestr(self.BINARY, b"\0" * 100)
+
+    def staged(self):
+        """The AppBundle of the ipa, extracted as stage() does"""
+        app = AppBundle(self.ipa)
+        app.root = os.path.join(self.dir, "root")
+        with zipfile.ZipFile(self.ipa) as archive:
+            for info in archive.infolist():
+                app._extracted[info.filename] = archive.extract(info,
+                                                                app.root)
+        return app
+
+    def test_grown_past_zip64_limit(self):
+        app = self.staged()
+        with open(app._extracted[self.BINARY], "wb") as f:
+            f.write(b"\1" * 5000)
+        output = os.path.join(self.dir, "Rebuilt.ipa")
+        with mock.patch.object(zipfile, "ZIP64_LIMIT", 1000):
+            app.repack(output)
+        with zipfile.ZipFile(output) as archive:
+            self.assertEqual(archive.read(self.BINARY), b"\1" * 5000)
+
+
+if __name__ == "__main__":
+    unittest.main()
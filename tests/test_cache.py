@@ -0,0 +1,78 @@
+"""BuildCache"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "lib"))
+
+from bitcode_build_tool.cache import BuildCache, pruneDirectory
+
+
+class BuildCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="bitcode-cache-test")
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.cache = BuildCache(os.path.join(self.dir, "cache"), "compile")
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def cacheFiles(self):
+        return [name for _, _, files in os.walk(self.cache.path)
+                for name in files]
+
+    def test_key(self):
+        key = BuildCache.key("clang", "-O2", b"\0")
+        self.assertEqual(key, BuildCache.key("clang", "-O2", b"\0"))
+        self.assertNotEqual(key, BuildCache.key("-O2", "clang", b"\0"))
+        # parts are hashed separately, joining them changes the key
+        self.assertNotEqual(BuildCache.key("ab", "c"),
+                            BuildCache.key("a", "bc"))
+
+    def test_round_trip(self):
+        key = BuildCache.key("clang", "-O2")
+        output = os.path.join(self.dir, "out.o")
+        self.assertFalse(self.cache.lookup(key, output))
+        self.assertFalse(os.path.exists(output))
+        self.assertTrue(self.cache.store(key, self.write("a.o", b"object")))
+        self.assertEqual(self.cacheFiles(), [key])
+        self.assertTrue(self.cache.lookup(key, output))
+        with open(output, "rb") as f:
+            self.assertEqual(f.read(), b"object")
+
+    def test_digests(self):
+        first = self.write("a", b"tool")
+        second = self.write("b", b"tool")
+        self.assertEqual(BuildCache.fileDigest(first),
+                         BuildCache.fileDigest(second))
+        self.assertEqual(BuildCache.toolKey(first),
+                         BuildCache.fileDigest(first))
+        self.assertNotEqual(BuildCache.fileDigest(self.write("c", b"other")),
+                            BuildCache.fileDigest(first))
+
+    def test_prune(self):
+        for index, name in enumerate(["old", "middle", "new"]):
+            path = self.write(name, b"\0" * 100)
+            os.utime(path, (1000 + index, 1000 + index))
+        self.assertEqual(pruneDirectory(self.dir, 250), 100)
+        self.assertEqual(sorted(os.listdir(self.dir)), ["middle", "new"])
+        self.assertEqual(pruneDirectory(self.dir, 200), 0)
+        self.assertEqual(pruneDirectory(self.dir, 0), 200)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_failed_store_leaves_nothing(self):
+        key = BuildCache.key("clang", "-O2")
+        missing = os.path.join(self.dir, "missing.o")
+        self.assertFalse(self.cache.store(key, missing))
+        self.assertEqual(self.cacheFiles(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
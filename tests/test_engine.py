@@ -0,0 +1,54 @@
+"""AsyncEngine.map"""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "lib"))
+
+from bitcode_build_tool.engine import AsyncEngine
+
+
+class MapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = AsyncEngine()
+        self.addCleanup(self.engine.close)
+
+    def test_results_in_order(self):
+        async def square(x):
+            await asyncio.sleep(0.01 * (5 - x))
+            return x * x
+        self.assertEqual(self.engine.map(square, range(5)),
+                         [0, 1, 4, 9, 16])
+
+    def test_fail_fast_ends_the_other_jobs(self):
+        ended = []
+        failures = []
+
+        async def job(x):
+            try:
+                if x == 0:
+                    raise ValueError("job failed")
+                await asyncio.sleep(10)
+            finally:
+                ended.append(x)
+
+        with self.assertRaises(ValueError):
+            self.engine.map(job, range(4), on_failure=failures.append)
+        # the siblings were cancelled and have ended when map() raises
+        self.assertEqual(sorted(ended), [0, 1, 2, 3])
+        self.assertEqual(len(failures), 1)
+
+    def test_failure_after_the_others(self):
+        async def job(x):
+            if x == 1:
+                raise ValueError("job failed")
+            return x
+        with self.assertRaises(ValueError):
+            self.engine.map(job, range(3), fail_fast=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+"""SliceInfo and writeFat"""
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "lib"))
+
+from bitcode_build_tool import fat
+
+ARM64 = fat.CPU_TYPE_ARM | fat.CPU_ARCH_ABI64
+X86_64 = fat.CPU_TYPE_X86 | fat.CPU_ARCH_ABI64
+
+
+def thinMacho(cputype, cpusubtype, uuid_bytes=None, body=b""):
+    """A 64 bit Mach-O header, its LC_UUID if any, then body"""
+    commands = b""
+    if uuid_bytes is not None:
+        commands = struct.pack("<II", fat.LC_UUID, 24) + uuid_bytes
+    ncmds = 1 if commands else 0
+    header = struct.pack("<IiiIIIII", fat.MH_MAGIC_64, cputype, cpusubtype,
+                         2, ncmds, len(commands), 0, 0)
+    return header + commands + body
+
+
+def bitcodeMacho(cputype, cpusubtype, bundle_size):
+    """A 64 bit Mach-O with an __LLVM,__bundle section of bundle_size"""
+    section = struct.pack("<16s16sQQIIIIIIII", b"__bundle", b"__LLVM", 0,
+                          bundle_size, 0, 0, 0, 0, 0, 0, 0, 0)
+    segment = struct.pack("<II16sQQQQiiII", fat.LC_SEGMENT_64,
+                          72 + len(section), b"__LLVM", 0, 0, 0, 0, 0, 0, 1,
+                          0) + section
+    header = struct.pack("<IiiIIIII", fat.MH_MAGIC_64, cputype, cpusubtype, 1, 1,
+                         len(segment), 0, 0)
+    return header + segment
+
+
+class FatTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="bitcode-fat-test")
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+
+class SliceInfoTest(FatTestCase):
+
+    def test_uuid(self):
+        value = uuid.uuid4()
+        path = self.write("a", thinMacho(ARM64, 0, value.bytes))
+        info = fat.SliceInfo(path)
+        self.assertEqual(info.arch, "arm64")
+        self.assertEqual(info.uuid, str(value).upper())
+        self.assertEqual(info.size, os.path.getsize(path))
+
+    def test_arm64v8(self):
+        # lipo and dwarfdump name subtype 1 arm64v8, not arm64
+        path = self.write("a", thinMacho(ARM64, 1, uuid.uuid4().bytes))
+        self.assertEqual(fat.SliceInfo(path).arch, "arm64v8")
+
+    def test_not_thin(self):
+        thin = self.write("a", thinMacho(ARM64, 0))
+        output = os.path.join(self.dir, "fat")
+        fat.writeFat([thin], output)
+        self.assertRaises(fat.FatError, fat.SliceInfo, output)
+        self.assertRaises(fat.FatError, fat.SliceInfo,
+                          self.write("b", b"\0" * 64))
+        self.assertRaises(fat.FatError, fat.SliceInfo,
+                          self.write("c", thinMacho(99, 0)))
+
+
+class WriteFatTest(FatTestCase):
+
+    def test_layout(self):
+        arm64 = self.write("arm64", thinMacho(ARM64, 0, uuid.uuid4().bytes,
+                                              b"\1" * 5000))
+        x86_64 = self.write("x86_64", thinMacho(X86_64, 3,
+                                                uuid.uuid4().bytes, b"\2"))
+        output = os.path.join(self.dir, "fat")
+        slices = fat.writeFat([arm64, x86_64], output)
+        # ordered by alignment like lipo
+        self.assertEqual([x.arch for x in slices], ["x86_64", "arm64"])
+        with open(output, "rb") as f:
+            data = f.read()
+        magic, count = fat.FAT_HEADER.unpack_from(data)
+        self.assertEqual((magic, count), (fat.FAT_MAGIC, 2))
+        for index, info in enumerate(slices):
+            cputype, cpusubtype, offset, size, align = fat.FAT_ARCH.unpack_from(
+                data, fat.FAT_HEADER.size + index * fat.FAT_ARCH.size)
+            self.assertEqual((cputype, cpusubtype, size, align),
+                             (info.cputype, info.cpusubtype, info.size,
+                              info.align))
+            self.assertEqual(offset % (1 << align), 0)
+            with open(info.path, "rb") as f:
+                self.assertEqual(data[offset:offset + size], f.read())
+        self.assertEqual(slices[1].align, 14)
+        self.assertEqual(slices[0].align, fat.DEFAULT_ALIGN)
+
+    def test_same_arch(self):
+        first = self.write("a", thinMacho(ARM64, 0))
+        second = self.write("b", thinMacho(ARM64, 0, body=b"\1"))
+        output = os.path.join(self.dir, "fat")
+        self.assertRaises(fat.FatError, fat.writeFat, [first, second], output)
+        self.assertFalse(os.path.exists(output))
+
+    def test_has_bitcode(self):
+        thin = self.write("a", thinMacho(ARM64, 0, uuid.uuid4().bytes))
+        self.assertFalse(fat.hasBitcode(thin))
+        # the bitcode marker alone doesn't count
+        marker = self.write("marker", bitcodeMacho(ARM64, 0, 1))
+        self.assertFalse(fat.hasBitcode(marker))
+        bundle = self.write("bundle", bitcodeMacho(X86_64, 3, 4096))
+        self.assertTrue(fat.hasBitcode(bundle))
+        output = os.path.join(self.dir, "fat")
+        fat.writeFat([marker, bundle], output)
+        self.assertTrue(fat.hasBitcode(output))
+        self.assertFalse(fat.hasBitcode(self.write("b", b"#!/bin/sh\n")))
+        self.assertFalse(fat.hasBitcode(os.path.join(self.dir, "missing")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+"""JobServerClient and JobServer"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "lib"))
+
+from bitcode_build_tool.jobserver import JobServer, JobServerClient
+
+
+class JobServerClientTest(unittest.TestCase):
+
+    def pipe(self, tokens):
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        os.write(write_fd, b"+" * tokens)
+        return read_fd, write_fd
+
+    def connect(self, makeflags):
+        client = JobServerClient.fromEnvironment({"MAKEFLAGS": makeflags})
+        if client is not None:
+            self.addCleanup(client.close)
+        return client
+
+    def test_no_jobserver(self):
+        self.assertIsNone(JobServerClient.fromEnvironment({}))
+        self.assertIsNone(self.connect("-j4"))
+        self.assertIsNone(self.connect("--jobserver-auth='unbalanced"))
+
+    def test_pipe(self):
+        read_fd, write_fd = self.pipe(2)
+        flags = "-j3 --jobserver-auth={},{}".format(read_fd, write_fd)
+        client = self.connect(flags)
+        self.assertEqual((client.read_fd, client.write_fd),
+                         (read_fd, write_fd))
+        self.assertEqual(client.pass_fds, (read_fd, write_fd))
+        self.assertEqual(client.childEnvironment(), {"MAKEFLAGS": flags})
+        token = client.acquire()
+        self.assertEqual(token, b"+")
+        client.release(token)
+        self.assertEqual(len(os.read(read_fd, 16)), 2)
+
+    def test_old_spelling(self):
+        read_fd, write_fd = self.pipe(0)
+        client = self.connect("--jobserver-fds={},{} -j".format(read_fd,
+                                                               write_fd))
+        self.assertEqual(client.read_fd, read_fd)
+
+    def test_closed_descriptors(self):
+        # make doesn't pass the pipe to commands it doesn't know recurse
+        read_fd, write_fd = os.pipe()
+        os.close(read_fd)
+        os.close(write_fd)
+        self.assertIsNone(self.connect(
+            "--jobserver-auth={},{}".format(read_fd, write_fd)))
+        self.assertIsNone(self.connect("--jobserver-auth=-1,-1"))
+        self.assertIsNone(self.connect("--jobserver-auth=fifo:/nonexistent"))
+
+    @unittest.skipUnless(sys.platform.startswith("linux"),
+                         "pipes are reopened through /proc")
+    def test_try_acquire(self):
+        read_fd, write_fd = self.pipe(1)
+        client = JobServerClient(read_fd, write_fd)
+        self.addCleanup(client.close)
+        self.assertTrue(client.pollable)
+        self.assertEqual(client.tryAcquire(), b"+")
+        self.assertIsNone(client.tryAcquire())
+
+
+class JobServerTest(unittest.TestCase):
+
+    def test_tokens(self):
+        server = JobServer(3)
+        self.addCleanup(server.close)
+        # the implicit slot is not in the fifo
+        tokens = [server.tryAcquire() for _ in range(3)]
+        self.assertEqual(tokens, [b"+", b"+", None])
+        for token in tokens:
+            server.release(token)
+
+    def test_joined_through_makeflags(self):
+        server = JobServer(2)
+        self.addCleanup(server.close)
+        self.assertEqual(server.pass_fds, ())
+        client = JobServerClient.fromEnvironment(server.childEnvironment())
+        self.addCleanup(client.close)
+        self.assertEqual(client.fifo, server.fifo)
+        token = client.tryAcquire()
+        self.assertEqual(token, b"+")
+        self.assertIsNone(server.tryAcquire())
+        client.release(token)
+        self.assertEqual(server.tryAcquire(), b"+")
+
+    def test_close_removes_fifo(self):
+        server = JobServer(2)
+        server.close()
+        self.assertFalse(os.path.exists(server.fifo))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,36 @@
+"""Command line exits of bitcode-build-tool"""
+import contextlib
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "lib"))
+
+from bitcode_build_tool import bitcode_build_tool_main, BitcodeBuildFailure
+from bitcode_build_tool import BuildEnvironment
+
+
+class EarlyErrorTest(unittest.TestCase):
+
+    def main(self, *args):
+        out = io.StringIO()
+        # a fresh environment, nothing left over from another build
+        with BuildEnvironment().activate(), contextlib.redirect_stdout(out):
+            with self.assertRaises(BitcodeBuildFailure):
+                bitcode_build_tool_main(["bitcode-build-tool"] + list(args))
+        return out.getvalue()
+
+    def test_missing_library_list(self):
+        # fails while the environment is half initialized
+        out = self.main("/bin/ls", "--library-list", "/nonexistent.txt")
+        self.assertIn("library list doesn't exist", out)
+
+    def test_missing_input(self):
+        out = self.main("/nonexistent", "-o", "/nonexistent.out")
+        self.assertIn("Input macho file doesn't exist", out)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+"""JobSlots, with and without a jobserver"""
+import asyncio
+import os
+import sys
+import threading
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "lib"))
+
+from bitcode_build_tool.jobserver import JobServer, JobServerClient
+from bitcode_build_tool.scheduler import JobSlots
+
+
+class JobSlotsTest(unittest.TestCase):
+
+    def test_counts(self):
+        slots = JobSlots(4)
+        self.assertEqual(slots.acquire(3), 3)
+        self.assertEqual(slots.available, 1)
+        # never more than -j, and only what is free above the minimum
+        self.assertEqual(slots.acquire(8, minimum=1), 1)
+        self.assertEqual(slots.available, 0)
+        slots.release(4)
+        self.assertEqual(slots.available, 4)
+        self.assertEqual(slots.acquire(0), 0)
+        self.assertEqual(JobSlots(0).total, 1)
+
+    def test_hold(self):
+        slots = JobSlots(2)
+        with slots.hold(2) as granted:
+            self.assertEqual(granted, 2)
+            self.assertEqual(slots.available, 0)
+        self.assertEqual(slots.available, 2)
+
+    def test_waits_for_minimum(self):
+        slots = JobSlots(2)
+        slots.acquire(2)
+        granted = []
+        waiter = threading.Thread(target=lambda: granted.append(
+            slots.acquire(2, minimum=1)))
+        waiter.start()
+        waiter.join(0.05)
+        self.assertTrue(waiter.is_alive())
+        slots.release(1)
+        waiter.join()
+        self.assertEqual(granted, [1])
+
+    def test_idle_only_is_lent(self):
+        slots = JobSlots(2)
+        self.assertEqual(slots.acquire(2, idle_only=True), 2)
+        # regular work takes lent slots back at once
+        self.assertEqual(slots.acquire(2), 2)
+        self.assertEqual(slots.acquire(1, minimum=0, idle_only=True), 0)
+        slots.release(2)
+        self.assertEqual(slots.acquire(1, minimum=0, idle_only=True), 0)
+        slots.release(2, idle_only=True)
+        self.assertEqual(slots.acquire(2, idle_only=True), 2)
+
+    def test_jobserver_tokens(self):
+        server = JobServer(3)
+        self.addCleanup(server.close)
+        slots = JobSlots(4, server)
+        # the implicit slot and both tokens of the jobserver
+        self.assertEqual(slots.acquire(4, minimum=1), 3)
+        self.assertIsNone(server.tryAcquire())
+        slots.release(3)
+        self.assertEqual(slots.available, 4)
+        tokens = [server.tryAcquire() for _ in range(3)]
+        self.assertEqual(tokens, [b"+", b"+", None])
+
+
+class AsyncJobserverTest(unittest.TestCase):
+
+    JOBS = 16
+
+    def peakConcurrency(self, slots):
+        """Run JOBS coroutines holding a slot each, return how many ran at
+        once at most"""
+        state = {"running": 0, "peak": 0}
+
+        async def job():
+            granted = await slots.acquireAsync(1)
+            self.assertEqual(granted, 1)
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+            await asyncio.sleep(0.05)
+            state["running"] -= 1
+            slots.release(granted)
+
+        async def fanOut():
+            await asyncio.gather(*[job() for _ in range(self.JOBS)])
+
+        asyncio.run(fanOut())
+        return state["peak"]
+
+    def test_pipe_without_proc(self):
+        # an inherited pipe can't be reopened non-blocking off Linux
+        read_fd, write_fd = os.pipe()
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        os.write(write_fd, b"+" * 7)
+        with mock.patch.object(sys, "platform", "darwin"):
+            client = JobServerClient(read_fd, write_fd)
+        self.addCleanup(client.close)
+        self.assertFalse(client.pollable)
+        self.assertEqual(self.peakConcurrency(JobSlots(8, client)), 8)
+        # every token went back
+        self.assertEqual(len(os.read(read_fd, 64)), 7)
+
+    def test_own_jobserver(self):
+        with mock.patch.object(sys, "platform", "darwin"):
+            server = JobServer(8)
+        self.addCleanup(server.close)
+        self.assertTrue(server.pollable)
+        self.assertEqual(self.peakConcurrency(JobSlots(8, server)), 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+"""XarTOC.parse"""
+import io
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                "..", "lib"))
+
+from bitcode_build_tool.toc import XarTOC
+
+TOC = b"""<?xml version="1.0" encoding="UTF-8"?>
+<xar>
+ <subdoc subdoc_name="Ignore">
+  <version>1.0</version>
+  <architecture>arm64</architecture>
+  <platform>iOS</platform>
+  <link-options><option>-execute</option><option>-dead_strip</option>
+  </link-options>
+ </subdoc>
+ <toc>
+  <checksum style="sha1"><offset>0</offset><size>20</size></checksum>
+  <file id="1">
+   <name>1</name>
+   <file-type>Bitcode</file-type>
+   <data>
+    <length>100</length><offset>20</offset><size>400</size>
+    <encoding style="application/x-gzip"/>
+   </data>
+   <clang><cmd>-triple</cmd><cmd>arm64-apple-ios12.0.0</cmd><cmd>-O2</cmd></clang>
+  </file>
+  <file id="2">
+   <name>2</name>
+   <file-type>Bitcode</file-type>
+   <data><length>50</length><offset>120</offset><size>50</size></data>
+   <clang><cmd>-triple</cmd><cmd>arm64-apple-ios12.0.0</cmd><cmd>-O2</cmd></clang>
+  </file>
+  <file id="3">
+   <name>3</name>
+   <file-type>Bitcode</file-type>
+   <data><length>60</length><offset>170</offset><size>60</size></data>
+   <swift><cmd>-emit-object</cmd><cmd>-Onone</cmd></swift>
+  </file>
+  <file id="4">
+   <name>4</name>
+   <file-type>Object</file-type>
+   <data><length>10</length><offset>230</offset><size>bad</size></data>
+  </file>
+ </toc>
+</xar>
+"""
+
+
+class XarTOCTest(unittest.TestCase):
+
+    def parse(self, chunk_size=1 << 16):
+        return XarTOC.parse(io.BytesIO(TOC), chunk_size)
+
+    def test_members(self):
+        toc = self.parse()
+        self.assertEqual(len(toc), 4)
+        first = toc.members[0]
+        self.assertEqual((first.name, first.file_type), ("1", "Bitcode"))
+        self.assertEqual((first.size, first.length, first.offset),
+                         (400, 100, 20))
+        self.assertEqual(first.encoding, "application/x-gzip")
+        self.assertEqual(first.tool, "clang")
+        self.assertEqual(first.options,
+                         ("-triple", "arm64-apple-ios12.0.0", "-O2"))
+        swift = toc.members[2]
+        self.assertEqual(swift.tool, "swift")
+        self.assertEqual(swift.options, ("-emit-object", "-Onone"))
+        self.assertIsNone(swift.encoding)
+
+    def test_files_by_type(self):
+        toc = self.parse()
+        self.assertEqual([x.name for x in toc.files("Bitcode")],
+                         ["1", "2", "3"])
+        self.assertEqual([x.name for x in toc.files("Object")], ["4"])
+        self.assertEqual(toc.files("Bundle"), [])
+
+    def test_object_without_tool(self):
+        member = self.parse().files("Object")[0]
+        self.assertIsNone(member.tool)
+        self.assertEqual(member.options, ())
+        # a malformed number reads as 0
+        self.assertEqual(member.size, 0)
+
+    def test_shared_options(self):
+        first, second = self.parse().files("Bitcode")[:2]
+        self.assertIs(first.options, second.options)
+
+    def test_subdoc(self):
+        subdoc = self.parse().subdoc
+        self.assertEqual(subdoc.find("platform").text, "iOS")
+        self.assertEqual([x.text for x in
+                          subdoc.find("link-options").findall("option")],
+                         ["-execute", "-dead_strip"])
+
+    def test_small_chunks(self):
+        toc = self.parse(chunk_size=7)
+        self.assertEqual([x.name for x in toc.members], ["1", "2", "3", "4"])
+        self.assertEqual(toc.members[0].options[-1], "-O2")
+
+
+if __name__ == "__main__":
+    unittest.main()